@@ -1,10 +1,17 @@
 import logging
+from sqlalchemy import select
 from flask import Blueprint, render_template, redirect, url_for, flash, request, current_app
 from flask_login import login_required, current_user
 from app import db
-from models import User, Board, Thread, Post, Image
+from models import User, Board, Thread, Post, Image, BannedImage
 from forms import BoardForm, ModerateThreadForm, ModeratePostForm
-from mega_utils import mega_handler
+from tasks import refresh_thread_counters, delete_threads
+from file_deletions import file_deletion_queue
+from catalog import catalog_cache
+from page_cache import page_cache, board_tag, thread_tag, INDEX_TAG
+from conditional import touch_board, touch_thread
+from live import thread_events
+from image_hashes import image_index, banned_index
 
 logger = logging.getLogger(__name__)
 
@@ -80,6 +87,7 @@ def new_board():
         
         db.session.add(board)
         db.session.commit()
+        page_cache.invalidate(INDEX_TAG)
         
         flash(f'Board /{form.slug.data}/ created successfully', 'success')
         return redirect(url_for('admin.boards'))
@@ -107,8 +115,11 @@ def edit_board(board_id):
         board.description = form.description.data
         board.category = form.category.data
         board.nsfw = form.nsfw.data
+        touch_board(board.id)
         
         db.session.commit()
+        # Thread pages show the board too but are only tagged with their thread
+        page_cache.clear()
         
         flash(f'Board /{form.slug.data}/ updated successfully', 'success')
         return redirect(url_for('admin.boards'))
@@ -121,21 +132,22 @@ def edit_board(board_id):
 def delete_board(board_id):
     board = Board.query.get_or_404(board_id)
     
-    # Get all threads in the board
-    threads = Thread.query.filter_by(board_id=board.id).all()
+    # Delete the threads with their posts and images in batches, queueing their files
+    batch_size = current_app.config.get('THREAD_CLEANUP_BATCH_SIZE', 100)
+    while True:
+        threads = db.session.execute(
+            select(Thread.id, Thread.board_id).where(Thread.board_id == board.id).limit(batch_size)
+        ).all()
+        if not threads:
+            break
+        delete_threads(threads)
     
-    # Delete all images from Mega.nz
-    for thread in threads:
-        posts = Post.query.filter_by(thread_id=thread.id).all()
-        for post in posts:
-            images = Image.query.filter_by(post_id=post.id).all()
-            for image in images:
-                if image.mega_url:
-                    mega_handler.delete_file(image.mega_url)
-    
-    # The database cascade will handle deleting threads, posts, and images
     db.session.delete(board)
     db.session.commit()
+    file_deletion_queue.kick()
+    catalog_cache.remove_board(board_id)
+    # Thread pages are only tagged with their thread
+    page_cache.clear()
     
     flash(f'Board {board.name} deleted successfully', 'success')
     return redirect(url_for('admin.boards'))
@@ -149,26 +161,30 @@ def moderate_thread(thread_id):
     
     if form.validate_on_submit():
         if form.delete.data:
-            # Delete all images from Mega.nz
-            posts = Post.query.filter_by(thread_id=thread.id).all()
-            for post in posts:
-                images = Image.query.filter_by(post_id=post.id).all()
-                for image in images:
-                    if image.mega_url:
-                        mega_handler.delete_file(image.mega_url)
+            # Get board info before deleting the thread
+            board_id = thread.board_id
+            board_slug = thread.board.slug
             
-            # Delete the thread
-            db.session.delete(thread)
+            # Delete the thread with its posts and images, queueing their files
+            delete_threads([(thread_id, board_id)])
             db.session.commit()
+            file_deletion_queue.kick()
+            catalog_cache.remove_thread(board_id, thread_id)
+            page_cache.invalidate(board_tag(board_id), thread_tag(thread_id), INDEX_TAG)
+            thread_events.discard(thread_id)
             
             flash(f'Thread {thread_id} deleted successfully', 'success')
-            return redirect(url_for('boards.view_board', board_slug=thread.board.slug))
+            return redirect(url_for('boards.view_board', board_slug=board_slug))
         else:
             # Update thread properties
             thread.sticky = form.sticky.data
             thread.locked = form.locked.data
+            touch_board(thread.board_id)
+            touch_thread(thread.id)
             
             db.session.commit()
+            catalog_cache.update_thread(thread)
+            page_cache.invalidate(board_tag(thread.board_id), thread_tag(thread.id), INDEX_TAG)
             
             flash(f'Thread {thread_id} updated successfully', 'success')
             return redirect(url_for('threads.view_thread', board_slug=thread.board.slug, thread_id=thread.id))
@@ -184,19 +200,26 @@ def moderate_post(post_id):
     
     if form.validate_on_submit():
         if form.delete.data:
-            # Delete all images from Mega.nz
-            images = Image.query.filter_by(post_id=post.id).all()
-            for image in images:
-                if image.mega_url:
-                    mega_handler.delete_file(image.mega_url)
+            # Queue the files of the post's images for deletion
+            file_ids = []
+            for image in post.images:
+                file_ids.extend(image.file_ids())
+            file_deletion_queue.release(file_ids)
             
             # Get thread info before deleting the post
+            thread = post.thread
             thread_id = post.thread_id
-            board_slug = post.thread.board.slug
+            board_slug = thread.board.slug
             
-            # Delete the post
+            # Delete the post and update the thread's counters
             db.session.delete(post)
+            refresh_thread_counters([thread_id])
+            touch_board(thread.board_id)
+            touch_thread(thread_id)
             db.session.commit()
+            file_deletion_queue.kick()
+            catalog_cache.reload_thread(thread)
+            page_cache.invalidate(board_tag(thread.board_id), thread_tag(thread_id))
             
             flash(f'Post {post_id} deleted successfully', 'success')
             return redirect(url_for('threads.view_thread', board_slug=board_slug, thread_id=thread_id))
@@ -204,6 +227,79 @@ def moderate_post(post_id):
     return render_template('admin/moderate_post.html', title='Moderate Post', form=form, post=post)
 
 
+@admin_bp.route('/images/<int:image_id>/similar')
+@login_required
+def similar_images(image_id):
+    image = Image.query.get_or_404(image_id)
+    
+    matches = []
+    bans = []
+    if image.phash is not None:
+        max_distance = current_app.config.get('IMAGE_SIMILAR_MAX_DISTANCE', 10)
+        matches = image_index.find(image.phash, max_distance, exclude=image.id)
+        bans = banned_index.find(image.phash, max_distance)
+    
+    return render_template(
+        'admin/similar_images.html',
+        title='Similar Images',
+        image=image,
+        matches=matches,
+        bans=bans
+    )
+
+
+@admin_bp.route('/images/<int:image_id>/ban', methods=['POST'])
+@login_required
+def ban_image(image_id):
+    image = Image.query.get_or_404(image_id)
+    
+    if image.phash is None:
+        flash('This image has no perceptual hash yet and cannot be banned', 'danger')
+        return redirect(url_for('admin.similar_images', image_id=image.id))
+    
+    ban = BannedImage(
+        phash=image.phash,
+        reason=request.form.get('reason', '').strip()[:256] or None,
+        created_by=current_user.id
+    )
+    db.session.add(ban)
+    
+    # Take the banned image itself down, as screen_image does for new uploads
+    if image.status != 'rejected':
+        file_deletion_queue.release(image.file_ids())
+        image.mega_url = image.public_url = ''
+        image.thumbnails = None
+        image.status = 'rejected'
+    thread = image.post.thread
+    touch_board(thread.board_id)
+    touch_thread(thread.id)
+    db.session.commit()
+    file_deletion_queue.kick()
+    catalog_cache.reload_thread(thread)
+    page_cache.invalidate(board_tag(thread.board_id), thread_tag(thread.id))
+    
+    flash(f'Image {image.id} banned and removed; matching uploads will be rejected', 'success')
+    return redirect(url_for('admin.similar_images', image_id=image.id))
+
+
+@admin_bp.route('/bans')
+@login_required
+def bans():
+    all_bans = BannedImage.query.order_by(BannedImage.created_at.desc()).all()
+    return render_template('admin/bans.html', title='Banned Images', bans=all_bans)
+
+
+@admin_bp.route('/bans/delete/<int:ban_id>', methods=['POST'])
+@login_required
+def delete_ban(ban_id):
+    ban = BannedImage.query.get_or_404(ban_id)
+    db.session.delete(ban)
+    db.session.commit()
+    
+    flash(f'Ban {ban_id} removed', 'success')
+    return redirect(url_for('admin.bans'))
+
+
 @admin_bp.route('/users')
 @login_required
 def users():
@@ -0,0 +1,386 @@
+import gzip
+import json
+import base64
+import logging
+from datetime import datetime
+from flask import Blueprint, request, jsonify, render_template, current_app, make_response, get_template_attribute
+from models import Board, Thread, Post, Image
+from threads import attach_images
+from boards import SORT_KEYS, decode_cursor, paginate_by_cursor, load_thread_previews
+from catalog import catalog_cache
+from page_cache import page_cache, board_tag, thread_tag, INDEX_TAG
+from conditional import make_validators, is_not_modified, not_modified, add_validators
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+api_bp = Blueprint('api', __name__)
+
+# Most posts returned by one incremental request
+MAX_POSTS_PER_REQUEST = 200
+
+# Threads per page of the v1 board listing, same as the HTML board page
+THREADS_PER_PAGE = 15
+
+
+def serialize_post(post, images):
+    return {
+        'id': post.id,
+        'content': post.content,
+        'poster_name': post.poster_name,
+        'created_at': post.created_at.isoformat(),
+        'upvotes': post.upvotes,
+        'images': [serialize_image(image) for image in images],
+    }
+
+
+def serialize_image(image):
+    data = {
+        'id': image.id,
+        'filename': image.filename,
+        'public_url': image.public_url,
+        'width': image.width,
+        'height': image.height,
+        'size_bytes': image.size_bytes,
+        'status': image.status,
+        'thumbnails': {},
+    }
+    for size, thumbnail in (image.thumbnails or {}).items():
+        data['thumbnails'][size] = {
+            'width': thumbnail['width'],
+            'height': thumbnail['height'],
+            'webp_url': thumbnail['webp']['url'],
+            'url': thumbnail['fallback']['url'],
+        }
+    return data
+
+
+def serialize_board(board):
+    return {
+        'id': board.id,
+        'slug': board.slug,
+        'name': board.name,
+        'description': board.description,
+        'category': board.category,
+        'nsfw': bool(board.nsfw),
+    }
+
+
+def serialize_thread(thread):
+    return {
+        'id': thread.id,
+        'subject': thread.subject,
+        'sticky': bool(thread.sticky),
+        'locked': bool(thread.locked),
+        'upvotes': thread.upvotes or 0,
+        'views': thread.views or 0,
+        'reply_count': thread.reply_count or 0,
+        'image_count': thread.image_count or 0,
+        'created_at': thread.created_at.isoformat(),
+        'bumped_at': thread.updated_at.isoformat(),
+    }
+
+
+def serialize_tile(tile):
+    """Catalog tiles are already plain dicts, apart from their datetimes"""
+    return {
+        key: value.isoformat() if isinstance(value, datetime) else value
+        for key, value in tile.items()
+    }
+
+
+def dumps(data):
+    """Serialize to compact JSON bytes, with orjson when it is installed"""
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, separators=(',', ':'), ensure_ascii=False).encode()
+
+
+def requested_fields():
+    """Item fields picked with ?fields=a,b,c, or None for all of them"""
+    fields = request.args.get('fields')
+    if not fields:
+        return None
+    return {'id'} | {field.strip() for field in fields.split(',') if field.strip()}
+
+
+def select_fields(items, fields):
+    if fields is None:
+        return items
+    return [{key: value for key, value in item.items() if key in fields} for item in items]
+
+
+def cache_key(*parts):
+    """Cache key for a v1 response; the field selection changes the body"""
+    return ':'.join(['api', 'v1', *[str(part) for part in parts], request.args.get('fields', '')])
+
+
+def cached_response(key):
+    """
+    Answer from a cached v1 body, or None on a miss
+
+    Cached entries hold the serialized body, its compressed copies and
+    its validators, so hits and 304s cost no queries and no compression.
+    """
+    entry = page_cache.load(key)
+    if entry is None:
+        return None
+
+    entry = json.loads(entry)
+    validators = (entry['etag'], datetime.fromisoformat(entry['last_modified']))
+    if is_not_modified(validators):
+        return finish(make_response('', 304), validators)
+    encoded = {encoding: base64.b64decode(data) for encoding, data in entry.get('encoded', {}).items()}
+    return finish(make_response(entry['body'].encode()), validators, encoded)
+
+
+def build_response(key, tags, data, validators):
+    """Serialize a v1 payload, cache it under key and return it"""
+    body = dumps(data)
+    if page_cache.backend is None:
+        return finish(make_response(body), validators)
+
+    encoded = compress_body(body)
+    page_cache.store(key, tags, json.dumps({
+        'body': body.decode(),
+        'encoded': {encoding: base64.b64encode(data).decode() for encoding, data in encoded.items()},
+        'etag': validators[0],
+        'last_modified': validators[1].isoformat(),
+    }))
+    return finish(make_response(body), validators, encoded)
+
+
+def compress_body(body, encodings=None):
+    """
+    Compress a body for each content coding we serve
+
+    Returns:
+        dict: Compressed bodies by encoding, empty for bodies too small to bother
+    """
+    if len(body) < current_app.config.get('API_COMPRESS_MIN_BYTES', 1024):
+        return {}
+    if encodings is None:
+        encodings = ['br', 'gzip'] if brotli is not None else ['gzip']
+
+    encoded = {}
+    for encoding in encodings:
+        if encoding == 'br':
+            encoded[encoding] = brotli.compress(body, quality=4)
+        elif encoding == 'gzip':
+            encoded[encoding] = gzip.compress(body, compresslevel=6)
+    return encoded
+
+
+def finish(response, validators=None, encoded=None):
+    """
+    Set public caching headers and compress the body if the client accepts it
+
+    Args:
+        encoded: Compressed copies of the body from compress_body; when
+            None only the encoding the client picks is made here
+    """
+    if validators is not None:
+        # Weak, so the same validator holds for the compressed and plain bodies
+        response.set_etag(validators[0], weak=True)
+        response.last_modified = validators[1]
+    response.headers['Cache-Control'] = f"public, max-age={current_app.config.get('API_CACHE_MAX_AGE_SECONDS', 10)}"
+    response.vary.add('Accept-Encoding')
+    if response.status_code != 200:
+        return response
+
+    response.mimetype = 'application/json'
+    if encoded is None:
+        encodings = ['br', 'gzip'] if brotli is not None else ['gzip']
+    else:
+        encodings = [encoding for encoding in ('br', 'gzip') if encoding in encoded]
+    encoding = request.accept_encodings.best_match(encodings)
+    if encoding is None:
+        return response
+
+    if encoded is None:
+        encoded = compress_body(response.get_data(), [encoding])
+        if not encoded:
+            return response
+    response.set_data(encoded[encoding])
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+@api_bp.route('/<board_slug>/thread/<int:thread_id>/posts')
+@api_bp.route('/v1/<board_slug>/thread/<int:thread_id>/posts')
+def thread_posts(board_slug, thread_id):
+    """Posts of a thread newer than ?after=<post_id>, oldest first"""
+    board = Board.query.filter_by(slug=board_slug).first_or_404()
+    thread = Thread.query.filter_by(id=thread_id, board_id=board.id).first_or_404()
+
+    after = request.args.get('after', 0, type=int)
+    with_html = request.args.get('html', type=int) == 1
+
+    # Nothing new since the client's last poll: answer before touching posts
+    validators = make_validators(thread.last_modified_at or thread.updated_at, 'posts', after, with_html)
+    if is_not_modified(validators):
+        return not_modified(validators)
+
+    posts = Post.query.filter(
+        Post.thread_id == thread.id,
+        Post.id > after
+    ).order_by(Post.id).limit(MAX_POSTS_PER_REQUEST + 1).all()
+
+    has_more = len(posts) > MAX_POSTS_PER_REQUEST
+    posts = posts[:MAX_POSTS_PER_REQUEST]
+
+    items = []
+    for i, item in enumerate(attach_images(posts)):
+        data = serialize_post(item['post'], item['images'])
+        if with_html:
+            is_op = after == 0 and i == 0
+            data['html'] = render_template('post.html', board=board, thread=thread, is_op=is_op, **item)
+        items.append(data)
+
+    response = jsonify({
+        'thread_id': thread.id,
+        'locked': bool(thread.locked),
+        'posts': items,
+        'last_id': items[-1]['id'] if items else after,
+        'has_more': has_more,
+    })
+    return add_validators(response, validators)
+
+
+@api_bp.route('/v1/boards')
+def list_boards():
+    key = cache_key('boards')
+    cached = cached_response(key)
+    if cached is not None:
+        return cached
+
+    boards = Board.query.order_by(Board.category, Board.name).all()
+    last_modified = max((board.last_modified_at or board.created_at for board in boards), default=datetime(1970, 1, 1))
+    validators = make_validators(last_modified, 'boards', len(boards), request.args.get('fields'), per_viewer=False)
+    if is_not_modified(validators):
+        return finish(make_response('', 304), validators)
+
+    data = {'boards': select_fields([serialize_board(board) for board in boards], requested_fields())}
+    return build_response(key, [INDEX_TAG], data, validators)
+
+
+@api_bp.route('/v1/<board_slug>/')
+def board_page(board_slug):
+    """One page of a board's threads with their OPs, paged by ?cursor= like the HTML board"""
+    sort = request.args.get('sort', 'bump')
+    if sort not in SORT_KEYS:
+        sort = 'bump'
+    cursor_token = request.args.get('cursor', '')
+
+    key = cache_key('board', board_slug, sort, cursor_token)
+    cached = cached_response(key)
+    if cached is not None:
+        return cached
+
+    board = Board.query.filter_by(slug=board_slug).first_or_404()
+    validators = make_validators(
+        board.last_modified_at or board.created_at, 'board', sort, cursor_token, request.args.get('fields'),
+        per_viewer=False
+    )
+    if is_not_modified(validators):
+        return finish(make_response('', 304), validators)
+
+    threads, prev_cursor, next_cursor = paginate_by_cursor(
+        Thread.query.filter_by(board_id=board.id), sort, decode_cursor(cursor_token, sort), THREADS_PER_PAGE
+    )
+
+    items = []
+    for item in load_thread_previews(threads):
+        data = serialize_thread(item['thread'])
+        first_post = item['first_post']
+        data['op'] = serialize_post(first_post, [item['first_image']] if item['first_image'] else []) if first_post else None
+        items.append(data)
+
+    data = {
+        'board': serialize_board(board),
+        'sort': sort,
+        'threads': select_fields(items, requested_fields()),
+        'prev_cursor': prev_cursor,
+        'next_cursor': next_cursor,
+    }
+    return build_response(key, [board_tag(board.id)], data, validators)
+
+
+@api_bp.route('/v1/<board_slug>/catalog')
+def board_catalog(board_slug):
+    key = cache_key('catalog', board_slug)
+    cached = cached_response(key)
+    if cached is not None:
+        return cached
+
+    board = Board.query.filter_by(slug=board_slug).first_or_404()
+    validators = make_validators(
+        board.last_modified_at or board.created_at, 'catalog', request.args.get('fields'), per_viewer=False
+    )
+    if is_not_modified(validators):
+        return finish(make_response('', 304), validators)
+
+    tiles = [serialize_tile(tile) for tile in catalog_cache.get_tiles(board.id)]
+    data = {'board': serialize_board(board), 'threads': select_fields(tiles, requested_fields())}
+    return build_response(key, [board_tag(board.id)], data, validators)
+
+
+@api_bp.route('/v1/<board_slug>/thread/<int:thread_id>')
+def full_thread(board_slug, thread_id):
+    key = cache_key('thread', board_slug, thread_id)
+    cached = cached_response(key)
+    if cached is not None:
+        return cached
+
+    board = Board.query.filter_by(slug=board_slug).first_or_404()
+    thread = Thread.query.filter_by(id=thread_id, board_id=board.id).first_or_404()
+    validators = make_validators(
+        thread.last_modified_at or thread.updated_at, 'thread', request.args.get('fields'), per_viewer=False
+    )
+    if is_not_modified(validators):
+        return finish(make_response('', 304), validators)
+
+    posts = Post.query.filter_by(thread_id=thread.id).order_by(Post.created_at, Post.id).all()
+    items = [serialize_post(item['post'], item['images']) for item in attach_images(posts)]
+
+    data = {
+        'board': serialize_board(board),
+        'thread': serialize_thread(thread),
+        'posts': select_fields(items, requested_fields()),
+    }
+    return build_response(key, [thread_tag(thread.id)], data, validators)
+
+
+# Thumbnail macro arguments per size, matching board.html and post.html
+IMAGE_MARKUP = {
+    'preview': ('thread-image', 'Thread image'),
+    'post': ('post-image', 'Post image'),
+}
+
+
+@api_bp.route('/v1/images/<int:image_id>')
+def image_status(image_id):
+    """Processing status of an image, with its thumbnail markup once processed"""
+    image = Image.query.get_or_404(image_id)
+    size = request.args.get('size', 'post')
+    if size not in IMAGE_MARKUP:
+        size = 'post'
+
+    thumbnail = get_template_attribute('thumbnail.html', 'thumbnail')
+    response = make_response(dumps({
+        'id': image.id,
+        'status': image.status,
+        'html': str(thumbnail(image, size, *IMAGE_MARKUP[size])),
+    }))
+    response.mimetype = 'application/json'
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
@@ -6,6 +6,7 @@ from sqlalchemy.orm import DeclarativeBase
 from werkzeug.middleware.proxy_fix import ProxyFix
 from flask_login import LoginManager
 from apscheduler.schedulers.background import BackgroundScheduler
+from uploads import UploadRequest
 
 # Setup logging
 logging.basicConfig(level=logging.DEBUG)
@@ -21,6 +22,7 @@ scheduler = BackgroundScheduler()
 
 # Create the app
 app = Flask(__name__)
+app.request_class = UploadRequest  # Stream file uploads to disk while hashing them
 app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)
 
 # Load configuration
@@ -43,20 +45,72 @@ with app.app_context():
     # Create database tables
     db.create_all()
     
+    # Upgrade tables created by older versions
+    from migrations import upgrade_schema
+    upgrade_schema()
+    
+    # Setup page cache
+    from page_cache import page_cache
+    page_cache.init_app(app)
+    
+    # Setup live thread events
+    from live import thread_events
+    thread_events.init_app(app)
+    
+    # Setup captcha pool
+    from captcha_pool import captcha_pool
+    captcha_pool.init_app(app)
+    
+    # Setup file storage
+    from mega_utils import mega_handler, shard_uploads_command
+    mega_handler.init_app(app)
+    app.cli.add_command(shard_uploads_command)
+    
+    # Setup image processing
+    from image_jobs import image_processor
+    image_processor.init_app(app)
+    
+    # Setup background file deletion
+    from file_deletions import file_deletion_queue
+    file_deletion_queue.init_app(app)
+    
+    # Setup signed captcha tokens
+    from signed_captcha import signed_captcha
+    signed_captcha.init_app(app)
+    
     # Import views and register blueprints
     from auth import auth_bp
     from boards import boards_bp
     from threads import threads_bp
     from admin import admin_bp
+    from api import api_bp
+    from captcha import captcha_bp
+    from media import media_bp
     
     app.register_blueprint(auth_bp)
     app.register_blueprint(boards_bp)
     app.register_blueprint(threads_bp)
     app.register_blueprint(admin_bp, url_prefix='/admin')
+    app.register_blueprint(api_bp, url_prefix='/api')
+    app.register_blueprint(captcha_bp)
+    app.register_blueprint(media_bp)
+    
+    # Setup election of the process running the shared scheduled jobs
+    from scheduler_lock import scheduler_lock
+    scheduler_lock.init_app(app)
     
     # Import and start tasks
-    from tasks import start_scheduler
+    from tasks import start_scheduler, repair_thread_counters_command
     start_scheduler(scheduler)
+    app.cli.add_command(repair_thread_counters_command)
+    
+    from benchmarks import benchmark_captcha_command, benchmark_captcha_render_command, benchmark_indexes_command
+    app.cli.add_command(benchmark_captcha_command)
+    app.cli.add_command(benchmark_captcha_render_command)
+    app.cli.add_command(benchmark_indexes_command)
+    
+    from image_hashes import backfill_image_hashes_command
+    app.cli.add_command(backfill_image_hashes_command)
     
     # Create default boards if they don't exist
     from boards import create_default_boards
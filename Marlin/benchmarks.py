@@ -0,0 +1,337 @@
+import os
+import time
+import uuid
+import random
+import base64
+import tempfile
+import statistics
+import click
+from io import BytesIO
+from PIL import Image, ImageDraw, ImageFont, ImageFilter
+from datetime import datetime
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import create_engine, inspect, insert, text
+from app import db
+from models import User, Board, Thread, Post, Image, Vote, CaptchaToken
+from captcha import render_captchas, generate_captcha_text, draw_captcha, encode_captcha, CAPTCHA_FORMATS
+from captcha_pool import captcha_pool
+
+
+def percentile(samples, fraction):
+    """Nearest-rank percentile of a list of samples"""
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(fraction * len(ordered)) - 1))
+    return ordered[index]
+
+
+def time_requests(client, path, count, before_each=None, after_each=None):
+    """
+    Time count GET requests, in milliseconds
+
+    Args:
+        before_each: Called untimed before every request, e.g. to refill a pool
+        after_each: Called untimed with every response
+    """
+    samples = []
+    for _ in range(count):
+        if before_each is not None:
+            before_each()
+        start = time.perf_counter()
+        response = client.get(path)
+        samples.append((time.perf_counter() - start) * 1000)
+        if response.status_code != 200:
+            raise click.ClickException(f"{path} answered {response.status_code}")
+        if after_each is not None:
+            after_each(response)
+    return samples
+
+
+def report(label, samples):
+    click.echo(
+        f"{label:<10} n={len(samples)}  p50={percentile(samples, 0.5):7.2f} ms  "
+        f"p99={percentile(samples, 0.99):7.2f} ms  max={max(samples):7.2f} ms"
+    )
+
+
+@click.command('benchmark-captcha')
+@click.option('--requests', 'count', default=500, help='Requests per mode.')
+@with_appcontext
+def benchmark_captcha_command(count):
+    """Compare /captcha/generate latency when rendering inline and when serving from the pool."""
+    client = current_app.test_client()
+
+    # Tokens this run rendered or handed out, so real visitors' tokens are left alone
+    tokens = set()
+
+    def collect(response):
+        tokens.add(response.get_json()['token'])
+
+    def clear_pool():
+        # Nobody else can be served a dropped captcha any more
+        tokens.update(captcha['token'] for captcha in captcha_pool.clear())
+
+    # Inline: the pool is empty, so every request renders and commits
+    clear_pool()
+    inline = time_requests(client, '/captcha/generate', count, before_each=clear_pool, after_each=collect)
+
+    # Pooled: refill outside the timed section, the way the background task does
+    def refill():
+        if not len(captcha_pool):
+            captchas = render_captchas(captcha_pool.high_watermark)
+            tokens.update(captcha['token'] for captcha in captchas)
+            captcha_pool.extend(captchas)
+
+    pooled = time_requests(client, '/captcha/generate', count, before_each=refill, after_each=collect)
+
+    report('inline', inline)
+    report('pool', pooled)
+
+    # Drop the tokens this run created
+    clear_pool()
+    tokens = list(tokens)
+    for start in range(0, len(tokens), 500):
+        CaptchaToken.query.filter(CaptchaToken.token.in_(tokens[start:start + 500])).delete(synchronize_session=False)
+    db.session.commit()
+
+
+def legacy_captcha_image(text):
+    """The original per-pixel captcha renderer, the baseline for benchmark-captcha-render"""
+    # Create a blank image with a random background color
+    width, height = 180, 60
+    bg_color = (random.randint(230, 255), random.randint(230, 255), random.randint(230, 255))
+    text_color = (random.randint(0, 100), random.randint(0, 100), random.randint(0, 100))
+    
+    image = Image.new('RGB', (width, height), color=bg_color)
+    draw = ImageDraw.Draw(image)
+    
+    # Add noise (dots)
+    for _ in range(width * height // 20):
+        x = random.randint(0, width - 1)
+        y = random.randint(0, height - 1)
+        color = (random.randint(0, 200), random.randint(0, 200), random.randint(0, 200))
+        draw.point((x, y), fill=color)
+    
+    # Add text with random position jitters
+    font_size = random.randint(26, 32)
+    try:
+        font = ImageFont.truetype("arial.ttf", font_size)
+    except IOError:
+        # Fallback to default font
+        font = ImageFont.load_default()
+    
+    # Draw each character with slight random rotation and position
+    x_offset = 15
+    for char in text:
+        angle = random.randint(-15, 15)
+        char_image = Image.new('RGBA', (30, 30), color=(0, 0, 0, 0))
+        char_draw = ImageDraw.Draw(char_image)
+        char_draw.text((5, 5), char, font=font, fill=text_color)
+        
+        # Rotate the character
+        rotated_char = char_image.rotate(angle, resample=Image.BICUBIC, expand=0)
+        
+        # Paste onto main image
+        y_pos = random.randint(10, height - 30)
+        image.paste(rotated_char, (x_offset, y_pos), rotated_char)
+        x_offset += random.randint(18, 25)
+    
+    # Add lines across the image
+    for _ in range(random.randint(2, 4)):
+        start_x = random.randint(0, width // 4)
+        start_y = random.randint(0, height)
+        end_x = random.randint(width // 4 * 3, width)
+        end_y = random.randint(0, height)
+        line_color = (random.randint(0, 150), random.randint(0, 150), random.randint(0, 150))
+        draw.line([(start_x, start_y), (end_x, end_y)], fill=line_color, width=random.randint(1, 2))
+    
+    # Apply slight blur
+    image = image.filter(ImageFilter.BLUR)
+    
+    # Convert to base64 string
+    buffered = BytesIO()
+    image.save(buffered, format="PNG")
+    img_str = base64.b64encode(buffered.getvalue()).decode()
+    
+    return img_str
+
+
+@click.command('benchmark-captcha-render')
+@click.option('--count', default=300, help='Captchas rendered per renderer.')
+def benchmark_captcha_render_command(count):
+    """Compare single-core captcha rendering throughput and payload size."""
+    texts = [generate_captcha_text() for _ in range(count)]
+    renderers = [('legacy', legacy_captcha_image)]
+    for image_format in CAPTCHA_FORMATS:
+        renderers.append((image_format, lambda text, f=image_format: encode_captcha(draw_captcha(text), f)[0]))
+
+    # Warm the font and glyph caches, as a long-running worker would have
+    for text in texts[:20]:
+        draw_captcha(text)
+
+    for label, render in renderers:
+        start = time.process_time()
+        sizes = [len(render(text)) for text in texts]
+        elapsed = time.process_time() - start
+        click.echo(f"{label:<8} {count / elapsed:8.1f} captchas/sec/core  avg {sum(sizes) // len(sizes):6d} bytes base64")
+
+
+# Tables benchmark-indexes seeds, in foreign key order
+INDEX_BENCHMARK_MODELS = [User, Board, Thread, Post, Image, Vote, CaptchaToken]
+
+# The hot query shapes the model indexes are declared for
+INDEX_BENCHMARK_QUERIES = [
+    ('thread posts', "SELECT * FROM posts WHERE thread_id = :thread_id ORDER BY created_at"),
+    ('posts since', "SELECT * FROM posts WHERE thread_id = :thread_id AND id > :since ORDER BY id"),
+    ('post images', "SELECT * FROM images WHERE post_id = :post_id"),
+    ('board bump', "SELECT * FROM threads WHERE board_id = :board_id ORDER BY sticky DESC, updated_at DESC LIMIT 15"),
+    ('popular', "SELECT * FROM threads ORDER BY upvotes DESC LIMIT 10"),
+    ('thread vote', "SELECT * FROM votes WHERE user_id = :user_id AND thread_id = :thread_id"),
+    ('post vote', "SELECT * FROM votes WHERE user_id = :user_id AND post_id = :post_id"),
+    ('captcha', "SELECT * FROM captcha_tokens WHERE token = :token AND used = :used"),
+]
+
+
+def insert_in_chunks(connection, table, rows, chunk_size=10000):
+    """Insert rows from a generator with one executemany per chunk"""
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == chunk_size:
+            connection.execute(insert(table), chunk)
+            chunk = []
+    if chunk:
+        connection.execute(insert(table), chunk)
+
+
+def seed_index_benchmark(engine, post_count):
+    """
+    Fill the benchmark tables with random rows
+
+    Returns:
+        dict: Parameters for INDEX_BENCHMARK_QUERIES that match seeded rows
+    """
+    rng = random.Random(1)
+    now = datetime.utcnow()
+    board_count, user_count = 70, 1000
+    thread_count = max(1, post_count // 50)
+    token_count = vote_count = max(1, post_count // 10)
+    token = None
+
+    def tokens():
+        nonlocal token
+        for n in range(token_count):
+            token = uuid.UUID(int=rng.getrandbits(128)).hex
+            yield {'token': token, 'solution': 'ABC123', 'created_at': now, 'used': n % 2 == 0}
+
+    with engine.begin() as connection:
+        insert_in_chunks(connection, User.__table__, (
+            {'id': n, 'username': f'user{n}', 'email': f'user{n}@example.com', 'password_hash': '-'}
+            for n in range(1, user_count + 1)
+        ))
+        insert_in_chunks(connection, Board.__table__, (
+            {'id': n, 'name': f'Board {n}', 'slug': f'b{n}', 'category': 'Benchmark', 'created_at': now}
+            for n in range(1, board_count + 1)
+        ))
+        insert_in_chunks(connection, Thread.__table__, (
+            {
+                'id': n, 'subject': f'Thread {n}', 'board_id': rng.randint(1, board_count),
+                'created_at': now, 'updated_at': now.replace(microsecond=rng.randint(0, 999999)),
+                'upvotes': rng.randint(0, 500), 'views': 0, 'sticky': n % 1000 == 0, 'locked': False
+            }
+            for n in range(1, thread_count + 1)
+        ))
+        insert_in_chunks(connection, Post.__table__, (
+            {'id': n, 'content': 'Benchmark post', 'thread_id': rng.randint(1, thread_count), 'created_at': now, 'upvotes': 0}
+            for n in range(1, post_count + 1)
+        ))
+        insert_in_chunks(connection, Image.__table__, (
+            {'id': n, 'filename': 'image.png', 'mega_url': f'{n}.png', 'public_url': f'/media/{n}.png', 'post_id': n * 3}
+            for n in range(1, post_count // 3 + 1)
+        ))
+        insert_in_chunks(connection, Vote.__table__, (
+            {
+                'id': n, 'user_id': rng.randint(1, user_count), 'created_at': now,
+                'thread_id': rng.randint(1, thread_count) if n % 2 else None,
+                'post_id': None if n % 2 else rng.randint(1, post_count)
+            }
+            for n in range(1, vote_count + 1)
+        ))
+        insert_in_chunks(connection, CaptchaToken.__table__, tokens())
+
+    return {
+        'thread_id': thread_count // 2, 'since': post_count // 2, 'post_id': 3, 'board_id': 5,
+        'user_id': 7, 'token': token, 'used': False
+    }
+
+
+def explain(connection, sql, params):
+    """Query plan lines for a statement"""
+    if connection.dialect.name == 'sqlite':
+        return [row[-1] for row in connection.execute(text(f'EXPLAIN QUERY PLAN {sql}'), params)]
+    return [row[0] for row in connection.execute(text(f'EXPLAIN {sql}'), params)]
+
+
+def report_query_plans(engine, label, params, repeat):
+    click.echo(f"--- {label}")
+    with engine.connect() as connection:
+        for name, sql in INDEX_BENCHMARK_QUERIES:
+            samples = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                connection.execute(text(sql), params).all()
+                samples.append((time.perf_counter() - start) * 1000)
+            click.echo(f"{name:<13} median {statistics.median(samples):9.3f} ms")
+            for line in explain(connection, sql, params):
+                click.echo(f"    {line}")
+
+
+@click.command('benchmark-indexes')
+@click.option('--posts', 'post_count', default=1000000, help='Posts to seed; threads, images, votes and tokens scale with it.')
+@click.option('--database-url', default=None, help='Empty scratch database to seed; its tables are dropped afterwards. Defaults to a temporary SQLite file.')
+@click.option('--repeat', default=20, help='Runs per query.')
+@with_appcontext
+def benchmark_indexes_command(post_count, database_url, repeat):
+    """Show plans and timings of the hot queries without and with the model indexes."""
+    path = None
+    if database_url is None:
+        fd, path = tempfile.mkstemp(suffix='.db', prefix='marlin-benchmark-')
+        os.close(fd)
+        database_url = f'sqlite:///{path}'
+
+    engine = create_engine(database_url)
+    tables = [model.__table__ for model in INDEX_BENCHMARK_MODELS]
+    indexes = [index for table in tables for index in table.indexes]
+
+    # The tables are dropped at the end, so never touch a database that already has them
+    existing = [table.name for table in tables if inspect(engine).has_table(table.name)]
+    if existing:
+        engine.dispose()
+        raise click.ClickException(f"{database_url} already has tables ({', '.join(existing)}); use an empty scratch database")
+
+    try:
+        db.metadata.create_all(engine, tables=tables)
+        for index in indexes:
+            index.drop(engine)
+
+        click.echo(f"Seeding {post_count} posts...")
+        start = time.perf_counter()
+        params = seed_index_benchmark(engine, post_count)
+        click.echo(f"Seeded in {time.perf_counter() - start:.1f} s")
+
+        with engine.begin() as connection:
+            connection.execute(text('ANALYZE'))
+        report_query_plans(engine, 'without indexes', params, repeat)
+
+        start = time.perf_counter()
+        for index in indexes:
+            index.create(engine)
+        with engine.begin() as connection:
+            connection.execute(text('ANALYZE'))
+        click.echo(f"Created {len(indexes)} indexes in {time.perf_counter() - start:.1f} s")
+        report_query_plans(engine, 'with indexes', params, repeat)
+    finally:
+        db.metadata.drop_all(engine, tables=tables)
+        engine.dispose()
+        if path:
+            os.remove(path)
@@ -1,7 +1,15 @@
+import base64
+import binascii
+import json
 import logging
-from flask import Blueprint, render_template, redirect, url_for, request, current_app
+from datetime import datetime
+from flask import Blueprint, render_template, redirect, url_for, request, current_app, make_response
+from sqlalchemy import func, tuple_
 from app import db
 from models import Board, Thread, Post, Image
+from catalog import catalog_cache
+from page_cache import page_cache, board_tag, INDEX_TAG
+from conditional import make_validators, is_not_modified, not_modified, add_validators
 
 logger = logging.getLogger(__name__)
 
@@ -113,8 +121,155 @@ def create_default_boards():
     logger.info("Default boards created successfully")
 
 
+# Columns each board sort order is keyed on, most significant first.
+# All of them are sorted descending, and the id makes every key unique.
+SORT_KEYS = {
+    'bump': (Thread.sticky, Thread.updated_at, Thread.id),
+    'new': (Thread.created_at, Thread.id),
+    'hot': (Thread.upvotes, Thread.id),
+}
+
+
+def encode_cursor(thread, sort, direction):
+    """
+    Build an opaque page token pointing just past a thread.
+    
+    Args:
+        thread: Thread on the edge of the current page
+        sort: Sort order the token belongs to
+        direction: 'next' to continue after the thread, 'prev' to go before it
+        
+    Returns:
+        str: URL-safe token
+    """
+    values = []
+    for column in SORT_KEYS[sort]:
+        value = getattr(thread, column.key)
+        values.append(value.isoformat() if isinstance(value, datetime) else value)
+    
+    payload = json.dumps([direction, values], separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+
+def decode_cursor(token, sort):
+    """
+    Parse a page token produced by encode_cursor.
+    
+    Returns:
+        tuple: (direction, values), or None for a missing or invalid token
+    """
+    if not token:
+        return None
+    
+    try:
+        payload = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        direction, values = json.loads(payload)
+        columns = SORT_KEYS[sort]
+        if direction not in ('next', 'prev') or len(values) != len(columns):
+            return None
+        
+        for i, column in enumerate(columns):
+            if isinstance(column.type, db.DateTime):
+                values[i] = datetime.fromisoformat(values[i])
+            elif isinstance(column.type, db.Boolean):
+                values[i] = bool(values[i])
+            else:
+                values[i] = int(values[i])
+        return direction, values
+    except (ValueError, TypeError, binascii.Error):
+        return None
+
+
+def paginate_by_cursor(query, sort, cursor, per_page):
+    """
+    Fetch one page of threads by seeking past the cursor on the sort key.
+    
+    Returns:
+        tuple: (threads, prev_cursor, next_cursor)
+    """
+    columns = SORT_KEYS[sort]
+    direction, values = cursor or ('next', None)
+    
+    if direction == 'next':
+        if values is not None:
+            query = query.filter(tuple_(*columns) < tuple(values))
+        query = query.order_by(*[column.desc() for column in columns])
+    else:
+        query = query.filter(tuple_(*columns) > tuple(values))
+        query = query.order_by(*[column.asc() for column in columns])
+    
+    # Fetch one extra row to find out whether there is another page
+    threads = query.limit(per_page + 1).all()
+    has_more = len(threads) > per_page
+    threads = threads[:per_page]
+    
+    if direction == 'next':
+        has_prev, has_next = values is not None, has_more
+    else:
+        threads.reverse()
+        has_prev, has_next = has_more, True
+    
+    prev_cursor = encode_cursor(threads[0], sort, 'prev') if threads and has_prev else None
+    next_cursor = encode_cursor(threads[-1], sort, 'next') if threads and has_next else None
+    return threads, prev_cursor, next_cursor
+
+
+def load_thread_previews(threads):
+    """
+    Build the board listing data for a page of threads.
+    
+    Uses a fixed number of queries regardless of page size: one windowed
+    query for the first post of every thread, and one bulk query for the
+    images attached to those first posts. Reply counts come from the
+    denormalized Thread.reply_count column.
+    """
+    thread_ids = [thread.id for thread in threads]
+    if not thread_ids:
+        return []
+    
+    # Rank posts inside each thread so the OP is row 1
+    ranked = db.session.query(
+        Post.id.label('post_id'),
+        func.row_number().over(
+            partition_by=Post.thread_id,
+            order_by=(Post.created_at, Post.id)
+        ).label('position')
+    ).filter(Post.thread_id.in_(thread_ids)).subquery()
+    
+    first_posts = Post.query.join(
+        ranked, Post.id == ranked.c.post_id
+    ).filter(ranked.c.position == 1).all()
+    first_posts = {post.thread_id: post for post in first_posts}
+    
+    # Fetch images for all first posts, keeping the earliest one per post
+    first_images = {}
+    post_ids = [post.id for post in first_posts.values()]
+    if post_ids:
+        images = Image.query.filter(Image.post_id.in_(post_ids)).order_by(Image.post_id, Image.id).all()
+        for image in images:
+            first_images.setdefault(image.post_id, image)
+    
+    threads_data = []
+    for thread in threads:
+        first_post = first_posts.get(thread.id)
+        threads_data.append({
+            'thread': thread,
+            'first_post': first_post,
+            'first_image': first_images.get(first_post.id) if first_post else None,
+            'reply_count': thread.reply_count or 0
+        })
+    
+    return threads_data
+
+
 @boards_bp.route('/boards')
 def index():
+    cacheable = page_cache.is_cacheable()
+    if cacheable:
+        cached = page_cache.get('index')
+        if cached is not None:
+            return cached
+    
     # Get all boards grouped by category
     boards_by_category = {}
     
@@ -128,56 +283,81 @@ def index():
     # Get popular threads for display on the home page
     popular_threads = Thread.query.order_by(Thread.upvotes.desc()).limit(10).all()
     
-    return render_template(
-        'index.html', 
-        title='Marlin - Boards', 
+    context = dict(
+        title='Marlin - Boards',
         boards_by_category=boards_by_category,
         popular_threads=popular_threads
     )
+    if cacheable:
+        return page_cache.render('index', [INDEX_TAG], 'index.html', **context)
+    return render_template('index.html', **context)
 
 
 @boards_bp.route('/<board_slug>/')
 def view_board(board_slug):
+    per_page = 15  # Threads per page
+    
+    # Handle sorting; unknown values fall back to 'bump' (activity)
+    sort = request.args.get('sort', 'bump')
+    if sort not in SORT_KEYS:
+        sort = 'bump'
+    
+    page_key = request.args.get('page', type=int) if 'page' in request.args else request.args.get('cursor', '')
+    
+    cache_key = None
+    if page_cache.is_cacheable():
+        cache_key = f'board:{board_slug}:{sort}:{page_key}'
+        cached = page_cache.get(cache_key)
+        if cached is not None:
+            return cached
+    
     board = Board.query.filter_by(slug=board_slug).first_or_404()
     
-    page = request.args.get('page', 1, type=int)
-    per_page = 15  # Threads per page
+    # Answer conditional GETs before querying any threads
+    validators = make_validators(board.last_modified_at or board.created_at, sort, page_key)
+    if is_not_modified(validators):
+        return not_modified(validators)
     
-    # Get threads with first post and image preloaded
     threads_query = Thread.query.filter_by(board_id=board.id)
     
-    # Handle sorting
-    sort = request.args.get('sort', 'bump')
-    if sort == 'new':
-        threads_query = threads_query.order_by(Thread.created_at.desc())
-    elif sort == 'hot':
-        threads_query = threads_query.order_by(Thread.upvotes.desc())
-    else:  # Default 'bump' sort by activity
-        threads_query = threads_query.order_by(Thread.sticky.desc(), Thread.updated_at.desc())
+    pagination = None
+    prev_cursor = next_cursor = None
     
-    # Get paginated threads
-    threads_pagination = threads_query.paginate(page=page, per_page=per_page)
+    if 'page' in request.args:
+        # Numbered pages for existing ?page= links (OFFSET plus a total count)
+        page = request.args.get('page', 1, type=int)
+        threads_query = threads_query.order_by(*[column.desc() for column in SORT_KEYS[sort]])
+        pagination = threads_query.paginate(page=page, per_page=per_page)
+        threads = pagination.items
+    else:
+        # Keyset pagination, which never counts or skips rows
+        cursor = decode_cursor(request.args.get('cursor'), sort)
+        threads, prev_cursor, next_cursor = paginate_by_cursor(threads_query, sort, cursor, per_page)
     
-    # Get first post and image for each thread
-    threads_data = []
-    for thread in threads_pagination.items:
-        first_post = Post.query.filter_by(thread_id=thread.id).order_by(Post.created_at).first()
-        first_image = None
-        if first_post:
-            first_image = Image.query.filter_by(post_id=first_post.id).first()
-        
-        threads_data.append({
-            'thread': thread,
-            'first_post': first_post,
-            'first_image': first_image,
-            'reply_count': Post.query.filter_by(thread_id=thread.id).count() - 1  # Subtract OP
-        })
+    # Get first post, first image and reply count for the whole page at once
+    threads_data = load_thread_previews(threads)
     
-    return render_template(
-        'board.html',
+    context = dict(
         title=f'/{board.slug}/ - {board.name}',
         board=board,
         threads_data=threads_data,
-        pagination=threads_pagination,
+        pagination=pagination,
+        prev_cursor=prev_cursor,
+        next_cursor=next_cursor,
         sort=sort
     )
+    if cache_key:
+        return page_cache.render(cache_key, [board_tag(board.id)], 'board.html', validators=validators, **context)
+    return add_validators(make_response(render_template('board.html', **context)), validators)
+
+
+@boards_bp.route('/<board_slug>/catalog')
+def catalog(board_slug):
+    board = Board.query.filter_by(slug=board_slug).first_or_404()
+    
+    return render_template(
+        'catalog.html',
+        title=f'/{board.slug}/ - Catalog',
+        board=board,
+        tiles=catalog_cache.get_tiles(board.id)
+    )
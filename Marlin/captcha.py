@@ -2,113 +2,211 @@ import os
 import random
 import string
 import uuid
+import math
+import time
 import logging
+from functools import lru_cache
 from PIL import Image, ImageDraw, ImageFont, ImageFilter
 from io import BytesIO
 import base64
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, request, jsonify, current_app
 from app import db
 from models import CaptchaToken
+from captcha_pool import captcha_pool
+from signed_captcha import signed_captcha
 
 logger = logging.getLogger(__name__)
 
 captcha_bp = Blueprint('captcha', __name__)
 
+# Captcha image size
+CAPTCHA_WIDTH, CAPTCHA_HEIGHT = 180, 60
+
+# Glyph rotations are drawn from these angles so the rotated glyphs can be cached
+GLYPH_ANGLES = range(-15, 16, 3)
+
+# Lookup tables turning random bytes into a noise mask (about one pixel in 20)
+# and into noise colours of up to 200 per channel
+NOISE_MASK_LUT = [255 if v < 13 else 0 for v in range(256)]
+NOISE_COLOR_LUT = [v * 200 // 255 for v in range(256)] * 3
+
+# Encoded image formats: name -> (PIL format, MIME type)
+CAPTCHA_FORMATS = {
+    'png': ('PNG', 'image/png'),
+    'png8': ('PNG', 'image/png'),  # 32-colour palette
+    'webp': ('WEBP', 'image/webp'),
+}
+
 def generate_captcha_text(length=6):
     """Generate random captcha text"""
     return ''.join(random.choices(string.ascii_uppercase + string.digits, k=length))
 
 
-def generate_captcha_image(text):
-    """Generate captcha image with given text"""
-    # Create a blank image with a random background color
-    width, height = 180, 60
+@lru_cache(maxsize=None)
+def load_font(size):
+    """Load the captcha font once per size"""
+    try:
+        return ImageFont.truetype("arial.ttf", size)
+    except IOError:
+        pass
+    try:
+        # Fallback to the default font, which is scalable from Pillow 10.1
+        return ImageFont.load_default(size)
+    except TypeError:
+        # Older Pillow (render_requirements.txt pins 10.0) only has the fixed-size bitmap font
+        return ImageFont.load_default()
+
+
+@lru_cache(maxsize=None)
+def glyph_mask(char, size, angle):
+    """Rotated alpha mask of one character, rendered once and reused"""
+    mask = Image.new('L', (size + 10, size + 10), 0)
+    ImageDraw.Draw(mask).text((5, 0), char, font=load_font(size), fill=255)
+    return mask.rotate(angle, resample=Image.BICUBIC)
+
+
+def random_layer(mode, size):
+    """Image of uniformly random bytes, built in one call instead of per pixel"""
+    bands = len(mode)
+    return Image.frombytes(mode, size, random.randbytes(size[0] * size[1] * bands))
+
+
+def wave_mesh(width, height, amplitude, period, phase, step=15):
+    """Mesh for Image.transform that shifts vertical strips along a sine wave"""
+    mesh = []
+    for x0 in range(0, width, step):
+        x1 = min(x0 + step, width)
+        dy0 = amplitude * math.sin(phase + 2 * math.pi * x0 / period)
+        dy1 = amplitude * math.sin(phase + 2 * math.pi * x1 / period)
+        mesh.append((
+            (x0, 0, x1, height),
+            (x0, dy0, x0, height + dy0, x1, height + dy1, x1, dy1)
+        ))
+    return mesh
+
+
+def draw_captcha(text):
+    """
+    Draw a captcha image with given text.
+
+    Noise, text placement and distortion are done as whole-image
+    operations: the noise is one random layer composited through a
+    random mask, the characters are pasted from cached rotated glyph
+    masks, and the text layer is warped with a single mesh transform.
+    """
+    size = (CAPTCHA_WIDTH, CAPTCHA_HEIGHT)
     bg_color = (random.randint(230, 255), random.randint(230, 255), random.randint(230, 255))
     text_color = (random.randint(0, 100), random.randint(0, 100), random.randint(0, 100))
     
-    image = Image.new('RGB', (width, height), color=bg_color)
-    draw = ImageDraw.Draw(image)
+    image = Image.new('RGB', size, color=bg_color)
     
-    # Add noise (dots)
-    for _ in range(width * height // 20):
-        x = random.randint(0, width - 1)
-        y = random.randint(0, height - 1)
-        color = (random.randint(0, 200), random.randint(0, 200), random.randint(0, 200))
-        draw.point((x, y), fill=color)
+    # Noise layer
+    noise_mask = random_layer('L', size).point(NOISE_MASK_LUT)
+    noise = random_layer('RGB', size).point(NOISE_COLOR_LUT)
+    image.paste(noise, mask=noise_mask)
     
-    # Add text with random position jitters
+    # Text: paste cached glyphs into one mask, then warp the whole mask at once
     font_size = random.randint(26, 32)
-    # Use a default font since we can't include a custom font file
-    try:
-        font = ImageFont.truetype("arial.ttf", font_size)
-    except IOError:
-        # Fallback to default font
-        font = ImageFont.load_default()
-    
-    # Calculate text size to center it
-    text_width = width // 2
-    text_height = height // 2
-    
-    # Draw each character with slight random rotation and position
+    text_layer = Image.new('L', size, 0)
     x_offset = 15
     for char in text:
-        angle = random.randint(-15, 15)
-        char_image = Image.new('RGBA', (30, 30), color=(0, 0, 0, 0))
-        char_draw = ImageDraw.Draw(char_image)
-        char_draw.text((5, 5), char, font=font, fill=text_color)
-        
-        # Rotate the character
-        rotated_char = char_image.rotate(angle, resample=Image.BICUBIC, expand=0)
-        
-        # Paste onto main image
-        y_pos = random.randint(10, height - 30)
-        image.paste(rotated_char, (x_offset, y_pos), rotated_char)
+        glyph = glyph_mask(char, font_size, random.choice(GLYPH_ANGLES))
+        y_pos = random.randint(0, CAPTCHA_HEIGHT - glyph.height)
+        text_layer.paste(glyph, (x_offset, y_pos), glyph)
         x_offset += random.randint(18, 25)
     
+    mesh = wave_mesh(
+        CAPTCHA_WIDTH, CAPTCHA_HEIGHT,
+        amplitude=random.uniform(2, 4),
+        period=random.randint(60, 120),
+        phase=random.uniform(0, 2 * math.pi)
+    )
+    text_layer = text_layer.transform(size, Image.MESH, mesh, resample=Image.BILINEAR)
+    image.paste(text_color, mask=text_layer)
+    
     # Add lines across the image
+    draw = ImageDraw.Draw(image)
     for _ in range(random.randint(2, 4)):
-        start_x = random.randint(0, width // 4)
-        start_y = random.randint(0, height)
-        end_x = random.randint(width // 4 * 3, width)
-        end_y = random.randint(0, height)
+        start_x = random.randint(0, CAPTCHA_WIDTH // 4)
+        start_y = random.randint(0, CAPTCHA_HEIGHT)
+        end_x = random.randint(CAPTCHA_WIDTH // 4 * 3, CAPTCHA_WIDTH)
+        end_y = random.randint(0, CAPTCHA_HEIGHT)
         line_color = (random.randint(0, 150), random.randint(0, 150), random.randint(0, 150))
         draw.line([(start_x, start_y), (end_x, end_y)], fill=line_color, width=random.randint(1, 2))
     
     # Apply slight blur
-    image = image.filter(ImageFilter.BLUR)
+    return image.filter(ImageFilter.BLUR)
+
+
+def encode_captcha(image, image_format='png'):
+    """
+    Encode a captcha image for embedding in a data URL
+    
+    Args:
+        image: Image from draw_captcha
+        image_format: Key of CAPTCHA_FORMATS
+        
+    Returns:
+        tuple: (base64 string, MIME type)
+    """
+    pil_format, mime = CAPTCHA_FORMATS[image_format]
+    if image_format == 'png8':
+        image = image.quantize(colors=32, method=Image.Quantize.FASTOCTREE)
     
-    # Convert to base64 string
     buffered = BytesIO()
-    image.save(buffered, format="PNG")
-    img_str = base64.b64encode(buffered.getvalue()).decode()
+    if pil_format == 'WEBP':
+        image.save(buffered, format=pil_format, quality=60, method=4)
+    else:
+        image.save(buffered, format=pil_format)
+    return base64.b64encode(buffered.getvalue()).decode(), mime
+
+
+def is_signed_mode():
+    return current_app.config.get('CAPTCHA_TOKEN_MODE', 'database') == 'signed'
+
+
+def render_captchas(count):
+    """
+    Render captchas and issue their tokens
+    
+    In database mode the tokens are stored with a single commit; signed
+    tokens need no storage.
+    
+    Returns:
+        list: {'token', 'image', 'mime', 'expires_at'} dicts
+    """
+    image_format = current_app.config.get('CAPTCHA_IMAGE_FORMAT', 'png8')
+    signed = is_signed_mode()
+    
+    # Database tokens last until purge_captcha_tokens deletes them
+    expires_at = time.time() + current_app.config.get('CAPTCHA_TOKEN_MAX_AGE_HOURS', 24) * 3600
+    
+    captchas = []
+    for _ in range(count):
+        captcha_text = generate_captcha_text()
+        image, mime = encode_captcha(draw_captcha(captcha_text), image_format)
+        captcha = {'image': image, 'mime': mime}
+        if signed:
+            captcha['token'], captcha['expires_at'] = signed_captcha.issue(captcha_text)
+        else:
+            captcha['token'], captcha['solution'], captcha['expires_at'] = uuid.uuid4().hex, captcha_text, expires_at
+        captchas.append(captcha)
+    
+    if signed:
+        return captchas
+    
+    db.session.add_all([
+        CaptchaToken(token=captcha['token'], solution=captcha.pop('solution'), used=False)
+        for captcha in captchas
+    ])
+    db.session.commit()
     
-    return img_str
+    return captchas
 
 
 def create_captcha():
     """Create a new captcha and store in database"""
-    # Generate random captcha text
-    captcha_text = generate_captcha_text()
-    
-    # Generate token
-    token = uuid.uuid4().hex
-    
-    # Create database record
-    captcha_token = CaptchaToken(
-        token=token,
-        solution=captcha_text,
-        used=False
-    )
-    db.session.add(captcha_token)
-    db.session.commit()
-    
-    # Generate image
-    captcha_image = generate_captcha_image(captcha_text)
-    
-    return {
-        'token': token,
-        'image': captcha_image
-    }
+    return render_captchas(1)[0]
 
 
 def validate_captcha(token, solution):
@@ -116,6 +214,9 @@ def validate_captcha(token, solution):
     if not token or not solution:
         return False
     
+    if is_signed_mode():
+        return signed_captcha.verify(token, solution)
+    
     # Find token in database
     captcha_token = CaptchaToken.query.filter_by(token=token, used=False).first()
     
@@ -134,11 +235,13 @@ def validate_captcha(token, solution):
 def generate_captcha():
     """API endpoint to generate a new captcha"""
     try:
-        captcha_data = create_captcha()
+        # Serve a pre-rendered captcha, rendering one here only if the pool ran dry
+        captcha_data = captcha_pool.pop() or create_captcha()
         return jsonify({
             'success': True,
             'token': captcha_data['token'],
-            'image': captcha_data['image']
+            'image': captcha_data['image'],
+            'mime': captcha_data['mime']
         })
     except Exception as e:
         logger.error(f"Error generating captcha: {str(e)}")
@@ -0,0 +1,76 @@
+import logging
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# Pooled captchas whose tokens expire sooner than this are discarded instead of served
+MIN_SOLVE_SECONDS = 300
+
+class CaptchaPool:
+    """
+    In-process pool of pre-rendered captchas.
+
+    Entries are rendered and their tokens stored in bulk by the
+    refill_captcha_pool task, so serving a captcha is a pop from the
+    pool. The task tops the pool up to the high watermark whenever it
+    drops below the low watermark.
+    """
+
+    def __init__(self):
+        self.low_watermark = 20
+        self.high_watermark = 100
+        self._lock = threading.Lock()
+        self._entries = deque()
+
+    def init_app(self, app):
+        self.low_watermark = app.config.get('CAPTCHA_POOL_LOW_WATERMARK', 20)
+        self.high_watermark = app.config.get('CAPTCHA_POOL_HIGH_WATERMARK', 100)
+
+    def pop(self):
+        """
+        Take a captcha from the pool
+
+        Returns:
+            dict: {'token', 'image', 'mime', 'expires_at'}, or None if the pool is empty
+        """
+        with self._lock:
+            self._prune()
+            return self._entries.popleft() if self._entries else None
+
+    def extend(self, entries):
+        """Add freshly rendered captchas"""
+        with self._lock:
+            self._entries.extend(entries)
+
+    def deficit(self):
+        """Number of captchas to render, 0 while the pool is above the low watermark"""
+        with self._lock:
+            self._prune()
+            size = len(self._entries)
+        return self.high_watermark - size if size < self.low_watermark else 0
+
+    def _prune(self):
+        """Drop captchas whose tokens expire too soon to be solved; the oldest come first"""
+        fresh_until = time.time() + MIN_SOLVE_SECONDS
+        while self._entries and self._entries[0]['expires_at'] < fresh_until:
+            self._entries.popleft()
+
+    def clear(self):
+        """
+        Empty the pool
+
+        Returns:
+            list: The dropped captchas
+        """
+        with self._lock:
+            entries = list(self._entries)
+            self._entries.clear()
+        return entries
+
+    def __len__(self):
+        return len(self._entries)
+
+# Create a singleton instance
+captcha_pool = CaptchaPool()
@@ -0,0 +1,238 @@
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+from flask import current_app
+from models import Thread
+
+logger = logging.getLogger(__name__)
+
+# Characters of the OP kept for the catalog snippet
+SNIPPET_LENGTH = 200
+
+# How far back the cross-worker sync looks past its last run, to absorb clock skew
+SYNC_OVERLAP = timedelta(seconds=5)
+
+
+class BoardCatalog:
+    """Catalog tiles for one board, keyed by thread ID"""
+
+    def __init__(self, board_id):
+        self.board_id = board_id
+        self.tiles = {}
+        self.synced_at = None
+        self.built_at = 0.0
+        self._ordered = None
+
+    def put(self, tile):
+        self.tiles[tile['id']] = tile
+        self._ordered = None
+
+    def discard(self, thread_id):
+        if self.tiles.pop(thread_id, None) is not None:
+            self._ordered = None
+
+    def ordered(self):
+        """Tiles in bump order, cached until the next change"""
+        if self._ordered is None:
+            self._ordered = sorted(
+                self.tiles.values(),
+                key=lambda tile: (tile['sticky'], tile['updated_at'], tile['id']),
+                reverse=True
+            )
+        return self._ordered
+
+
+class CatalogCache:
+    """
+    In-process cache of the per-board catalog.
+
+    A board's catalog is built from the database on first use. After that,
+    the posting, moderation and cleanup paths update single tiles as they
+    commit. Threads created or bumped by other workers are merged in on
+    read by a small query for rows whose updated_at moved. Deletions made
+    by other workers are picked up by a periodic full rebuild.
+
+    Queries run without holding the cache lock, which only guards the
+    swap of their results; a per-board lock keeps one board from being
+    rebuilt twice at once.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._boards = {}
+        self._build_locks = {}
+        self._removed_while_building = {}  # board_id -> thread IDs deleted during a rebuild
+
+    def get_tiles(self, board_id):
+        """
+        Get the catalog tiles for a board in bump order
+
+        Returns:
+            list: Tile dicts
+        """
+        rebuild_seconds = current_app.config.get('CATALOG_REBUILD_INTERVAL_SECONDS', 300)
+
+        with self._lock:
+            catalog = self._boards.get(board_id)
+        if self._is_stale(catalog, rebuild_seconds):
+            catalog = self._rebuild(board_id, rebuild_seconds)
+        else:
+            self._sync(catalog)
+
+        with self._lock:
+            return list(catalog.ordered())
+
+    def add_thread(self, thread, first_post, first_image=None):
+        """Add a newly created thread"""
+        tile = make_tile(thread, first_post, first_image)
+        with self._lock:
+            catalog = self._boards.get(thread.board_id)
+            if catalog is not None:
+                catalog.put(tile)
+
+    def update_thread(self, thread):
+        """Refresh the counters and flags of a thread after a reply or moderation"""
+        with self._lock:
+            catalog = self._boards.get(thread.board_id)
+            if catalog is None:
+                return
+            tile = catalog.tiles.get(thread.id)
+            if tile is not None:
+                catalog.put(dict(tile, **thread_fields(thread)))
+                return
+
+        self._put_loaded(thread)
+
+    def reload_thread(self, thread):
+        """Rebuild a thread's tile from the database, e.g. after its OP changed"""
+        with self._lock:
+            if thread.board_id not in self._boards:
+                return
+
+        self._put_loaded(thread)
+
+    def remove_thread(self, board_id, thread_id):
+        """Drop a deleted thread"""
+        with self._lock:
+            catalog = self._boards.get(board_id)
+            if catalog is not None:
+                catalog.discard(thread_id)
+            if board_id in self._removed_while_building:
+                self._removed_while_building[board_id].add(thread_id)
+
+    def remove_board(self, board_id):
+        """Forget a deleted board"""
+        with self._lock:
+            self._boards.pop(board_id, None)
+
+    def _put_loaded(self, thread):
+        """Load a thread's tile outside the lock, then store it"""
+        tile = self._load_tiles([thread])[0]
+        with self._lock:
+            catalog = self._boards.get(thread.board_id)
+            if catalog is not None:
+                catalog.put(tile)
+
+    def _is_stale(self, catalog, rebuild_seconds):
+        return catalog is None or time.monotonic() - catalog.built_at > rebuild_seconds
+
+    def _rebuild(self, board_id, rebuild_seconds):
+        """Build a board's catalog and swap it in, unless another request just did"""
+        with self._lock:
+            build_lock = self._build_locks.setdefault(board_id, threading.Lock())
+
+        with build_lock:
+            with self._lock:
+                catalog = self._boards.get(board_id)
+                if not self._is_stale(catalog, rebuild_seconds):
+                    return catalog
+                self._removed_while_building[board_id] = set()
+
+            try:
+                catalog = self._build(board_id)
+            except Exception:
+                with self._lock:
+                    self._removed_while_building.pop(board_id, None)
+                raise
+
+            with self._lock:
+                for thread_id in self._removed_while_building.pop(board_id):
+                    catalog.discard(thread_id)
+                self._boards[board_id] = catalog
+            return catalog
+
+    def _build(self, board_id):
+        logger.info(f"Building catalog for board {board_id}")
+        catalog = BoardCatalog(board_id)
+        catalog.synced_at = datetime.utcnow()
+        catalog.built_at = time.monotonic()
+
+        threads = Thread.query.filter_by(board_id=board_id).all()
+        for tile in self._load_tiles(threads):
+            catalog.put(tile)
+        return catalog
+
+    def _sync(self, catalog):
+        """Merge threads that other workers created or bumped since the last sync"""
+        now = datetime.utcnow()
+        with self._lock:
+            synced_at = catalog.synced_at
+            known = set(catalog.tiles)
+
+        changed = Thread.query.filter(
+            Thread.board_id == catalog.board_id,
+            Thread.updated_at >= synced_at - SYNC_OVERLAP
+        ).all()
+        new_tiles = self._load_tiles([thread for thread in changed if thread.id not in known])
+
+        with self._lock:
+            catalog.synced_at = max(catalog.synced_at, now)
+            for thread in changed:
+                tile = catalog.tiles.get(thread.id)
+                if tile is not None:
+                    catalog.put(dict(tile, **thread_fields(thread)))
+            for tile in new_tiles:
+                catalog.put(tile)
+
+    def _load_tiles(self, threads):
+        from boards import load_thread_previews
+
+        return [
+            make_tile(item['thread'], item['first_post'], item['first_image'])
+            for item in load_thread_previews(threads)
+        ]
+
+
+def thread_fields(thread):
+    """Catalog fields that come from the thread row itself"""
+    return {
+        'id': thread.id,
+        'subject': thread.subject,
+        'sticky': bool(thread.sticky),
+        'locked': bool(thread.locked),
+        'reply_count': thread.reply_count or 0,
+        'image_count': thread.image_count or 0,
+        'created_at': thread.created_at,
+        'updated_at': thread.updated_at,
+    }
+
+
+def make_tile(thread, first_post, first_image=None):
+    """Build the catalog tile for a thread"""
+    tile = thread_fields(thread)
+    tile['snippet'] = first_post.content[:SNIPPET_LENGTH] if first_post else ''
+    tile['thumbnail_url'] = tile['thumbnail_webp_url'] = None
+    tile['thumbnail_width'] = tile['thumbnail_height'] = None
+    if first_image:
+        preview = first_image.thumbnail('preview')
+        if preview:
+            tile['thumbnail_url'] = preview['fallback']['url']
+            tile['thumbnail_webp_url'] = preview['webp']['url']
+            tile['thumbnail_width'], tile['thumbnail_height'] = preview['width'], preview['height']
+        elif first_image.status in ('ready', 'failed'):
+            tile['thumbnail_url'] = first_image.public_url
+    return tile
+
+# Create a singleton instance
+catalog_cache = CatalogCache()
@@ -0,0 +1,76 @@
+import time
+import hashlib
+from datetime import datetime
+from flask import request, session, make_response
+from flask_login import current_user
+from sqlalchemy import update
+from werkzeug.http import is_resource_modified
+from app import db
+from models import Board, Thread
+
+# Pages with forms change validators this often, so a 304 never revives an expired CSRF token
+CSRF_EPOCH_SECONDS = 1800
+
+
+def touch_board(board_id):
+    """Mark a board's listing as changed, in the current transaction"""
+    db.session.execute(
+        update(Board.__table__)
+        .where(Board.__table__.c.id == board_id)
+        .values(last_modified_at=datetime.utcnow())
+    )
+
+
+def touch_thread(thread_id):
+    """Mark a thread's page as changed, in the current transaction"""
+    threads = Thread.__table__
+    db.session.execute(
+        update(threads)
+        .where(threads.c.id == thread_id)
+        .values(last_modified_at=datetime.utcnow(), updated_at=threads.c.updated_at)  # Don't bump
+    )
+
+
+def make_validators(last_modified, *state, per_viewer=True):
+    """
+    Build the (etag, last_modified) pair for a page.
+
+    Args:
+        last_modified: Modification marker of the board or thread shown
+        state: Anything else the page depends on, e.g. sort order and page
+        per_viewer: False for responses that are the same for everyone
+
+    By default the viewer is part of the ETag because pages differ per user.
+    """
+    parts = [last_modified.isoformat()]
+    if per_viewer:
+        viewer = current_user.get_id() if current_user.is_authenticated else 'anon'
+        parts.extend([viewer, int(time.time() // CSRF_EPOCH_SECONDS)])
+    parts.extend(state)
+    etag = hashlib.sha1('|'.join(str(part) for part in parts).encode()).hexdigest()
+    return etag, last_modified.replace(microsecond=0)
+
+
+def is_not_modified(validators):
+    """Check the request's If-None-Match/If-Modified-Since against the validators"""
+    if validators is None or '_flashes' in session:
+        return False
+    etag, last_modified = validators
+    return not is_resource_modified(request.environ, etag=etag, last_modified=last_modified)
+
+
+def add_validators(response, validators):
+    """Attach ETag and Last-Modified headers, and make clients revalidate"""
+    if validators is None:
+        return response
+    etag, last_modified = validators
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.headers['Cache-Control'] = 'no-cache'
+    response.vary.add('Cookie')
+    return response
+
+
+def not_modified(validators):
+    """Build an empty 304 response"""
+    return add_validators(make_response('', 304), validators)
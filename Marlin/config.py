@@ -17,13 +17,118 @@ class Config:
     MEGA_EMAIL = os.environ.get('MEGA_EMAIL')
     MEGA_PASSWORD = os.environ.get('MEGA_PASSWORD')
     
+    # File storage: 'sharded' (local folders fanned out by file ID), 'local' (one flat folder,
+    # the original layout) or 's3' (an S3-compatible bucket)
+    STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'sharded')
+    UPLOAD_FOLDER = os.environ.get('UPLOAD_FOLDER')  # Defaults to instance/uploads, outside static/
+    STORAGE_URL_PREFIX = os.environ.get('STORAGE_URL_PREFIX', '/media')  # Served by media.py for local backends
+    STORAGE_SHARD_DEPTH = 2  # Folder levels, e.g. ab/cd/<file_id>
+    STORAGE_SHARD_WIDTH = 2  # Characters of the file ID per level
+    S3_BUCKET = os.environ.get('S3_BUCKET')
+    S3_ENDPOINT_URL = os.environ.get('S3_ENDPOINT_URL')  # e.g. a MinIO server; unset for AWS
+    S3_REGION = os.environ.get('S3_REGION')
+    S3_ACCESS_KEY = os.environ.get('S3_ACCESS_KEY')
+    S3_SECRET_KEY = os.environ.get('S3_SECRET_KEY')
+    S3_KEY_PREFIX = os.environ.get('S3_KEY_PREFIX', '')
+    S3_PUBLIC_URL = os.environ.get('S3_PUBLIC_URL')  # Base URL files are served from, e.g. a CDN
+    
+    # How /media hands files over: 'none' (send_file), 'x-accel-redirect' (nginx) or 'x-sendfile'
+    MEDIA_SENDFILE_MODE = os.environ.get('MEDIA_SENDFILE_MODE', 'none')
+    MEDIA_ACCEL_REDIRECT_PREFIX = '/_media/'  # nginx "internal" location aliased to the upload folder
+    
     # Thread cleanup configuration
     THREAD_MAX_AGE_DAYS = 120  # 4 months
     THREAD_CLEANUP_INTERVAL_HOURS = 24
+    THREAD_CLEANUP_BATCH_SIZE = 100  # Threads deleted per transaction
+    THREAD_CLEANUP_TIME_BUDGET_SECONDS = 300  # A run stops after this long and resumes from its checkpoint next time
+    
+    # Scheduled jobs run by this process: 'all', 'local' (per-process jobs only, for web workers
+    # next to a marlin-worker) or 'shared' (database jobs only, what marlin-worker runs)
+    SCHEDULER_JOBS = os.environ.get('SCHEDULER_JOBS', 'all')
+    # Elects the one process running the shared jobs: 'auto' (a PostgreSQL advisory lock, or a
+    # lock file for other databases), 'postgres', 'file' or 'none' (every process runs them)
+    SCHEDULER_LOCK = os.environ.get('SCHEDULER_LOCK', 'auto')
+    SCHEDULER_LOCK_KEY = 0x4d61726c696e  # Advisory lock key, "Marlin" in ASCII
+    SCHEDULER_LOCK_FILE = os.environ.get('SCHEDULER_LOCK_FILE')  # Defaults to instance/scheduler.lock
+    
+    # Thread view counts are buffered in memory and flushed at this interval
+    VIEW_COUNT_FLUSH_INTERVAL_SECONDS = 10
+    
+    # Catalog pages are updated incrementally and fully rebuilt at this interval
+    CATALOG_REBUILD_INTERVAL_SECONDS = 300
+    
+    # Page cache for anonymous visitors: 'shared' (all workers on the host), 'memory' or 'none'.
+    # 'memory' is private to each worker process and invalidations only reach the worker that made
+    # the change, so other workers serve stale pages for up to PAGE_CACHE_TTL_SECONDS: only use it
+    # with a single worker. With several hosts, use 'none' or a short TTL.
+    PAGE_CACHE_BACKEND = os.environ.get('PAGE_CACHE_BACKEND', 'shared')
+    PAGE_CACHE_PATH = os.environ.get('PAGE_CACHE_PATH')  # Defaults to a file per database in /dev/shm (tmpfs), or the instance folder without it
+    PAGE_CACHE_TTL_SECONDS = 30
+    PAGE_CACHE_MAX_ENTRIES = 2000
+    
+    # Live thread updates (Server-Sent Events)
+    # Each reader holds a request open for up to LIVE_STREAM_MAX_SECONDS, so this needs threaded or async
+    # workers (run.sh uses gthread); turn it off when running gunicorn with its default sync workers
+    LIVE_UPDATES_ENABLED = os.environ.get('LIVE_UPDATES_ENABLED', 'True').lower() in ('true', '1', 't')
+    LIVE_SIGNAL_DIR = os.environ.get('LIVE_SIGNAL_DIR')  # Shared by all workers on the host; defaults to a temp dir
+    LIVE_SIGNAL_POLL_SECONDS = 1.0
+    LIVE_KEEPALIVE_SECONDS = 15
+    LIVE_STREAM_MAX_SECONDS = 300  # Clients reconnect with Last-Event-ID afterwards
+    # Streams served at once by one process, each holding a worker thread; keep it well below
+    # GUNICORN_THREADS (run.sh) so pages and posting keep their threads. Further readers poll.
+    LIVE_MAX_STREAMS_PER_PROCESS = int(os.environ.get('LIVE_MAX_STREAMS_PER_PROCESS', 16))
+    
+    # Read-only JSON API
+    API_CACHE_MAX_AGE_SECONDS = 10  # Lets mirrors and proxies reuse responses without revalidating
+    API_COMPRESS_MIN_BYTES = 1024  # Smaller bodies are sent uncompressed
+    
+    # Captcha pool: refilled up to the high watermark whenever it drops below the low one
+    CAPTCHA_POOL_ENABLED = os.environ.get('CAPTCHA_POOL_ENABLED', 'True').lower() in ('true', '1', 't')
+    CAPTCHA_POOL_LOW_WATERMARK = 20
+    CAPTCHA_POOL_HIGH_WATERMARK = 100
+    CAPTCHA_POOL_REFILL_INTERVAL_SECONDS = 2
+    CAPTCHA_IMAGE_FORMAT = os.environ.get('CAPTCHA_IMAGE_FORMAT', 'png8')  # 'png', 'png8' (paletted) or 'webp'
+    
+    # Captcha tokens: 'database' stores each one in captcha_tokens, 'signed' issues stateless HMAC-signed tokens
+    CAPTCHA_TOKEN_MODE = os.environ.get('CAPTCHA_TOKEN_MODE', 'database')
+    CAPTCHA_TOKEN_TTL_SECONDS = 1800
+    CAPTCHA_REPLAY_CACHE_BACKEND = os.environ.get('CAPTCHA_REPLAY_CACHE_BACKEND', 'shared')  # 'shared' (all workers on the host) or 'memory' (per worker)
+    CAPTCHA_REPLAY_CACHE_PATH = os.environ.get('CAPTCHA_REPLAY_CACHE_PATH')  # Defaults to a file per database in /dev/shm
+    # Nonces are kept until their tokens expire and tokens are rejected while the cache is full,
+    # so this has to cover CAPTCHA_TOKEN_TTL_SECONDS of solved captchas (100000 is ~55 a second)
+    CAPTCHA_REPLAY_CACHE_MAX_ENTRIES = 100000
+    
+    # Purge of the captcha_tokens table: used tokens, and unused ones older than the max age
+    CAPTCHA_PURGE_INTERVAL_HOURS = 1
+    CAPTCHA_TOKEN_MAX_AGE_HOURS = 24
+    
+    # Thread rendering configuration
+    THREAD_STREAM_RENDER = os.environ.get('THREAD_STREAM_RENDER', 'False').lower() in ('true', '1', 't')
+    THREAD_RENDER_CHUNK_SIZE = 100  # Posts fetched per query when streaming
     
     # Upload configuration
     MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB max upload size
     ALLOWED_EXTENSIONS = {'jpg', 'jpeg', 'png', 'gif', 'webp'}
+    IMAGE_THUMBNAIL_SIZES = {'preview': 250, 'post': 500}  # Longest side in pixels; 'preview' for board listings
+    IMAGE_THUMBNAIL_QUALITY = 80
+    
+    # Image processing runs in a pool of worker processes; 0 processes uploads inline
+    IMAGE_PROCESSING_WORKERS = int(os.environ.get('IMAGE_PROCESSING_WORKERS', 2))
+    IMAGE_JOB_MAX_ATTEMPTS = 3
+    IMAGE_JOB_RETRY_DELAY_SECONDS = 30
+    IMAGE_JOB_TIMEOUT_SECONDS = 300  # Running jobs older than this are assumed lost and resubmitted
+    
+    # Files of deleted records are removed from storage by a thread pool; 0 removes them inline after the commit
+    FILE_DELETION_WORKERS = int(os.environ.get('FILE_DELETION_WORKERS', 4))
+    FILE_DELETION_BATCH_SIZE = 100  # Files claimed by a worker at a time
+    FILE_DELETION_MAX_ATTEMPTS = 5  # Failed deletions are kept in file_deletions after this many tries
+    FILE_DELETION_RETRY_DELAY_SECONDS = 60  # Multiplied by the number of attempts so far
+    FILE_DELETION_LEASE_SECONDS = 300  # Claimed files not done after this long are tried again
+    
+    # Perceptual hash matching, as the number of differing bits out of 64
+    IMAGE_BAN_MAX_DISTANCE = 6  # Uploads this close to a banned image are rejected
+    IMAGE_DUPLICATE_MAX_DISTANCE = 4  # Uploads this close to an earlier image are flagged as reposts
+    IMAGE_SIMILAR_MAX_DISTANCE = 10  # Shown by the admin similar images page
     
     # Admin configuration
     ADMIN_USERNAME = os.environ.get('ADMIN_USERNAME', 'admin')
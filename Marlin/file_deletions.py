@@ -0,0 +1,220 @@
+import os
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from sqlalchemy import select, update, delete, insert, bindparam, event
+from sqlalchemy.orm import Session
+from app import db
+from models import FileDeletion, StoredFile
+from mega_utils import mega_handler, STORED_FILES_KEY
+
+logger = logging.getLogger(__name__)
+
+class FileDeletionQueue:
+    """
+    Durable queue of files to remove from storage.
+
+    Deleting records releases their files and queues the ones nothing
+    uses any more as file_deletions rows, in the same transaction, so the
+    request only pays for a few INSERTs. After the commit kick() starts
+    a pool of threads that claim the queued files in batches and delete
+    them in parallel. Failures are retried with a growing delay, and
+    files claimed by a process that died are picked up again once their
+    lease runs out.
+
+    Uploads are stored before their transaction commits. When it rolls
+    back instead, the blobs it wrote are queued here too; the drainer
+    keeps any of them that is referenced after all.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.workers = 4
+        self.batch_size = 100
+        self.max_attempts = 5
+        self.retry_delay = 60
+        self.lease = 300
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+        self._running = 0
+
+    def init_app(self, app):
+        self.app = app
+        self.workers = app.config.get('FILE_DELETION_WORKERS', 4)
+        self.batch_size = app.config.get('FILE_DELETION_BATCH_SIZE', 100)
+        self.max_attempts = app.config.get('FILE_DELETION_MAX_ATTEMPTS', 5)
+        self.retry_delay = app.config.get('FILE_DELETION_RETRY_DELAY_SECONDS', 60)
+        self.lease = app.config.get('FILE_DELETION_LEASE_SECONDS', 300)
+
+        if not event.contains(Session, 'after_commit', self._forget_stored):
+            event.listen(Session, 'after_commit', self._forget_stored)
+            event.listen(Session, 'after_transaction_end', self._queue_uncommitted)
+
+    def release(self, file_ids):
+        """
+        Drop references to files and queue the ones nothing uses any more,
+        in the current transaction. Call kick() once it has committed.
+
+        Args:
+            file_ids: File IDs, once per reference dropped
+
+        Returns:
+            int: Number of files queued for deletion
+        """
+        unreferenced = mega_handler.release_files(file_ids)
+        if unreferenced:
+            now = datetime.utcnow()
+            db.session.execute(insert(FileDeletion.__table__), [
+                {'file_id': file_id, 'attempts': 0, 'not_before': now, 'created_at': now}
+                for file_id in unreferenced
+            ])
+        return len(unreferenced)
+
+    def _forget_stored(self, session):
+        session.info.pop(STORED_FILES_KEY, None)
+
+    def _queue_uncommitted(self, session, transaction):
+        """Queue the blobs of a transaction that ended without a commit"""
+        if transaction.parent is not None:
+            return
+        file_ids = session.info.pop(STORED_FILES_KEY, None)
+        if not file_ids:
+            return
+
+        # The session's transaction is over, so record them on a connection of their own
+        now = datetime.utcnow()
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(insert(FileDeletion.__table__), [
+                    {'file_id': file_id, 'attempts': 0, 'not_before': now, 'created_at': now}
+                    for file_id in set(file_ids)
+                ])
+        except Exception as e:
+            logger.error(f"Error queueing files of a rolled back upload: {str(e)}")
+            return
+        logger.info(f"Queued {len(set(file_ids))} files of a rolled back upload for deletion")
+        self.kick()
+
+    def kick(self):
+        """Start draining the queue in the background"""
+        if self.workers <= 0:
+            # Synchronous mode, e.g. for development
+            self.drain()
+            return
+
+        with self._lock:
+            idle = self.workers - self._running
+            self._running += idle
+        for _ in range(idle):
+            try:
+                self._get_executor().submit(self._run)
+            except RuntimeError as e:
+                # Shut down pool, e.g. at exit: the rows stay queued for the next kick
+                logger.error(f"Error starting file deletion worker: {str(e)}")
+                with self._lock:
+                    self._running -= 1
+                    self._executor = None
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='file-deletion')
+                self._pid = os.getpid()
+                self._running = min(self._running, self.workers)
+            return self._executor
+
+    def _run(self):
+        try:
+            with self.app.app_context():
+                self.drain()
+        except Exception as e:
+            logger.error(f"Error draining file deletion queue: {str(e)}")
+        finally:
+            with self._lock:
+                self._running -= 1
+
+    def drain(self):
+        """
+        Delete queued files until none are due
+
+        Returns:
+            int: Number of queue entries processed
+        """
+        processed = 0
+        while True:
+            count = self.drain_batch()
+            if not count:
+                return processed
+            processed += count
+
+    def drain_batch(self):
+        """
+        Claim up to batch_size due files and delete them from storage
+
+        Returns:
+            int: Number of queue entries claimed
+        """
+        deletions = FileDeletion.__table__
+        now = datetime.utcnow()
+
+        # SKIP LOCKED lets concurrent workers claim different rows on PostgreSQL;
+        # the claim pushes not_before back by the lease so nobody else takes them
+        due = select(deletions.c.id).where(
+            deletions.c.not_before <= now, deletions.c.attempts < self.max_attempts
+        ).order_by(deletions.c.id).limit(self.batch_size).with_for_update(skip_locked=True)
+        claimed = db.session.execute(
+            update(deletions).where(deletions.c.id.in_(due), deletions.c.not_before <= now).values(
+                attempts=deletions.c.attempts + 1,
+                not_before=now + timedelta(seconds=self.lease)
+            ).returning(deletions.c.id, deletions.c.file_id, deletions.c.attempts)
+        ).all()
+        db.session.commit()
+        if not claimed:
+            return 0
+
+        files = StoredFile.__table__
+        storage = mega_handler.get_storage()
+        done = []
+        failed = []
+        for deletion_id, file_id, attempts in claimed:
+            # One transaction per file: the reference row is held while the blob is
+            # removed, so an upload of the same content can't reuse it meanwhile
+            if not mega_handler.hold_unreferenced(file_id):
+                db.session.rollback()
+                logger.info(f"Keeping file {file_id}, it was stored again")
+                done.append(deletion_id)
+                continue
+            try:
+                storage.delete(file_id)
+                db.session.execute(delete(files).where(files.c.file_id == file_id, files.c.refcount <= 0))
+                db.session.commit()
+                done.append(deletion_id)
+            except Exception as e:
+                db.session.rollback()
+                if attempts >= self.max_attempts:
+                    logger.error(f"Giving up deleting file {file_id} after {attempts} attempts: {str(e)}")
+                else:
+                    logger.warning(f"Error deleting file {file_id}, will retry: {str(e)}")
+                failed.append({
+                    'deletion_id': deletion_id,
+                    'deletion_error': str(e),
+                    'retry_at': now + timedelta(seconds=self.retry_delay * attempts),
+                })
+
+        if done:
+            db.session.execute(delete(deletions).where(deletions.c.id.in_(done)))
+        if failed:
+            db.session.execute(
+                update(deletions).where(deletions.c.id == bindparam('deletion_id')).values(
+                    error=bindparam('deletion_error'), not_before=bindparam('retry_at')
+                ),
+                failed
+            )
+        db.session.commit()
+        logger.info(f"Deleted {len(done)} queued files, {len(failed)} failed")
+        return len(claimed)
+
+# Create a singleton instance
+file_deletion_queue = FileDeletionQueue()
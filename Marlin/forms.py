@@ -20,12 +20,24 @@ class RegistrationForm(FlaskForm):
     submit = SubmitField('Sign Up')
 
 
+class ImageContent:
+    """Check the content of an upload, not just its extension"""
+    def __init__(self, message=None):
+        self.message = message or 'File is not a supported image.'
+    
+    def __call__(self, form, field):
+        stream = getattr(field.data, 'stream', None)
+        if field.data and getattr(stream, 'rejected', False):
+            raise ValidationError(self.message)
+
+
 class NewThreadForm(FlaskForm):
     subject = StringField('Subject', validators=[Optional(), Length(max=128)])
     content = TextAreaField('Comment', validators=[DataRequired(), Length(min=1, max=4000)])
     image = FileField('Image', validators=[
         Optional(),
-        FileAllowed(current_app.config['ALLOWED_EXTENSIONS'], 'Images only!')
+        FileAllowed(current_app.config['ALLOWED_EXTENSIONS'], 'Images only!'),
+        ImageContent('Images only!')
     ])
     captcha_token = HiddenField('Captcha Token')
     captcha_solution = StringField('Captcha', validators=[DataRequired()])
@@ -36,7 +48,8 @@ class ReplyForm(FlaskForm):
     content = TextAreaField('Comment', validators=[DataRequired(), Length(min=1, max=4000)])
     image = FileField('Image', validators=[
         Optional(),
-        FileAllowed(current_app.config['ALLOWED_EXTENSIONS'], 'Images only!')
+        FileAllowed(current_app.config['ALLOWED_EXTENSIONS'], 'Images only!'),
+        ImageContent('Images only!')
     ])
     captcha_token = HiddenField('Captcha Token')
     captcha_solution = StringField('Captcha', validators=[DataRequired()])
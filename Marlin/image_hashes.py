@@ -0,0 +1,231 @@
+import logging
+import threading
+import click
+from collections import defaultdict
+from PIL import Image as PILImage
+from sqlalchemy import select, false
+from flask import current_app
+from flask.cli import with_appcontext
+from app import db
+from models import Image, BannedImage
+from mega_utils import mega_handler
+from image_processing import difference_hash, to_signed64
+from file_deletions import file_deletion_queue
+
+logger = logging.getLogger(__name__)
+
+# A 64-bit hash is indexed as four 16-bit chunks
+CHUNK_BITS = 16
+CHUNK_COUNT = 4
+CHUNK_MASK = (1 << CHUNK_BITS) - 1
+
+
+def to_unsigned64(value):
+    return value + (1 << 64) if value < 0 else value
+
+
+def chunk_neighbours(chunk, radius):
+    """Every chunk value within a Hamming distance of radius, chunk itself first"""
+    values = [chunk]
+    frontier = [(chunk, -1)]
+    for _ in range(radius):
+        next_frontier = []
+        for value, last_bit in frontier:
+            # Flip bits in increasing order so each value is generated once
+            for bit in range(last_bit + 1, CHUNK_BITS):
+                flipped = value ^ (1 << bit)
+                values.append(flipped)
+                next_frontier.append((flipped, bit))
+        frontier = next_frontier
+    return values
+
+
+class HammingIndex:
+    """
+    Multi-index hashing over 64-bit hashes.
+
+    Each hash is filed under each of its four 16-bit chunks. If two hashes
+    are within distance k, one of their chunks is within k // 4 of the
+    other's (pigeonhole), so a query only probes the chunk values within
+    that radius and checks the few hashes filed there. Unlike a BK-tree,
+    entries can be removed cheaply.
+    """
+
+    def __init__(self):
+        self.hashes = {}  # item_id -> unsigned hash
+        self.tables = [defaultdict(list) for _ in range(CHUNK_COUNT)]  # chunk -> [(hash, item_id)]
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def add(self, item_id, value):
+        if item_id in self.hashes:
+            return
+        self.hashes[item_id] = value
+        for i, table in enumerate(self.tables):
+            table[(value >> (i * CHUNK_BITS)) & CHUNK_MASK].append((value, item_id))
+
+    def remove(self, item_id):
+        value = self.hashes.pop(item_id, None)
+        if value is None:
+            return
+        for i, table in enumerate(self.tables):
+            chunk = (value >> (i * CHUNK_BITS)) & CHUNK_MASK
+            table[chunk].remove((value, item_id))
+            if not table[chunk]:
+                del table[chunk]
+
+    def search(self, value, max_distance):
+        """
+        Find hashes within max_distance bits of value
+
+        Returns:
+            list: (item_id, distance) tuples, closest first
+        """
+        radius = max_distance // CHUNK_COUNT
+        matches = {}
+        for i, table in enumerate(self.tables):
+            for chunk in chunk_neighbours((value >> (i * CHUNK_BITS)) & CHUNK_MASK, radius):
+                bucket = table.get(chunk)
+                if not bucket:
+                    continue
+                # Buckets hold (hash, item_id) pairs so candidates are checked without another lookup
+                for item_value, item_id in bucket:
+                    distance = (item_value ^ value).bit_count()
+                    if distance <= max_distance:
+                        matches[item_id] = distance
+        return sorted(matches.items(), key=lambda match: (match[1], match[0]))
+
+
+class PerceptualIndex:
+    """
+    In-process HammingIndex of the perceptual hashes of one table.
+
+    The index is loaded on first use and then catches up on rows with a
+    higher id than it has seen, so hashes written by other workers are
+    picked up without a full reload. Rows still being processed hold the
+    watermark back until they have a hash. Deleted rows are dropped when
+    a search runs into them.
+    """
+
+    def __init__(self, model, pending=None):
+        self.model = model
+        self.pending = pending  # Condition for rows that will get a hash later
+        self.index = HammingIndex()
+        self.last_id = 0
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        model = self.model
+        pending = self.pending if self.pending is not None else false()
+        rows = db.session.execute(
+            select(model.id, model.phash, pending).where(model.id > self.last_id).order_by(model.id)
+        ).all()
+
+        blocked = False
+        for row_id, phash, is_pending in rows:
+            if phash is not None:
+                self.index.add(row_id, to_unsigned64(phash))
+            blocked = blocked or is_pending
+            if not blocked:
+                self.last_id = row_id
+
+    def add(self, row_id, phash):
+        with self._lock:
+            self.index.add(row_id, to_unsigned64(phash))
+
+    def find(self, phash, max_distance, exclude=None):
+        """
+        Rows whose hash is within max_distance bits of phash
+
+        Returns:
+            list: (row, distance) tuples, closest first
+        """
+        with self._lock:
+            self.refresh()
+            matches = [
+                (row_id, distance)
+                for row_id, distance in self.index.search(to_unsigned64(phash), max_distance)
+                if row_id != exclude
+            ]
+
+            rows = {}
+            if matches:
+                ids = [row_id for row_id, _ in matches]
+                rows = {row.id: row for row in self.model.query.filter(self.model.id.in_(ids)).all()}
+                for row_id in ids:
+                    if row_id not in rows:
+                        self.index.remove(row_id)
+        return [(rows[row_id], distance) for row_id, distance in matches if row_id in rows]
+
+    def __len__(self):
+        return len(self.index)
+
+
+def screen_image(image):
+    """
+    Check a newly processed image against the banned and existing images
+
+    A banned image has its files released and is marked 'rejected'; a
+    near-duplicate of an earlier image is flagged with duplicate_of. Runs
+    in the transaction that stores the processing result; the caller
+    kicks file_deletion_queue once it has committed.
+
+    Returns:
+        bool: True if the image was rejected
+    """
+    if image.phash is None:
+        return False
+
+    ban_distance = current_app.config.get('IMAGE_BAN_MAX_DISTANCE', 6)
+    banned = banned_index.find(image.phash, ban_distance)
+    if banned:
+        ban, distance = banned[0]
+        logger.warning(f"Rejected image {image.id}: matches banned image {ban.id} at distance {distance}")
+        file_deletion_queue.release(image.file_ids())
+        image.mega_url = image.public_url = ''
+        image.thumbnails = None
+        image.status = 'rejected'
+        return True
+
+    duplicate_distance = current_app.config.get('IMAGE_DUPLICATE_MAX_DISTANCE', 4)
+    duplicates = image_index.find(image.phash, duplicate_distance, exclude=image.id)
+    earlier = [match.id for match, _ in duplicates if match.id < image.id]
+    if earlier:
+        image.duplicate_of = min(earlier)
+        logger.info(f"Image {image.id} is a near-duplicate of image {image.duplicate_of}")
+
+    image_index.add(image.id, image.phash)
+    return False
+
+
+@click.command('backfill-image-hashes')
+@click.option('--batch-size', default=500, help='Images hashed per commit.')
+@with_appcontext
+def backfill_image_hashes_command(batch_size):
+    """Compute perceptual hashes of images stored before they were hashed."""
+    hashed = failed = 0
+    last_id = 0
+    while True:
+        images = Image.query.filter(
+            Image.id > last_id, Image.phash.is_(None), Image.status == 'ready'
+        ).order_by(Image.id).limit(batch_size).all()
+        if not images:
+            break
+        
+        for image in images:
+            try:
+                with PILImage.open(mega_handler.local_path(image.mega_url)) as opened:
+                    image.phash = to_signed64(difference_hash(opened))
+                hashed += 1
+            except Exception as e:
+                logger.warning(f"Could not hash image {image.id}: {str(e)}")
+                failed += 1
+        last_id = images[-1].id
+        db.session.commit()
+    
+    click.echo(f"Hashed {hashed} images, {failed} could not be read.")
+
+# Create singleton instances
+image_index = PerceptualIndex(Image, pending=Image.status == 'pending')
+banned_index = PerceptualIndex(BannedImage)
@@ -0,0 +1,183 @@
+import os
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from functools import partial
+from sqlalchemy import update, select, or_, and_
+from app import db
+from models import ImageJob
+from image_processing import process_image_file, processing_args, apply_processing_result, UNPROCESSABLE_ERRORS
+from mega_utils import mega_handler
+from image_hashes import screen_image
+from file_deletions import file_deletion_queue
+from catalog import catalog_cache
+from page_cache import page_cache, board_tag, thread_tag
+from conditional import touch_board, touch_thread
+
+logger = logging.getLogger(__name__)
+
+class ImageProcessor:
+    """
+    Queue of image processing jobs.
+
+    An upload is stored as a pending Image with an ImageJob row in the
+    posting transaction. After the commit the job is handed to a pool of
+    worker processes, and a callback in the web worker stores the result
+    and marks the image ready. Job rows survive restarts: requeue_stale()
+    resubmits jobs that failed or never finished.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.workers = 2
+        self.max_attempts = 3
+        self.timeout = 300
+        self.retry_delay = 30
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+
+    def init_app(self, app):
+        self.app = app
+        self.workers = app.config.get('IMAGE_PROCESSING_WORKERS', 2)
+        self.max_attempts = app.config.get('IMAGE_JOB_MAX_ATTEMPTS', 3)
+        self.timeout = app.config.get('IMAGE_JOB_TIMEOUT_SECONDS', 300)
+        self.retry_delay = app.config.get('IMAGE_JOB_RETRY_DELAY_SECONDS', 30)
+
+    def enqueue(self, image):
+        """Add a processing job for a pending image to the current transaction"""
+        job = ImageJob(image=image, status='queued', attempts=0)
+        db.session.add(job)
+        return job
+
+    def submit(self, job_id):
+        """Start a job once the transaction that enqueued it has committed"""
+        self._start(ImageJob.id == job_id, ImageJob.status == 'queued')
+
+    def requeue_stale(self):
+        """
+        Resubmit jobs waiting for a retry, and running jobs whose worker
+        never reported back, e.g. because the web worker restarted.
+
+        Returns:
+            int: Number of jobs resubmitted
+        """
+        now = datetime.utcnow()
+        job_ids = db.session.execute(
+            select(ImageJob.id).where(or_(
+                and_(ImageJob.status == 'queued', ImageJob.updated_at < now - timedelta(seconds=self.retry_delay)),
+                and_(ImageJob.status == 'running', ImageJob.updated_at < now - timedelta(seconds=self.timeout)),
+            ))
+        ).scalars().all()
+
+        started = 0
+        for job_id in job_ids:
+            # The status and age are checked again so only one worker claims each job
+            started += self._start(
+                ImageJob.id == job_id,
+                or_(ImageJob.status == 'queued', ImageJob.status == 'running'),
+                ImageJob.updated_at < now - timedelta(seconds=min(self.retry_delay, self.timeout))
+            )
+        return started
+
+    def _start(self, *conditions):
+        """Claim a job matching conditions and hand it to the pool"""
+        jobs = ImageJob.__table__
+        claimed = db.session.execute(
+            update(jobs).where(*conditions).values(
+                status='running', attempts=jobs.c.attempts + 1, updated_at=datetime.utcnow()
+            ).returning(jobs.c.id)
+        ).scalars().all()
+        db.session.commit()
+
+        for job_id in claimed:
+            job = db.session.get(ImageJob, job_id)
+            args = processing_args(job.image)
+
+            if self.workers <= 0:
+                # Synchronous mode, e.g. for development
+                self._run_inline(job_id, args)
+                continue
+
+            try:
+                future = self._get_executor().submit(process_image_file, *args)
+                future.add_done_callback(partial(self._on_done, job_id))
+            except RuntimeError as e:
+                # Broken or shut down pool: drop it, requeue_stale will retry the job
+                logger.error(f"Error submitting image job {job_id}: {str(e)}")
+                with self._lock:
+                    self._executor = None
+        return len(claimed)
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                if 'forkserver' in multiprocessing.get_all_start_methods():
+                    # Forked from a clean server process that only imports the processing code,
+                    # never from a web worker with open connections and running threads
+                    context = multiprocessing.get_context('forkserver')
+                    context.set_forkserver_preload(['image_processing'])
+                else:
+                    context = multiprocessing.get_context('spawn')
+                self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+                self._pid = os.getpid()
+            return self._executor
+
+    def _run_inline(self, job_id, args):
+        try:
+            result = process_image_file(*args)
+        except Exception as e:
+            self._finish(job_id, error=e)
+        else:
+            self._finish(job_id, result=result)
+
+    def _on_done(self, job_id, future):
+        try:
+            result = future.result()
+        except Exception as e:
+            self._finish(job_id, error=e)
+        else:
+            self._finish(job_id, result=result)
+
+    def _finish(self, job_id, result=None, error=None):
+        """Record a job's outcome on its image and refresh the pages showing it"""
+        with self.app.app_context():
+            try:
+                job = db.session.get(ImageJob, job_id)
+                if job is None:
+                    return  # The image was deleted while it was processed
+
+                image = job.image
+                original = image.mega_url
+                if error is None:
+                    # Files replaced by the result are released and queued for deletion in the same transaction
+                    file_deletion_queue.release(apply_processing_result(image, result))
+                    screen_image(image)
+                    db.session.delete(job)
+                else:
+                    final = isinstance(error, UNPROCESSABLE_ERRORS) or job.attempts >= self.max_attempts
+                    job.status = 'failed' if final else 'queued'
+                    job.error = str(error)[:1000]
+                    job.updated_at = datetime.utcnow()
+                    if final:
+                        image.status = 'failed'
+                    logger.warning(f"Image job {job_id} failed (attempt {job.attempts}): {str(error)}")
+
+                thread = image.post.thread
+                touch_board(thread.board_id)
+                touch_thread(thread.id)
+                db.session.commit()
+            except Exception as e:
+                logger.error(f"Error finishing image job {job_id}: {str(e)}")
+                db.session.rollback()
+                return
+
+            mega_handler.release_local_path(original)
+            file_deletion_queue.kick()
+            catalog_cache.reload_thread(thread)
+            page_cache.invalidate(board_tag(thread.board_id), thread_tag(thread.id))
+
+# Create a singleton instance
+image_processor = ImageProcessor()
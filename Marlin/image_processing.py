@@ -0,0 +1,268 @@
+import os
+import uuid
+import hashlib
+import logging
+from io import BytesIO
+from PIL import Image as PILImage, ImageOps, UnidentifiedImageError
+from flask import current_app
+from werkzeug.utils import secure_filename
+from mega_utils import mega_handler
+from uploads import FORMAT_EXTENSIONS
+
+logger = logging.getLogger(__name__)
+
+# Formats whose originals are rewritten without EXIF/XMP metadata
+STRIPPABLE_FORMATS = {'JPEG', 'PNG', 'WEBP'}
+
+# EXIF orientation tag, applied to the pixels before the EXIF block is dropped
+EXIF_ORIENTATION = 0x0112
+
+# Errors process_image_file raises for files that are not usable images; retrying won't help
+UNPROCESSABLE_ERRORS = (UnidentifiedImageError, PILImage.DecompressionBombError, SyntaxError, ValueError)
+
+
+def to_signed64(value):
+    """Store an unsigned 64-bit hash in a signed BIGINT column"""
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def upload_size(file_storage):
+    """Size of an uploaded file in bytes, leaving the stream at the start"""
+    stream = file_storage.stream
+    stream.seek(0, os.SEEK_END)
+    size = stream.tell()
+    stream.seek(0)
+    return size
+
+
+def has_alpha(image):
+    return image.mode in ('RGBA', 'LA', 'PA') or (image.mode == 'P' and 'transparency' in image.info)
+
+
+def encode_thumbnail(image, pil_format, quality):
+    """
+    Encode a thumbnail
+
+    Returns:
+        bytes: Encoded image
+    """
+    buffered = BytesIO()
+    if pil_format == 'WEBP':
+        image.save(buffered, format='WEBP', quality=quality, method=4)
+    elif pil_format == 'JPEG':
+        image.save(buffered, format='JPEG', quality=quality, optimize=True, progressive=True)
+    else:
+        image.save(buffered, format='PNG', optimize=True)
+    return buffered.getvalue()
+
+
+def strip_metadata(image):
+    """
+    Re-encode an original without its EXIF/XMP metadata
+
+    Returns:
+        bytes: The stripped file, or None if there was nothing to strip
+    """
+    if image.format not in STRIPPABLE_FORMATS or getattr(image, 'n_frames', 1) > 1:
+        return None
+    exif = image.getexif()
+    if not ({'exif', 'xmp', 'XML:com.adobe.xmp'} & set(image.info) or exif):
+        return None
+
+    pil_format = image.format
+    icc_profile = image.info.get('icc_profile')
+    rotated = exif.get(EXIF_ORIENTATION, 1) != 1
+    if rotated:
+        image = ImageOps.exif_transpose(image)
+
+    buffered = BytesIO()
+    if pil_format == 'JPEG':
+        # Unless the pixels had to be rotated, reuse the original quantization tables
+        quality = 95 if rotated else 'keep'
+        image.save(buffered, format='JPEG', quality=quality, icc_profile=icc_profile)
+    elif pil_format == 'WEBP':
+        image.save(buffered, format='WEBP', quality=90, icc_profile=icc_profile)
+    else:
+        image.save(buffered, format='PNG', icc_profile=icc_profile)
+    return buffered.getvalue()
+
+
+def difference_hash(image):
+    """
+    64-bit perceptual hash (dHash) of an image
+    
+    Each bit says whether a pixel of a 9x8 greyscale version is brighter
+    than its right neighbour, so the hash survives resizing, re-encoding
+    and small edits. Near-duplicates differ in a few bits.
+    
+    Returns:
+        int: Unsigned 64-bit hash
+    """
+    image.draft('L', (64, 64))
+    pixels = list(ImageOps.exif_transpose(image).convert('L').resize((9, 8), PILImage.LANCZOS).getdata())
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            value = (value << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return value
+
+
+def make_thumbnails(image, sizes, quality):
+    """
+    Encode the thumbnails of an image
+
+    Every size gets a WebP version and a fallback, JPEG for opaque images
+    and PNG for transparent ones.
+
+    Args:
+        image: Opened Pillow image
+        sizes: {size_name: longest side in pixels}
+        quality: Lossy encoder quality
+
+    Returns:
+        dict: {size_name: {'width', 'height', 'webp': (bytes, mime), 'fallback': (bytes, mime)}}
+    """
+    # Shrink while decoding when the format supports it (JPEG), then fix the orientation
+    image.draft('RGB', (max(sizes.values()),) * 2)
+    image = ImageOps.exif_transpose(image)
+    alpha = has_alpha(image)
+    image = image.convert('RGBA' if alpha else 'RGB')
+    fallback_format, fallback_mime = ('PNG', 'image/png') if alpha else ('JPEG', 'image/jpeg')
+
+    # Largest size first, so each smaller thumbnail is resized from the previous one
+    thumbnails = {}
+    for name, max_side in sorted(sizes.items(), key=lambda item: item[1], reverse=True):
+        image.thumbnail((max_side, max_side), PILImage.LANCZOS)
+        thumbnails[name] = {
+            'width': image.width,
+            'height': image.height,
+            'webp': (encode_thumbnail(image, 'WEBP', quality), 'image/webp'),
+            'fallback': (encode_thumbnail(image, fallback_format, quality), fallback_mime),
+        }
+    return thumbnails
+
+
+def file_sha256(path, chunk_size=64 * 1024):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def process_image_file(path, sizes, quality):
+    """
+    Do the CPU-heavy work for one stored original.
+
+    Runs in a worker process of the image processing pool, so it only
+    uses its arguments and returns plain data.
+
+    Returns:
+        dict: width, height, sha256, phash, stripped (bytes or None) and thumbnails
+    """
+    # The original is decoded from disk rather than read into memory first
+    with PILImage.open(path) as image:
+        stripped = strip_metadata(image)
+
+    if stripped is not None:
+        source, sha256 = BytesIO(stripped), hashlib.sha256(stripped).hexdigest()
+    else:
+        source, sha256 = path, file_sha256(path)
+    with PILImage.open(source) as image:
+        phash = difference_hash(image)
+    if stripped is not None:
+        source.seek(0)
+    with PILImage.open(source) as image:
+        width, height = image.size
+        thumbnails = make_thumbnails(image, sizes, quality)
+
+    return {
+        'width': width,
+        'height': height,
+        'sha256': sha256,
+        'phash': phash,
+        'stripped': stripped,
+        'thumbnails': thumbnails,
+    }
+
+
+def processing_args(image):
+    """Arguments of process_image_file for an Image record"""
+    return (
+        mega_handler.local_path(image.mega_url),
+        current_app.config.get('IMAGE_THUMBNAIL_SIZES', {'preview': 250, 'post': 500}),
+        current_app.config.get('IMAGE_THUMBNAIL_QUALITY', 80),
+    )
+
+
+def apply_processing_result(image, result):
+    """
+    Store the files produced by process_image_file and record them on the image
+
+    Returns:
+        list: File IDs replaced by the result, to release with file_deletion_queue.release
+    """
+    base_name = os.path.splitext(image.filename)[0]
+    replaced = []
+
+    if result['stripped'] is not None:
+        file_id, public_url = mega_handler.upload_file(result['stripped'], image.filename)
+        if not file_id:
+            raise IOError("Could not store stripped original")
+        replaced.append(image.mega_url)
+        image.mega_url, image.public_url = file_id, public_url
+        image.size_bytes = len(result['stripped'])
+
+    extensions = {'image/webp': 'webp', 'image/jpeg': 'jpg', 'image/png': 'png'}
+    thumbnails = {}
+    for name, thumbnail in result['thumbnails'].items():
+        thumbnails[name] = {'width': thumbnail['width'], 'height': thumbnail['height']}
+        for key in ('webp', 'fallback'):
+            data, mime = thumbnail[key]
+            file_id, public_url = mega_handler.upload_file(data, f"{base_name}_{name}.{extensions[mime]}")
+            if not file_id:
+                raise IOError(f"Could not store {name} thumbnail")
+            thumbnails[name][key] = {'file_id': file_id, 'url': public_url, 'bytes': len(data), 'mime': mime}
+
+    image.width, image.height = result['width'], result['height']
+    image.sha256 = result['sha256']
+    image.phash = to_signed64(result['phash'])
+    image.thumbnails = thumbnails
+    image.status = 'ready'
+    return replaced
+
+
+def store_image(file_storage):
+    """
+    Store an uploaded original; thumbnails are made later by the image processor
+
+    Args:
+        file_storage: Uploaded file from the form
+
+    Returns:
+        dict: Keyword arguments for a pending Image record, or None if storing failed
+    """
+    original_filename = secure_filename(file_storage.filename or '')
+    file_ext = os.path.splitext(original_filename)[1].lower()
+
+    # Trust the format sniffed from the file's first bytes over the client's file name
+    stream = file_storage.stream
+    if getattr(stream, 'rejected', False):
+        return None
+    if getattr(stream, 'image_format', None):
+        file_ext = FORMAT_EXTENSIONS[stream.image_format]
+    new_filename = f"{uuid.uuid4().hex}{file_ext}"
+
+    size_bytes = upload_size(file_storage)
+    mega_url, public_url = mega_handler.upload_file(file_storage, new_filename)
+    if not mega_url or not public_url:
+        return None
+
+    return {
+        'filename': new_filename,
+        'mega_url': mega_url,
+        'public_url': public_url,
+        'size_bytes': size_bytes,
+        'status': 'pending',
+    }
+
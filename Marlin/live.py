@@ -0,0 +1,102 @@
+import os
+import logging
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+class ThreadEvents:
+    """
+    Wakes up live thread streams when a thread gets new posts.
+
+    Streams in the same process are woken through a condition variable.
+    Streams in other gunicorn workers on the host watch a per-thread
+    signal file whose mtime the publisher bumps, so no worker has to
+    poll the database to find out that nothing happened.
+
+    Each stream holds a worker thread, so a process serves at most
+    max_streams of them at once and leaves its other threads to the
+    rest of the site.
+    """
+
+    def __init__(self):
+        self.directory = None
+        self.poll_interval = 1.0
+        self.max_streams = 16
+        self._cond = threading.Condition()
+        self._streams_lock = threading.Lock()
+        self._streams = 0
+
+    def init_app(self, app):
+        self.directory = app.config.get('LIVE_SIGNAL_DIR') or os.path.join(tempfile.gettempdir(), 'marlin-live')
+        self.poll_interval = app.config.get('LIVE_SIGNAL_POLL_SECONDS', 1.0)
+        self.max_streams = app.config.get('LIVE_MAX_STREAMS_PER_PROCESS', 16)
+        os.makedirs(self.directory, exist_ok=True)
+
+    def open_stream(self):
+        """
+        Take a stream slot of this process
+
+        Returns:
+            bool: False if every slot is taken
+        """
+        with self._streams_lock:
+            if self._streams >= self.max_streams:
+                return False
+            self._streams += 1
+            return True
+
+    def close_stream(self):
+        """Give back a slot taken by open_stream"""
+        with self._streams_lock:
+            self._streams -= 1
+
+    def version(self, thread_id):
+        """Current signal version of a thread, 0 if it never published"""
+        try:
+            return os.stat(self._path(thread_id)).st_mtime_ns
+        except FileNotFoundError:
+            return 0
+
+    def publish(self, thread_id):
+        """Signal every stream watching the thread"""
+        try:
+            path = self._path(thread_id)
+            with open(path, 'a'):
+                pass
+            os.utime(path, ns=(time.time_ns(), time.time_ns()))
+        except OSError as e:
+            logger.error(f"Error publishing thread event: {str(e)}")
+
+        with self._cond:
+            self._cond.notify_all()
+
+    def wait(self, thread_id, version, timeout):
+        """
+        Block until the thread's version differs from version, or timeout
+
+        Returns:
+            int: The thread's current version
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            current = self.version(thread_id)
+            remaining = deadline - time.monotonic()
+            if current != version or remaining <= 0:
+                return current
+            with self._cond:
+                self._cond.wait(min(self.poll_interval, remaining))
+
+    def discard(self, thread_id):
+        """Remove the signal file of a deleted thread"""
+        try:
+            os.remove(self._path(thread_id))
+        except OSError:
+            pass
+
+    def _path(self, thread_id):
+        return os.path.join(self.directory, f'thread-{int(thread_id)}')
+
+# Create a singleton instance
+thread_events = ThreadEvents()
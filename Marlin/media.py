@@ -0,0 +1,69 @@
+import os
+import mimetypes
+from flask import Blueprint, current_app, abort, redirect, send_file, make_response, url_for
+from werkzeug.security import safe_join
+from mega_utils import mega_handler
+from storage import IMMUTABLE_CACHE_CONTROL
+
+media_bp = Blueprint('media', __name__)
+
+# Long enough to count as "forever" for caches; stored files never change under the same name
+MEDIA_MAX_AGE_SECONDS = 365 * 24 * 3600
+
+
+@media_bp.route('/media/<path:relative_path>')
+def serve_media(relative_path):
+    """
+    Serve a stored file.
+
+    File names are content hashes, so responses are cacheable forever.
+    Depending on MEDIA_SENDFILE_MODE the bytes are handed to the front
+    proxy (X-Accel-Redirect for nginx, X-Sendfile for Apache/lighttpd)
+    or sent with send_file, which answers Range and conditional requests
+    and lets the WSGI server use sendfile().
+    """
+    storage = mega_handler.get_storage()
+    file_id = os.path.basename(relative_path)
+
+    root = getattr(storage, 'root', None)
+    if root is None:
+        # Remote backends serve their own files
+        return redirect(storage.url(file_id), code=301)
+
+    if relative_path.startswith('tmp/') or relative_path.endswith('.part'):
+        abort(404)
+    path = safe_join(root, relative_path)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+
+    mode = current_app.config.get('MEDIA_SENDFILE_MODE', 'none')
+    if mode in ('x-accel-redirect', 'x-sendfile'):
+        response = make_response('')
+        if mode == 'x-accel-redirect':
+            prefix = current_app.config.get('MEDIA_ACCEL_REDIRECT_PREFIX', '/_media/')
+            response.headers['X-Accel-Redirect'] = prefix.rstrip('/') + '/' + relative_path
+        else:
+            response.headers['X-Sendfile'] = path
+        response.mimetype = mimetypes.guess_type(file_id)[0] or 'application/octet-stream'
+    else:
+        response = send_file(
+            path,
+            conditional=True,  # Range, If-None-Match and If-Modified-Since
+            etag=os.path.splitext(file_id)[0],
+            max_age=MEDIA_MAX_AGE_SECONDS,
+        )
+
+    response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+    return response
+
+
+@media_bp.route('/static/uploads/<path:relative_path>')
+def legacy_upload(relative_path):
+    """Redirect URLs from when uploads were served out of static/ to the file's current URL"""
+    storage = mega_handler.get_storage()
+    file_id = os.path.basename(relative_path)
+
+    if getattr(storage, 'root', None) is not None and not os.path.isfile(storage.path(file_id)):
+        # Not moved into its shard (yet), so the old relative path still finds it
+        return redirect(url_for('media.serve_media', relative_path=relative_path))
+    return redirect(storage.url(file_id), code=301)
@@ -1,18 +1,47 @@
 import os
 import logging
 import tempfile
+import hashlib
+import mimetypes
 import requests
-import uuid
 import json
+import click
+from collections import Counter
 from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import select, update, delete, bindparam
+from sqlalchemy.dialects import postgresql, sqlite
+from storage import create_storage, ShardedLocalStorage
+
+# Read size when hashing uploaded files
+CHUNK_SIZE = 64 * 1024
+
+# Session.info key listing the blobs written during the current transaction
+STORED_FILES_KEY = 'marlin_stored_files'
 
 logger = logging.getLogger(__name__)
 
 class MegaHandler:
+    """
+    Stores uploaded files.
+    
+    Reference counting lives here; where the bytes go is up to the storage
+    backend chosen by STORAGE_BACKEND (see storage.py).
+    """
     def __init__(self):
         self.logged_in = False
         self.email = None
         self.password = None
+        self.storage = None
+    
+    def init_app(self, app):
+        self.storage = create_storage(app.config, app.root_path, app.instance_path)
+        logger.info(f"Storage backend: {type(self.storage).__name__}")
+    
+    def get_storage(self):
+        if self.storage is None:
+            self.storage = create_storage(current_app.config, current_app.root_path, current_app.instance_path)
+        return self.storage
     
     def login(self):
         """Login to Mega.nz using REST API"""
@@ -44,9 +73,18 @@ class MegaHandler:
         """
         Store a file and return URLs
         
+        Files are stored under the SHA-256 of their content, so identical
+        uploads share one blob. Each call adds a reference to the blob in
+        the current database transaction; release_files drops it again.
+        A blob written for a transaction that doesn't commit is queued for
+        deletion (see file_deletions.py).
+        
+        Uploads spooled by uploads.StreamedUpload were already hashed while
+        they were received and are renamed into place without a copy.
+        
         Args:
-            file_obj: File-like object to upload
-            filename: Name to give the file
+            file_obj: Uploaded file (anything with a stream) or bytes
+            filename: Name to give the file, only its extension is kept
             
         Returns:
             tuple: (file_id, public_url)
@@ -55,54 +93,243 @@ class MegaHandler:
             logger.error("Cannot upload file: Storage credentials not available")
             return None, None
         
+        storage = self.get_storage()
+        temp_path = None
         try:
-            # Create a unique filename to avoid collisions
-            unique_id = str(uuid.uuid4())
-            extension = os.path.splitext(filename)[1].lower()
-            file_id = f"{unique_id}{extension}"
-            
-            # Save file to static folder
-            static_folder = os.path.join(current_app.root_path, 'static', 'uploads')
-            os.makedirs(static_folder, exist_ok=True)
+            stream = getattr(file_obj, 'stream', None)
+            if hasattr(stream, 'sha256'):
+                sha256, size_bytes = stream.sha256, stream.size
+                temp_path = stream.detach()
+            else:
+                temp_path, sha256, size_bytes = self._spool(file_obj, storage.spool_folder())
             
-            file_path = os.path.join(static_folder, file_id)
-            logger.info(f"Saving file to: {file_path}")
+            extension = os.path.splitext(filename)[1].lower()
+            file_id = f"{sha256}{extension}"
+            refcount = self._add_reference(file_id, size_bytes)
             
-            file_obj.save(file_path)
+            # Only the first copy is kept; the reference row is locked until the commit,
+            # so the deletion queue won't remove the blob while this transaction runs
+            if refcount > 1 and storage.exists(file_id):
+                os.remove(temp_path)
+                logger.info(f"Reusing stored file {file_id} ({refcount} references)")
+            else:
+                storage.save(temp_path, file_id, mimetypes.guess_type(filename)[0])
+                self._track_stored(file_id)
+                logger.info(f"Stored file {file_id}")
+            temp_path = None
             
             # Generate a public URL for embedding
-            public_url = f"/static/uploads/{file_id}"
-            
-            logger.info(f"Successfully stored file: {public_url}")
+            public_url = storage.url(file_id)
             return file_id, public_url
         except Exception as e:
             logger.error(f"Error storing file: {str(e)}")
             return None, None
+        finally:
+            if temp_path and os.path.exists(temp_path):
+                os.remove(temp_path)
+    
+    def _track_stored(self, file_id):
+        """Remember a blob written during the current transaction"""
+        from app import db
+        
+        db.session.info.setdefault(STORED_FILES_KEY, []).append(file_id)
+    
+    def _spool(self, file_obj, directory):
+        """
+        Copy a file to a temporary file next to the blobs, hashing it on the way
+        
+        Returns:
+            tuple: (temporary path, SHA-256 hex digest, size in bytes)
+        """
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.part')
+        digest = hashlib.sha256()
+        size_bytes = 0
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                if isinstance(file_obj, bytes):
+                    chunks = [file_obj]
+                else:
+                    file_obj.stream.seek(0)
+                    chunks = iter(lambda: file_obj.stream.read(CHUNK_SIZE), b'')
+                for chunk in chunks:
+                    digest.update(chunk)
+                    size_bytes += len(chunk)
+                    f.write(chunk)
+        except Exception:
+            os.remove(temp_path)
+            raise
+        return temp_path, digest.hexdigest(), size_bytes
+    
+    def _add_reference(self, file_id, size_bytes):
+        """
+        Count a new reference to a blob with a single upsert
+        
+        Returns:
+            int: The blob's reference count including this one
+        """
+        # Imported here: the image processing workers import this module without the app
+        from app import db
+        from models import StoredFile
+        
+        files = StoredFile.__table__
+        dialect = db.engine.dialect.name
+        if dialect in ('postgresql', 'sqlite'):
+            dialect_insert = postgresql.insert if dialect == 'postgresql' else sqlite.insert
+            stmt = dialect_insert(files).values(
+                file_id=file_id, size_bytes=size_bytes, refcount=1
+            ).on_conflict_do_update(
+                index_elements=[files.c.file_id], set_={'refcount': files.c.refcount + 1}
+            ).returning(files.c.refcount)
+            return db.session.execute(stmt).scalar_one()
+        
+        refcount = db.session.execute(
+            update(files).where(files.c.file_id == file_id).values(
+                refcount=files.c.refcount + 1
+            ).returning(files.c.refcount)
+        ).scalar()
+        if refcount is None:
+            db.session.add(StoredFile(file_id=file_id, size_bytes=size_bytes, refcount=1))
+            db.session.flush()
+            refcount = 1
+        return refcount
+    
+    def hold_unreferenced(self, file_id):
+        """
+        Take the reference row of a file nothing uses, before deleting it
+        
+        Inserts a row with no references in the current transaction. An
+        upload of the same content conflicts with it and waits for the
+        commit, then finds the blob gone and stores it again; until then
+        the blob can be removed safely. The caller deletes the row again
+        in the same transaction.
+        
+        Returns:
+            bool: False if the file is in use again
+        """
+        from app import db
+        from models import StoredFile
+        
+        files = StoredFile.__table__
+        dialect = db.engine.dialect.name
+        if dialect in ('postgresql', 'sqlite'):
+            dialect_insert = postgresql.insert if dialect == 'postgresql' else sqlite.insert
+            stmt = dialect_insert(files).values(
+                file_id=file_id, refcount=0
+            ).on_conflict_do_nothing(
+                index_elements=[files.c.file_id]
+            ).returning(files.c.file_id)
+            return db.session.execute(stmt).scalar() is not None
+        
+        refcount = db.session.execute(
+            select(files.c.refcount).where(files.c.file_id == file_id).with_for_update()
+        ).scalar()
+        if refcount is not None:
+            return refcount <= 0
+        db.session.add(StoredFile(file_id=file_id, refcount=0))
+        db.session.flush()
+        return True
+    
+    def spool_folder(self):
+        """Folder for uploads being received, from which they are moved into storage"""
+        return self.get_storage().spool_folder()
     
-    def delete_file(self, file_id):
+    def local_path(self, file_id):
         """
-        Delete a file
+        Path of a stored file on the local filesystem
         
         Args:
             file_id: The file ID
             
         Returns:
-            bool: Success or failure
+            str: Absolute file path; a downloaded copy for remote backends
         """
-        try:
-            static_folder = os.path.join(current_app.root_path, 'static', 'uploads')
-            file_path = os.path.join(static_folder, file_id)
+        return self.get_storage().local_path(file_id)
+    
+    def release_local_path(self, file_id):
+        """Drop the downloaded copy local_path may have made"""
+        self.get_storage().evict(file_id)
+    
+    def release_files(self, file_ids):
+        """
+        Drop references to many files with set-based statements
+        
+        The reference counts are changed in the current database
+        transaction. Files are not removed from storage here; the caller
+        queues the returned IDs (see file_deletions.py), so slow storage
+        calls don't run while the transaction holds its locks.
+        
+        Args:
+            file_ids: File IDs, once per reference dropped
+        
+        Returns:
+            list: IDs of the files nothing uses any more
+        """
+        from app import db
+        from models import StoredFile
+        
+        counts = Counter(file_ids)
+        if not counts:
+            return []
+        
+        files = StoredFile.__table__
+        tracked = set(db.session.execute(
+            select(files.c.file_id).where(files.c.file_id.in_(counts))
+        ).scalars())
+        if tracked:
+            db.session.execute(
+                update(files).where(files.c.file_id == bindparam('released_id')).values(
+                    refcount=files.c.refcount - bindparam('released')
+                ),
+                [{'released_id': file_id, 'released': counts[file_id]} for file_id in tracked]
+            )
+            freed = db.session.execute(
+                delete(files).where(
+                    files.c.file_id.in_(tracked), files.c.refcount <= 0
+                ).returning(files.c.file_id)
+            ).scalars().all()
+        else:
+            freed = []
+        
+        # Files stored before deduplication have no reference row
+        return freed + [file_id for file_id in counts if file_id not in tracked]
+
+@click.command('shard-uploads')
+@click.option('--batch-size', default=500, help='Images moved per commit.')
+@with_appcontext
+def shard_uploads_command(batch_size):
+    """Move files from the flat uploads folder into the sharded layout."""
+    from app import db
+    from models import Image
+    
+    storage = mega_handler.get_storage()
+    if not isinstance(storage, ShardedLocalStorage):
+        raise click.ClickException("STORAGE_BACKEND is not 'sharded'")
+    
+    moved = 0
+    last_id = 0
+    while True:
+        images = Image.query.filter(Image.id > last_id).order_by(Image.id).limit(batch_size).all()
+        if not images:
+            break
+        
+        for image in images:
+            for file_id in image.file_ids():
+                moved += storage.migrate(file_id)
             
-            if os.path.exists(file_path):
-                logger.info(f"Deleting file: {file_path}")
-                os.remove(file_path)
-                return True
-            else:
-                logger.warning(f"File not found for deletion: {file_path}")
-                return False
-        except Exception as e:
-            logger.error(f"Error deleting file: {str(e)}")
-            return False
+            # Point the stored URLs at the new locations
+            if image.mega_url:
+                image.public_url = storage.url(image.mega_url)
+            if image.thumbnails:
+                thumbnails = {}
+                for name, thumbnail in image.thumbnails.items():
+                    thumbnails[name] = dict(thumbnail)
+                    for key in ('webp', 'fallback'):
+                        thumbnails[name][key] = dict(thumbnail[key], url=storage.url(thumbnail[key]['file_id']))
+                image.thumbnails = thumbnails
+        last_id = images[-1].id
+        db.session.commit()
+    
+    click.echo(f"Moved {moved} files into shards.")
 
 # Create a singleton instance
 mega_handler = MegaHandler()
\ No newline at end of file
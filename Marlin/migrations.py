@@ -0,0 +1,99 @@
+import logging
+from datetime import datetime
+from sqlalchemy import inspect, text, update
+from app import db
+
+logger = logging.getLogger(__name__)
+
+def add_missing_columns():
+    """
+    Add columns that exist on the models but not in the database.
+    
+    db.create_all() only creates missing tables, so new columns on existing
+    tables have to be added here. Columns already present are skipped.
+    
+    Returns:
+        set: Names of the added columns as "table.column"
+    """
+    inspector = inspect(db.engine)
+    preparer = db.engine.dialect.identifier_preparer
+    ddl_compiler = db.engine.dialect.ddl_compiler(db.engine.dialect, None)
+    added = set()
+    
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            
+            column_type = column.type.compile(dialect=db.engine.dialect)
+            ddl = f"ALTER TABLE {preparer.quote(table.name)} ADD COLUMN {preparer.quote(column.name)} {column_type}"
+            default = ddl_compiler.get_column_default_string(column)
+            if default is not None:
+                # Rendered as in CREATE TABLE: string defaults become quoted literals
+                ddl += f" DEFAULT {default}"
+            
+            logger.info(f"Adding column {table.name}.{column.name}")
+            db.session.execute(text(ddl))
+            added.add(f"{table.name}.{column.name}")
+    
+    db.session.commit()
+    return added
+
+
+def create_missing_indexes():
+    """
+    Create indexes declared on the models that are missing from the database.
+    
+    Returns:
+        set: Names of the created indexes
+    """
+    inspector = inspect(db.engine)
+    created = set()
+    
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name in existing:
+                continue
+            
+            logger.info(f"Creating index {index.name} on {table.name}")
+            index.create(db.engine, checkfirst=True)
+            created.add(index.name)
+    
+    return created
+
+
+def upgrade_schema():
+    """
+    Bring an existing database up to date with the models.
+    
+    Every step checks the live schema first, so this is safe to run on
+    every start.
+    """
+    added = add_missing_columns()
+    create_missing_indexes()
+    
+    # Backfill the denormalized thread counters the first time they appear
+    if added & {'threads.reply_count', 'threads.image_count', 'threads.last_post_at'}:
+        from tasks import refresh_thread_counters
+        logger.info("Backfilling thread counters")
+        refresh_thread_counters()
+        db.session.commit()
+    
+    # Seed the conditional GET markers the first time they appear
+    if 'boards.last_modified_at' in added:
+        from models import Board
+        db.session.execute(update(Board.__table__).values(last_modified_at=datetime.utcnow()))
+        db.session.commit()
+    if 'threads.last_modified_at' in added:
+        from models import Thread
+        threads = Thread.__table__
+        db.session.execute(update(threads).values(last_modified_at=threads.c.updated_at, updated_at=threads.c.updated_at))
+        db.session.commit()
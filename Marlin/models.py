@@ -35,6 +35,7 @@ class Board(db.Model):
     category = db.Column(db.String(64), nullable=False)
     nsfw = db.Column(db.Boolean, default=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    last_modified_at = db.Column(db.DateTime, default=datetime.utcnow)  # Validator for conditional GETs of the board page
     
     threads = db.relationship('Thread', backref='board', lazy='dynamic', cascade='all, delete-orphan')
     
@@ -44,6 +45,12 @@ class Board(db.Model):
 
 class Thread(db.Model):
     __tablename__ = 'threads'
+    __table_args__ = (
+        db.Index('ix_threads_board_bump', 'board_id', 'sticky', 'updated_at'),
+        db.Index('ix_threads_board_created', 'board_id', 'created_at'),
+        db.Index('ix_threads_board_upvotes', 'board_id', 'upvotes'),
+        db.Index('ix_threads_upvotes', 'upvotes'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     subject = db.Column(db.String(128))
@@ -55,6 +62,12 @@ class Thread(db.Model):
     sticky = db.Column(db.Boolean, default=False)
     locked = db.Column(db.Boolean, default=False)
     
+    # Denormalized aggregates, maintained on write and rebuilt by the repair-thread-counters command
+    reply_count = db.Column(db.Integer, default=0, server_default='0')
+    image_count = db.Column(db.Integer, default=0, server_default='0')
+    last_post_at = db.Column(db.DateTime, default=datetime.utcnow)
+    last_modified_at = db.Column(db.DateTime, default=datetime.utcnow)  # Validator for conditional GETs of the thread page
+    
     posts = db.relationship('Post', backref='thread', lazy='dynamic', cascade='all, delete-orphan')
     
     def __repr__(self):
@@ -63,6 +76,10 @@ class Thread(db.Model):
 
 class Post(db.Model):
     __tablename__ = 'posts'
+    __table_args__ = (
+        db.Index('ix_posts_thread_created', 'thread_id', 'created_at'),
+        db.Index('ix_posts_thread_id_id', 'thread_id', 'id'),  # For posts newer than an ID in a thread
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     content = db.Column(db.Text, nullable=False)
@@ -80,6 +97,9 @@ class Post(db.Model):
 
 class Image(db.Model):
     __tablename__ = 'images'
+    __table_args__ = (
+        db.Index('ix_images_post_id', 'post_id'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     filename = db.Column(db.String(256), nullable=False)
@@ -88,12 +108,126 @@ class Image(db.Model):
     post_id = db.Column(db.Integer, db.ForeignKey('posts.id'), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
+    # 'pending' until the image processor has made the thumbnails, then 'ready' or 'failed'
+    status = db.Column(db.String(16), default='ready', server_default='ready')
+    sha256 = db.Column(db.String(64))
+    
+    # Perceptual hash (dHash) as a signed 64-bit integer, and the earlier image it nearly duplicates
+    phash = db.Column(db.BigInteger)
+    duplicate_of = db.Column(db.Integer)
+    
+    # Original dimensions and size, and the generated thumbnails keyed by size name
+    width = db.Column(db.Integer)
+    height = db.Column(db.Integer)
+    size_bytes = db.Column(db.Integer)
+    thumbnails = db.Column(db.JSON)
+    
+    jobs = db.relationship('ImageJob', backref='image', lazy='dynamic', cascade='all, delete-orphan')
+    
+    def thumbnail(self, size):
+        """Thumbnail info for a size name, or None for images without thumbnails"""
+        return (self.thumbnails or {}).get(size)
+    
+    def file_ids(self):
+        """IDs of every stored file of this image, original first"""
+        return Image.stored_file_ids(self.mega_url, self.thumbnails)
+    
+    @staticmethod
+    def stored_file_ids(mega_url, thumbnails):
+        """file_ids from the column values, for queries that don't load Image objects"""
+        file_ids = [mega_url] if mega_url else []
+        for thumbnail in (thumbnails or {}).values():
+            file_ids.extend(thumbnail[key]['file_id'] for key in ('webp', 'fallback'))
+        return file_ids
+    
     def __repr__(self):
         return f'<Image {self.id} in Post {self.post_id}>'
 
 
+class ImageJob(db.Model):
+    """Processing job of an uploaded image; removed once the image is ready"""
+    __tablename__ = 'image_jobs'
+    __table_args__ = (
+        db.Index('ix_image_jobs_status_updated', 'status', 'updated_at'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    image_id = db.Column(db.Integer, db.ForeignKey('images.id'), nullable=False)
+    status = db.Column(db.String(16), default='queued')  # queued, running or failed
+    attempts = db.Column(db.Integer, default=0)
+    error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<ImageJob {self.id} for Image {self.image_id}>'
+
+
+class BannedImage(db.Model):
+    """Perceptual hash of an image moderators have banned"""
+    __tablename__ = 'banned_images'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    phash = db.Column(db.BigInteger, nullable=False)
+    reason = db.Column(db.String(256))
+    created_by = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<BannedImage {self.id}>'
+
+
+class StoredFile(db.Model):
+    """A content-addressed blob in storage and the number of records using it"""
+    __tablename__ = 'stored_files'
+    
+    file_id = db.Column(db.String(80), primary_key=True)  # SHA-256 of the content plus the extension
+    size_bytes = db.Column(db.Integer)
+    refcount = db.Column(db.Integer, nullable=False, default=1)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<StoredFile {self.file_id} x{self.refcount}>'
+
+
+class FileDeletion(db.Model):
+    """A stored file waiting to be removed from storage by the file deletion queue"""
+    __tablename__ = 'file_deletions'
+    __table_args__ = (
+        db.Index('ix_file_deletions_not_before', 'not_before'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    file_id = db.Column(db.String(80), nullable=False)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    not_before = db.Column(db.DateTime, default=datetime.utcnow)  # Due time; pushed back while claimed or after a failure
+    error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<FileDeletion {self.id} of {self.file_id}>'
+
+
+class TaskCheckpoint(db.Model):
+    """Where a batched background task stopped, so its next run can resume there"""
+    __tablename__ = 'task_checkpoints'
+    
+    name = db.Column(db.String(64), primary_key=True)
+    last_id = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<TaskCheckpoint {self.name} at {self.last_id}>'
+
+
 class Vote(db.Model):
     __tablename__ = 'votes'
+    __table_args__ = (
+        db.Index('ix_votes_user_thread', 'user_id', 'thread_id'),
+        db.Index('ix_votes_user_post', 'user_id', 'post_id'),
+        db.Index('ix_votes_thread_id', 'thread_id'),  # For deleting threads' votes in bulk
+        db.Index('ix_votes_post_id', 'post_id'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
@@ -112,6 +246,9 @@ class Vote(db.Model):
 
 class CaptchaToken(db.Model):
     __tablename__ = 'captcha_tokens'
+    __table_args__ = (
+        db.Index('ix_captcha_tokens_token_used', 'token', 'used'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     token = db.Column(db.String(64), unique=True, nullable=False)
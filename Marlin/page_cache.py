@@ -0,0 +1,295 @@
+import os
+import json
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from datetime import datetime
+from flask import g, request, session, render_template, make_response
+from flask_login import current_user
+from flask_wtf.csrf import generate_csrf
+from conditional import is_not_modified, not_modified, add_validators
+
+logger = logging.getLogger(__name__)
+
+# Stands in for the per-session CSRF token inside cached HTML
+CSRF_PLACEHOLDER = '__marlin_csrf_token__'
+
+
+class MemoryCacheBackend:
+    """Size-bounded LRU cache private to one worker process"""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (expires_at, value, tags)
+        self._keys_by_tag = defaultdict(set)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.time():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value, ttl, tags):
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (time.time() + ttl, value, tags)
+            for tag in tags:
+                self._keys_by_tag[tag].add(key)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, tags):
+        with self._lock:
+            for tag in tags:
+                for key in list(self._keys_by_tag.get(tag, ())):
+                    self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._keys_by_tag.clear()
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        for tag in entry[2]:
+            keys = self._keys_by_tag.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._keys_by_tag[tag]
+
+
+class SharedCacheBackend:
+    """
+    Cache shared by every worker on the host.
+
+    Entries live in an SQLite file, on tmpfs (/dev/shm) by default, so it
+    behaves like shared memory. Invalidations made by one worker are seen
+    by all of them. Reads never write, so cache hits don't contend for
+    SQLite's write lock; entries over the size limit are evicted oldest
+    first rather than least recently used.
+    """
+
+    def __init__(self, path, max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        self._local = threading.local()
+
+    def get(self, key):
+        conn = self._connect()
+        row = conn.execute(
+            'SELECT value, expires_at FROM cache_entries WHERE key = ?', (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        if row[1] < time.time():
+            return None
+        return row[0]
+
+    def set(self, key, value, ttl, tags):
+        conn = self._connect()
+        now = time.time()
+        with conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO cache_entries (key, value, expires_at) VALUES (?, ?, ?)',
+                (key, value, now + ttl)
+            )
+            conn.execute('DELETE FROM cache_tags WHERE key = ?', (key,))
+            conn.executemany('INSERT INTO cache_tags (tag, key) VALUES (?, ?)', [(tag, key) for tag in tags])
+            self._evict(conn, now)
+
+    def invalidate(self, tags):
+        conn = self._connect()
+        placeholders = ', '.join('?' for _ in tags)
+        with conn:
+            keys = f'SELECT key FROM cache_tags WHERE tag IN ({placeholders})'
+            conn.execute(f'DELETE FROM cache_entries WHERE key IN ({keys})', list(tags))
+            conn.execute(f'DELETE FROM cache_tags WHERE key IN ({keys})', list(tags))
+
+    def clear(self):
+        conn = self._connect()
+        with conn:
+            conn.execute('DELETE FROM cache_entries')
+            conn.execute('DELETE FROM cache_tags')
+
+    def _evict(self, conn, now):
+        """Drop expired entries, then the ones expiring soonest over the size limit"""
+        conn.execute('DELETE FROM cache_entries WHERE expires_at < ?', (now,))
+        overflow = conn.execute('SELECT COUNT(*) FROM cache_entries').fetchone()[0] - self.max_entries
+        if overflow > 0:
+            conn.execute(
+                'DELETE FROM cache_entries WHERE key IN '
+                '(SELECT key FROM cache_entries ORDER BY expires_at LIMIT ?)',
+                (overflow,)
+            )
+        conn.execute('DELETE FROM cache_tags WHERE key NOT IN (SELECT key FROM cache_entries)')
+
+    def _connect(self):
+        # One connection per thread, reopened after a fork
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+
+        conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=OFF')
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS cache_entries '
+            '(key TEXT PRIMARY KEY, value TEXT, expires_at REAL)'
+        )
+        conn.execute('CREATE TABLE IF NOT EXISTS cache_tags (tag TEXT, key TEXT)')
+        conn.execute('CREATE INDEX IF NOT EXISTS ix_cache_tags_tag ON cache_tags (tag)')
+        conn.execute('CREATE INDEX IF NOT EXISTS ix_cache_tags_key ON cache_tags (key)')
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+
+
+class PageCache:
+    """
+    Cache of rendered pages for anonymous visitors.
+
+    Entries are tagged with the boards and threads they show, so the
+    write paths can invalidate exactly the pages they change.
+    """
+
+    def __init__(self):
+        self.backend = None
+        self.ttl = 30
+
+    def init_app(self, app):
+        backend = app.config.get('PAGE_CACHE_BACKEND', 'shared')
+        max_entries = app.config.get('PAGE_CACHE_MAX_ENTRIES', 2000)
+        self.ttl = app.config.get('PAGE_CACHE_TTL_SECONDS', 30)
+
+        if backend == 'memory':
+            self.backend = MemoryCacheBackend(max_entries)
+        elif backend == 'shared':
+            path = app.config.get('PAGE_CACHE_PATH')
+            if not path:
+                # One file per database, so deployments sharing the host don't serve each other's pages
+                database = hashlib.sha256(app.config['SQLALCHEMY_DATABASE_URI'].encode()).hexdigest()[:16]
+                folder = '/dev/shm' if os.path.isdir('/dev/shm') else app.instance_path
+                os.makedirs(folder, exist_ok=True)
+                path = os.path.join(folder, f'marlin-page-cache-{database}.sqlite')
+            self.backend = SharedCacheBackend(path, max_entries)
+        else:
+            self.backend = None
+        logger.info(f"Page cache backend: {backend}")
+
+    def is_cacheable(self):
+        """Only anonymous GETs without pending flash messages share pages"""
+        return (
+            self.backend is not None
+            and request.method == 'GET'
+            and not current_user.is_authenticated
+            and '_flashes' not in session
+        )
+
+    def get(self, key):
+        """
+        Get a cached page as a response, or None on a miss
+
+        Answers with 304 when the request's validators still match the
+        cached page.
+        """
+        try:
+            entry = self.backend.get(key)
+        except Exception as e:
+            logger.error(f"Error reading page cache: {str(e)}")
+            return None
+        if entry is None:
+            return None
+
+        entry = json.loads(entry)
+        validators = None
+        if entry['etag']:
+            validators = (entry['etag'], datetime.fromisoformat(entry['last_modified']))
+            if is_not_modified(validators):
+                return not_modified(validators)
+
+        html = entry['html']
+        if CSRF_PLACEHOLDER in html:
+            html = html.replace(CSRF_PLACEHOLDER, generate_csrf())
+        return add_validators(make_response(html), validators)
+
+    def render(self, key, tags, template, validators=None, **context):
+        """Render a template, store it under key, and return the page as a response"""
+        html = render_template(template, **context)
+
+        # Store a placeholder instead of this session's CSRF token
+        token = g.get('csrf_token')
+        entry = {
+            'html': html.replace(token, CSRF_PLACEHOLDER) if token else html,
+            'etag': validators[0] if validators else None,
+            'last_modified': validators[1].isoformat() if validators else None,
+        }
+
+        try:
+            self.backend.set(key, json.dumps(entry), self.ttl, tags)
+        except Exception as e:
+            logger.error(f"Error writing page cache: {str(e)}")
+        return add_validators(make_response(html), validators)
+
+    def load(self, key):
+        """Get a raw cached value, or None on a miss or when caching is off"""
+        if self.backend is None:
+            return None
+        try:
+            return self.backend.get(key)
+        except Exception as e:
+            logger.error(f"Error reading page cache: {str(e)}")
+            return None
+
+    def store(self, key, tags, value):
+        """Cache a raw string value under key"""
+        if self.backend is None:
+            return
+        try:
+            self.backend.set(key, value, self.ttl, tags)
+        except Exception as e:
+            logger.error(f"Error writing page cache: {str(e)}")
+
+    def invalidate(self, *tags):
+        """Drop every cached page carrying one of the tags"""
+        if self.backend is None or not tags:
+            return
+        try:
+            self.backend.invalidate(tags)
+        except Exception as e:
+            logger.error(f"Error invalidating page cache: {str(e)}")
+
+    def clear(self):
+        """Drop every cached page"""
+        if self.backend is None:
+            return
+        try:
+            self.backend.clear()
+        except Exception as e:
+            logger.error(f"Error clearing page cache: {str(e)}")
+
+
+def board_tag(board_id):
+    return f'board:{board_id}'
+
+
+def thread_tag(thread_id):
+    return f'thread:{thread_id}'
+
+
+# Tag for pages listing boards or popular threads across all boards
+INDEX_TAG = 'index'
+
+# Create a singleton instance
+page_cache = PageCache()
@@ -2,4 +2,10 @@
 
 # Run database migrations and start the application
 python -c "from app import app, db; db.create_all()"
-exec gunicorn -b 0.0.0.0:${PORT:-5000} main:app
\ No newline at end of file
+
+# Threaded workers: every reader of a thread holds a live update stream open
+# (LIVE_STREAM_MAX_SECONDS), which would take a whole sync worker each. Each
+# process serves at most LIVE_MAX_STREAMS_PER_PROCESS streams (16), so keep
+# GUNICORN_THREADS above that; readers past the cap poll instead.
+# gunicorn reads the number of processes from WEB_CONCURRENCY.
+exec gunicorn -b 0.0.0.0:${PORT:-5000} --worker-class gthread --threads ${GUNICORN_THREADS:-32} main:app
\ No newline at end of file
@@ -0,0 +1,139 @@
+import os
+import logging
+import threading
+from sqlalchemy import text
+from app import db
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+class SchedulerLock:
+    """
+    Elects the one process that runs the shared scheduled jobs.
+
+    Every process scheduling the shared jobs competes for the same lock
+    whenever one of them is due; the process that gets it keeps it and
+    runs them, the others skip them. If the leader dies its lock is
+    released and the next process to try takes over.
+
+    On PostgreSQL the lock is a session advisory lock held on a dedicated
+    connection, so it spans nodes and the server drops it along with the
+    connection. Elsewhere (SQLite) it is an flock on a lock file, which
+    covers the processes of one host, all an SQLite database can serve.
+    """
+
+    def __init__(self):
+        self.backend = 'none'
+        self.key = None
+        self.path = None
+        self._lock = threading.Lock()
+        self._connection = None
+        self._file = None
+        self._pid = None
+
+    def init_app(self, app):
+        backend = app.config.get('SCHEDULER_LOCK', 'auto')
+        if backend == 'auto':
+            backend = 'postgres' if db.engine.dialect.name == 'postgresql' else 'file'
+        if backend == 'file' and fcntl is None:
+            logger.warning("File locks are not supported here, every process will run the shared jobs")
+            backend = 'none'
+
+        self.backend = backend
+        self.key = app.config.get('SCHEDULER_LOCK_KEY', 0x4d61726c696e)
+        self.path = app.config.get('SCHEDULER_LOCK_FILE') or os.path.join(app.instance_path, 'scheduler.lock')
+        if backend == 'file':
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+    def is_leader(self):
+        """
+        Whether this process holds the lock, taking it if it is free
+
+        Needs an app context for the PostgreSQL backend.
+        """
+        with self._lock:
+            if self._pid != os.getpid():
+                # Forked: the handles belong to the parent process
+                self._connection = self._file = None
+                self._pid = os.getpid()
+
+            if self.backend == 'postgres':
+                return self._hold_advisory_lock()
+            if self.backend == 'file':
+                return self._hold_file_lock()
+            return True
+
+    def _hold_advisory_lock(self):
+        if self._connection is not None:
+            try:
+                self._connection.execute(text('SELECT 1'))
+                return True
+            except Exception as e:
+                # The server released the lock with the connection
+                logger.warning(f"Lost the scheduler lock connection: {str(e)}")
+                self._close_connection()
+
+        connection = db.engine.connect().execution_options(isolation_level='AUTOCOMMIT')
+        try:
+            acquired = connection.execute(
+                text('SELECT pg_try_advisory_lock(:key)'), {'key': self.key}
+            ).scalar()
+        except Exception:
+            connection.close()
+            raise
+
+        if not acquired:
+            connection.close()
+            return False
+        self._connection = connection
+        logger.info(f"Process {os.getpid()} is now the scheduler leader")
+        return True
+
+    def _hold_file_lock(self):
+        if self._file is not None:
+            return True
+
+        lock_file = open(self.path, 'a+')
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+
+        # Record the holder for whoever looks at the file
+        lock_file.seek(0)
+        lock_file.truncate()
+        lock_file.write(f"{os.getpid()}\n")
+        lock_file.flush()
+        self._file = lock_file
+        logger.info(f"Process {os.getpid()} is now the scheduler leader")
+        return True
+
+    def _close_connection(self):
+        try:
+            self._connection.close()
+        except Exception:
+            pass
+        self._connection = None
+
+    def release(self):
+        """Give up the lock, e.g. when shutting down"""
+        with self._lock:
+            if self._pid != os.getpid():
+                return
+            if self._connection is not None:
+                try:
+                    self._connection.execute(text('SELECT pg_advisory_unlock(:key)'), {'key': self.key})
+                except Exception:
+                    pass
+                self._close_connection()
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+# Create a singleton instance
+scheduler_lock = SchedulerLock()
@@ -0,0 +1,197 @@
+import os
+import hmac
+import hashlib
+import logging
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Hex characters of the solution hash carried in a token
+SOLUTION_HASH_LENGTH = 20
+
+
+class MemoryReplayCache:
+    """
+    Used captcha nonces of one worker process, bounded in size.
+
+    A nonce is only forgotten once its token has expired; when the
+    cache is full of live nonces new tokens are rejected instead.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # nonce -> expires_at, oldest first
+
+    def add(self, nonce, expires_at):
+        with self._lock:
+            now = time.time()
+            while self._entries and next(iter(self._entries.values())) < now:
+                self._entries.popitem(last=False)
+            if nonce in self._entries:
+                return False
+            if len(self._entries) >= self.max_entries:
+                # Nonces are kept in the order they were used, not by expiry
+                for expired in [key for key, value in self._entries.items() if value < now]:
+                    del self._entries[expired]
+                if len(self._entries) >= self.max_entries:
+                    logger.warning("Captcha replay cache is full, rejecting token")
+                    return False
+            self._entries[nonce] = expires_at
+            return True
+
+
+class SharedReplayCache:
+    """
+    Used captcha nonces shared by every worker on the host.
+
+    Nonces live in an SQLite file, on tmpfs (/dev/shm) by default, and
+    INSERT OR IGNORE makes claiming a nonce atomic across workers. Like
+    MemoryReplayCache it never forgets a nonce before its token expires
+    and rejects new tokens while it is full.
+    """
+
+    # Expired nonces are swept after this many inserts
+    SWEEP_EVERY = 500
+
+    def __init__(self, path, max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._inserts = 0
+
+    def add(self, nonce, expires_at):
+        conn = self._connect()
+        with conn:
+            self._inserts += 1
+            if self._inserts % self.SWEEP_EVERY == 0:
+                self._sweep(conn)
+
+            claimed = self._claim(conn, nonce, expires_at)
+            if not claimed and self._is_full(conn):
+                # Sweep once more before turning the token away
+                self._sweep(conn)
+                claimed = self._claim(conn, nonce, expires_at)
+                if not claimed and self._is_full(conn):
+                    logger.warning("Captcha replay cache is full, rejecting token")
+        return claimed
+
+    def _claim(self, conn, nonce, expires_at):
+        # The size check and the insert are one statement, so workers can't overshoot together
+        return conn.execute(
+            'INSERT OR IGNORE INTO used_nonces (nonce, expires_at) '
+            'SELECT ?, ? WHERE (SELECT COUNT(*) FROM used_nonces) < ?',
+            (nonce, expires_at, self.max_entries)
+        ).rowcount == 1
+
+    def _is_full(self, conn):
+        return conn.execute('SELECT COUNT(*) FROM used_nonces').fetchone()[0] >= self.max_entries
+
+    def _sweep(self, conn):
+        """Drop nonces whose tokens have expired"""
+        conn.execute('DELETE FROM used_nonces WHERE expires_at < ?', (time.time(),))
+
+    def _connect(self):
+        # One connection per thread, reopened after a fork
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+
+        conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=OFF')
+        conn.execute('CREATE TABLE IF NOT EXISTS used_nonces (nonce TEXT PRIMARY KEY, expires_at REAL)')
+        conn.execute('CREATE INDEX IF NOT EXISTS ix_used_nonces_expires_at ON used_nonces (expires_at)')
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+
+
+class SignedCaptcha:
+    """
+    Stateless captcha tokens.
+
+    A token is "nonce.expires.solution_hash.signature": the solution is
+    only present as an HMAC keyed with the app secret, and the signature
+    covers the whole token so none of it can be altered. Each nonce is
+    accepted once, tracked by a replay cache that only has to remember
+    nonces until their tokens expire.
+    """
+
+    def __init__(self):
+        self.key = None
+        self.ttl = 600
+        self.replay_cache = None
+
+    def init_app(self, app):
+        self.key = hashlib.sha256(b'marlin-captcha:' + app.config['SECRET_KEY'].encode()).digest()
+        self.ttl = app.config.get('CAPTCHA_TOKEN_TTL_SECONDS', 600)
+
+        max_entries = app.config.get('CAPTCHA_REPLAY_CACHE_MAX_ENTRIES', 100000)
+        if app.config.get('CAPTCHA_REPLAY_CACHE_BACKEND', 'shared') == 'shared':
+            # One file per database, so deployments sharing the host keep separate nonces
+            database = hashlib.sha256(app.config['SQLALCHEMY_DATABASE_URI'].encode()).hexdigest()[:16]
+            path = app.config.get('CAPTCHA_REPLAY_CACHE_PATH') or os.path.join(
+                '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(),
+                f'marlin-captcha-replay-{database}.sqlite'
+            )
+            self.replay_cache = SharedReplayCache(path, max_entries)
+        else:
+            self.replay_cache = MemoryReplayCache(max_entries)
+
+    def issue(self, solution):
+        """
+        Create a token for a captcha solution
+
+        Returns:
+            tuple: (token, expires_at as a UNIX timestamp)
+        """
+        nonce = uuid.uuid4().hex
+        expires_at = int(time.time()) + self.ttl
+        body = f'{nonce}.{expires_at}.{self._hash_solution(nonce, solution)}'
+        return f'{body}.{self._sign(body)}', expires_at
+
+    def verify(self, token, solution):
+        """
+        Check a solution against a token, using the token up
+
+        The nonce is claimed before the solution is compared, so a wrong
+        answer burns the token just like in database mode.
+        """
+        # Tokens are hex and digits; anything else is forged, and compare_digest rejects non-ASCII str
+        if not token.isascii():
+            return False
+        try:
+            nonce, expires_at, solution_hash, signature = token.split('.')
+            expires_at = int(expires_at)
+        except ValueError:
+            return False
+
+        if not hmac.compare_digest(signature.encode(), self._sign(f'{nonce}.{expires_at}.{solution_hash}').encode()):
+            return False
+        if expires_at < time.time():
+            return False
+
+        try:
+            if not self.replay_cache.add(nonce, expires_at):
+                return False
+        except Exception as e:
+            logger.error(f"Error checking captcha replay cache: {str(e)}")
+            return False
+
+        return hmac.compare_digest(solution_hash.encode(), self._hash_solution(nonce, solution).encode())
+
+    def _hash_solution(self, nonce, solution):
+        message = f'{nonce}:{solution.upper()}'.encode()
+        return hmac.new(self.key, message, hashlib.sha256).hexdigest()[:SOLUTION_HASH_LENGTH]
+
+    def _sign(self, body):
+        return hmac.new(self.key, body.encode(), hashlib.sha256).hexdigest()
+
+# Create a singleton instance
+signed_captcha = SignedCaptcha()
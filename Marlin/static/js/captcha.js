@@ -57,7 +57,7 @@ function loadNewCaptcha(tokenInput, captchaImage) {
             if (data.success) {
                 // Update the captcha image and token
                 tokenInput.value = data.token;
-                captchaImage.src = 'data:image/png;base64,' + data.image;
+                captchaImage.src = 'data:' + (data.mime || 'image/png') + ';base64,' + data.image;
                 captchaImage.style.opacity = '1';
             } else {
                 console.error('Failed to generate captcha:', data.error);
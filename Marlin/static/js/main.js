@@ -29,13 +29,16 @@ document.addEventListener('DOMContentLoaded', function() {
     
     postImages.forEach(image => {
         image.addEventListener('click', function() {
-            const imageUrl = this.getAttribute('src');
+            const imageUrl = this.getAttribute('data-full-url') || this.getAttribute('src');
             if (imageUrl) {
                 openImageModal(imageUrl);
             }
         });
     });
     
+    // Swap in thumbnails of images still being processed
+    initPendingImages();
+    
     // Setup captcha handling for forms
     initializeCaptcha();
     
@@ -52,6 +55,45 @@ document.addEventListener('DOMContentLoaded', function() {
     });
 });
 
+/**
+ * Poll for images still being processed and replace their placeholders
+ * with the thumbnails once they are ready
+ */
+function initPendingImages(root = document) {
+    root.querySelectorAll('.image-placeholder[data-image-id]').forEach(placeholder => {
+        const imageId = placeholder.getAttribute('data-image-id');
+        const size = placeholder.getAttribute('data-image-size');
+        let delay = 1000;
+        
+        const poll = function() {
+            fetch(`/api/v1/images/${imageId}?size=${encodeURIComponent(size)}`)
+                .then(response => response.ok ? response.json() : null)
+                .then(data => {
+                    if (data && data.status !== 'pending') {
+                        const template = document.createElement('template');
+                        template.innerHTML = data.html.trim();
+                        const element = template.content.firstElementChild;
+                        placeholder.replaceWith(element);
+                        
+                        const image = element.matches('img') ? element : element.querySelector('img');
+                        if (image && image.classList.contains('post-image')) {
+                            image.addEventListener('click', function() {
+                                openImageModal(this.getAttribute('data-full-url') || this.src);
+                            });
+                        }
+                        return;
+                    }
+                    // Back off up to 30 seconds between polls
+                    delay = Math.min(delay * 2, 30000);
+                    setTimeout(poll, delay);
+                })
+                .catch(() => setTimeout(poll, 30000));
+        };
+        
+        setTimeout(poll, delay);
+    });
+}
+
 /**
  * Opens a modal to display the full-size image
  */
@@ -125,7 +167,7 @@ function getCaptcha(tokenInput, captchaImage) {
         .then(data => {
             if (data.success) {
                 tokenInput.value = data.token;
-                captchaImage.src = 'data:image/png;base64,' + data.image;
+                captchaImage.src = 'data:' + (data.mime || 'image/png') + ';base64,' + data.image;
             } else {
                 console.error('Failed to load captcha:', data.error);
             }
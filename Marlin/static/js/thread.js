@@ -26,13 +26,27 @@ function initThreadPage() {
     
     // Check if thread is locked
     checkThreadLocked();
+    
+    // Receive new replies without reloading the page
+    initLiveUpdates();
+}
+
+/**
+ * Set up formatting and handlers for posts added after page load
+ */
+function initNewPost(post) {
+    formatPostContent(post);
+    initPostReferences(post);
+    initReplyButtons(post);
+    initImageExpanding(post);
+    initPendingImages(post);
 }
 
 /**
  * Format post content (greentext, links, etc.)
  */
-function formatPostContent() {
-    const postContents = document.querySelectorAll('.post-text');
+function formatPostContent(root = document) {
+    const postContents = root.querySelectorAll('.post-text');
     
     postContents.forEach(content => {
         let html = content.innerHTML;
@@ -62,8 +76,8 @@ function formatPostContent() {
 /**
  * Initialize post reference functionality
  */
-function initPostReferences() {
-    const postRefs = document.querySelectorAll('.post-ref');
+function initPostReferences(root = document) {
+    const postRefs = root.querySelectorAll('.post-ref');
     
     postRefs.forEach(ref => {
         // Highlight referenced post when hovering over reference
@@ -178,8 +192,8 @@ function showPostPreview(referenceElement, targetPost) {
 /**
  * Initialize reply buttons for quoting posts
  */
-function initReplyButtons() {
-    const replyButtons = document.querySelectorAll('.reply-button');
+function initReplyButtons(root = document) {
+    const replyButtons = root.querySelectorAll('.reply-button');
     
     replyButtons.forEach(button => {
         button.addEventListener('click', function() {
@@ -211,8 +225,8 @@ function quotePost(postId) {
 /**
  * Initialize image expanding functionality
  */
-function initImageExpanding() {
-    const postImages = document.querySelectorAll('.post-image');
+function initImageExpanding(root = document) {
+    const postImages = root.querySelectorAll('.post-image');
     
     postImages.forEach(image => {
         image.addEventListener('click', function(e) {
@@ -307,3 +321,117 @@ function checkThreadLocked() {
         }
     }
 }
+
+/**
+ * Stream new replies into the page, falling back to polling
+ */
+function initLiveUpdates() {
+    const threadContainer = document.querySelector('.thread-container');
+    const streamUrl = threadContainer && threadContainer.getAttribute('data-stream-url');
+    
+    if (!streamUrl) {
+        return;
+    }
+    
+    if (!window.EventSource) {
+        startPolling();
+        return;
+    }
+    
+    const source = new EventSource(streamUrl + '?after=' + getLastPostId());
+    let failures = 0;
+    
+    source.addEventListener('post', function(e) {
+        failures = 0;
+        const data = JSON.parse(e.data);
+        appendPostHtml(data.id, data.html);
+    });
+    
+    source.addEventListener('open', function() {
+        failures = 0;
+    });
+    
+    source.addEventListener('error', function() {
+        // EventSource reconnects on its own, but not after an error status such as
+        // the 503 of a server out of stream slots; give up after repeated failures
+        failures += 1;
+        if (source.readyState === EventSource.CLOSED || failures >= 3) {
+            source.close();
+            startPolling();
+        }
+    });
+}
+
+/**
+ * ID of the newest post on the page
+ */
+function getLastPostId() {
+    const posts = document.querySelectorAll('.posts-container .post');
+    if (posts.length === 0) {
+        return 0;
+    }
+    return parseInt(posts[posts.length - 1].id.replace('post-', ''), 10) || 0;
+}
+
+/**
+ * Insert a rendered post unless it is already on the page
+ */
+function appendPostHtml(postId, html) {
+    if (document.getElementById('post-' + postId)) {
+        return;
+    }
+    
+    const template = document.createElement('template');
+    template.innerHTML = html.trim();
+    const post = template.content.firstElementChild;
+    
+    if (post) {
+        document.querySelector('.posts-container').appendChild(post);
+        initNewPost(post);
+    }
+}
+
+/**
+ * Poll for posts newer than the last one on the page, backing off while the thread is quiet
+ */
+function startPolling() {
+    const threadContainer = document.querySelector('.thread-container');
+    const postsUrl = threadContainer && threadContainer.getAttribute('data-posts-url');
+    
+    if (!postsUrl) {
+        return;
+    }
+    
+    const minDelay = 5000;
+    const maxDelay = 60000;
+    let delay = minDelay;
+    let etag = null;
+    
+    function poll() {
+        const headers = etag ? { 'If-None-Match': etag } : {};
+        
+        fetch(postsUrl + '?html=1&after=' + getLastPostId(), { headers: headers, cache: 'no-cache' })
+            .then(response => {
+                if (response.status === 304 || !response.ok) {
+                    return null;
+                }
+                etag = response.headers.get('ETag');
+                return response.json();
+            })
+            .then(data => {
+                if (data && data.posts.length > 0) {
+                    data.posts.forEach(post => appendPostHtml(post.id, post.html));
+                    delay = data.has_more ? 0 : minDelay;
+                } else {
+                    delay = Math.min(delay * 1.5, maxDelay);
+                }
+            })
+            .catch(error => {
+                console.error('Error polling thread:', error);
+                delay = Math.min(delay * 2, maxDelay);
+            })
+            .finally(() => setTimeout(poll, delay));
+    }
+    
+    setTimeout(poll, delay);
+}
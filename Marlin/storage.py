@@ -0,0 +1,263 @@
+import os
+import logging
+import tempfile
+
+try:
+    import boto3
+    from botocore.exceptions import ClientError
+except ImportError:  # Only needed for the S3 backend
+    boto3 = None
+
+logger = logging.getLogger(__name__)
+
+# Cache-Control for stored files, whose names change whenever their content does
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+
+def shard_path(file_id, depth=2, width=2):
+    """Relative path of a file fanned out by its leading characters, e.g. ab/cd/abcd..."""
+    shards = [file_id[i * width:(i + 1) * width] for i in range(depth)]
+    return '/'.join(shards + [file_id])
+
+
+class LocalStorage:
+    """
+    Files in one flat folder, the layout used before storage backends.
+
+    Kept as the compatibility mode; the sharded backend also reads and
+    deletes files left in this layout.
+    """
+
+    def __init__(self, root, url_prefix):
+        self.root = root
+        self.url_prefix = url_prefix.rstrip('/')
+        os.makedirs(self.root, exist_ok=True)
+
+    def relative_path(self, file_id):
+        return file_id
+
+    def path(self, file_id):
+        return os.path.join(self.root, self.relative_path(file_id))
+
+    def spool_folder(self):
+        """Folder for temporary files, on the same filesystem so they can be renamed into place"""
+        return self.root
+
+    def exists(self, file_id):
+        return os.path.exists(self.path(file_id))
+
+    def save(self, temp_path, file_id, content_type=None):
+        """Move a finished temporary file into storage"""
+        path = self.path(file_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(temp_path, path)
+
+    def delete(self, file_id):
+        """
+        Returns:
+            bool: True if a file was deleted
+        """
+        path = self.path(file_id)
+        if not os.path.exists(path):
+            return False
+        os.remove(path)
+        return True
+
+    def local_path(self, file_id):
+        """Path to read a stored file from"""
+        return self.path(file_id)
+
+    def evict(self, file_id):
+        """Drop a local copy made by local_path; files on disk need none"""
+
+    def url(self, file_id):
+        return f"{self.url_prefix}/{self.relative_path(file_id)}"
+
+
+class ShardedLocalStorage(LocalStorage):
+    """
+    Files fanned out over nested folders named after the leading characters
+    of their ID, e.g. ab/cd/abcdef....jpg, so no folder grows past a few
+    thousand entries. File IDs are SHA-256 hex digests (or UUIDs for older
+    files), which spreads them evenly.
+    """
+
+    def __init__(self, root, url_prefix, depth=2, width=2):
+        super().__init__(root, url_prefix)
+        self.depth = depth
+        self.width = width
+
+    def relative_path(self, file_id):
+        return shard_path(file_id, self.depth, self.width)
+
+    def legacy_path(self, file_id):
+        return os.path.join(self.root, file_id)
+
+    def spool_folder(self):
+        folder = os.path.join(self.root, 'tmp')
+        os.makedirs(folder, exist_ok=True)
+        return folder
+
+    def exists(self, file_id):
+        return super().exists(file_id) or os.path.exists(self.legacy_path(file_id))
+
+    def delete(self, file_id):
+        deleted = super().delete(file_id)
+        if not deleted and os.path.exists(self.legacy_path(file_id)):
+            os.remove(self.legacy_path(file_id))
+            deleted = True
+        return deleted
+
+    def local_path(self, file_id):
+        path = self.path(file_id)
+        if not os.path.exists(path) and os.path.exists(self.legacy_path(file_id)):
+            return self.legacy_path(file_id)
+        return path
+
+    def migrate(self, file_id):
+        """
+        Move a file from the flat layout into its shard
+
+        Returns:
+            bool: True if the file was moved
+        """
+        legacy_path = self.legacy_path(file_id)
+        if not os.path.exists(legacy_path) or super().exists(file_id):
+            return False
+        self.save(legacy_path, file_id)
+        return True
+
+
+class S3Storage:
+    """
+    Files in an S3-compatible bucket (AWS S3, MinIO, ...), under sharded keys.
+
+    Files are uploaded with an immutable Cache-Control header and served
+    from url_prefix, e.g. the bucket's public endpoint or a CDN. Image
+    processing needs the original on disk, so local_path downloads it
+    into a cache folder.
+    """
+
+    def __init__(self, bucket, url_prefix, endpoint_url=None, region=None, access_key=None,
+                 secret_key=None, key_prefix='', cache_folder=None):
+        if boto3 is None:
+            raise RuntimeError("The S3 storage backend requires boto3")
+        self.bucket = bucket
+        self.url_prefix = url_prefix.rstrip('/')
+        self.key_prefix = key_prefix.strip('/')
+        self.client = boto3.client(
+            's3',
+            endpoint_url=endpoint_url,
+            region_name=region,
+            aws_access_key_id=access_key,
+            aws_secret_access_key=secret_key,
+        )
+        self.cache_folder = cache_folder or os.path.join(tempfile.gettempdir(), 'marlin-storage-cache')
+        os.makedirs(self.cache_folder, exist_ok=True)
+
+    def key(self, file_id):
+        relative = shard_path(file_id)
+        return f"{self.key_prefix}/{relative}" if self.key_prefix else relative
+
+    def spool_folder(self):
+        return self.cache_folder
+
+    def exists(self, file_id):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self.key(file_id))
+            return True
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+
+    def save(self, temp_path, file_id, content_type=None):
+        extra_args = {'CacheControl': IMMUTABLE_CACHE_CONTROL}
+        if content_type:
+            extra_args['ContentType'] = content_type
+        self.client.upload_file(temp_path, self.bucket, self.key(file_id), ExtraArgs=extra_args)
+        os.remove(temp_path)
+
+    def delete(self, file_id):
+        self.client.delete_object(Bucket=self.bucket, Key=self.key(file_id))
+        self.evict(file_id)
+        return True
+
+    def local_path(self, file_id):
+        cached = os.path.join(self.cache_folder, file_id)
+        if not os.path.exists(cached):
+            fd, temp_path = tempfile.mkstemp(dir=self.cache_folder, suffix='.part')
+            os.close(fd)
+            self.client.download_file(self.bucket, self.key(file_id), temp_path)
+            os.replace(temp_path, cached)
+        return cached
+
+    def evict(self, file_id):
+        """Drop the local copy made by local_path"""
+        cached = os.path.join(self.cache_folder, file_id)
+        if os.path.exists(cached):
+            os.remove(cached)
+
+    def url(self, file_id):
+        return f"{self.url_prefix}/{self.key(file_id)}"
+
+
+def default_upload_folder(root_path, instance_path):
+    """
+    Upload folder used when UPLOAD_FOLDER is unset, in the instance folder
+
+    Files used to be kept in static/uploads, where Flask's static route
+    served them, spool files included. A folder left there is moved over
+    the first time.
+    """
+    folder = os.path.join(instance_path, 'uploads')
+    legacy_folder = os.path.join(root_path, 'static', 'uploads')
+    if os.path.isdir(legacy_folder) and not os.path.exists(folder):
+        try:
+            os.makedirs(instance_path, exist_ok=True)
+            os.rename(legacy_folder, folder)
+            logger.info(f"Moved uploads from {legacy_folder} to {folder}")
+        except OSError as e:
+            # Another worker may have moved it first
+            if not os.path.isdir(folder):
+                logger.error(f"Error moving uploads to {folder}: {str(e)}")
+    return folder
+
+
+def create_storage(config, root_path, instance_path):
+    """
+    Build the storage backend selected by STORAGE_BACKEND
+
+    Args:
+        config: App configuration
+        root_path: App root, where older versions kept uploads
+        instance_path: App instance folder, for the default upload folder
+
+    Returns:
+        A LocalStorage, ShardedLocalStorage or S3Storage
+    """
+    backend = config.get('STORAGE_BACKEND', 'sharded')
+    folder = config.get('UPLOAD_FOLDER')
+    if not folder and backend != 's3':
+        folder = default_upload_folder(root_path, instance_path)
+    url_prefix = config.get('STORAGE_URL_PREFIX', '/media')
+
+    if backend == 'local':
+        return LocalStorage(folder, url_prefix)
+    if backend == 'sharded':
+        return ShardedLocalStorage(
+            folder, url_prefix,
+            depth=config.get('STORAGE_SHARD_DEPTH', 2),
+            width=config.get('STORAGE_SHARD_WIDTH', 2),
+        )
+    if backend == 's3':
+        return S3Storage(
+            config['S3_BUCKET'],
+            config.get('S3_PUBLIC_URL') or f"{config.get('S3_ENDPOINT_URL', '').rstrip('/')}/{config['S3_BUCKET']}",
+            endpoint_url=config.get('S3_ENDPOINT_URL'),
+            region=config.get('S3_REGION'),
+            access_key=config.get('S3_ACCESS_KEY'),
+            secret_key=config.get('S3_SECRET_KEY'),
+            key_prefix=config.get('S3_KEY_PREFIX', ''),
+        )
+    raise ValueError(f"Unknown storage backend: {backend}")
@@ -1,88 +1,390 @@
+import time
+import atexit
 import logging
+import click
 from datetime import datetime, timedelta
 from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import update, delete, bindparam, select, func, case, or_
 from app import db, scheduler
-from models import Thread, Post, Image
-from mega_utils import mega_handler
+from models import Thread, Post, Image, ImageJob, Vote, CaptchaToken, TaskCheckpoint
+from view_counter import view_counter
+from catalog import catalog_cache
+from page_cache import page_cache, board_tag, thread_tag, INDEX_TAG
+from conditional import touch_board
+from live import thread_events
+from captcha_pool import captcha_pool
+from captcha import render_captchas
+from image_jobs import image_processor
+from file_deletions import file_deletion_queue
+from scheduler_lock import scheduler_lock
 
 logger = logging.getLogger(__name__)
 
-def cleanup_old_threads():
+# Row in task_checkpoints holding where cleanup_old_threads stopped
+CLEANUP_CHECKPOINT = 'cleanup_old_threads'
+
+
+def cleanup_old_threads(app):
     """
     Cleans up old threads and their associated posts and images
     based on age, upvotes, and views.
+    
+    Threads are deleted THREAD_CLEANUP_BATCH_SIZE at a time, one short
+    transaction per batch. The last deleted thread id is committed with
+    each batch, so a run that hits THREAD_CLEANUP_TIME_BUDGET_SECONDS or
+    fails resumes there next time. Files are queued for deletion and
+    removed from storage by the file deletion queue after each commit.
     """
-    with current_app.app_context():
+    with app.app_context():
         try:
             logger.info("Starting thread cleanup task")
             
             # Get the maximum age threshold
-            max_age_days = current_app.config.get('THREAD_MAX_AGE_DAYS', 120)
+            max_age_days = app.config.get('THREAD_MAX_AGE_DAYS', 120)
             age_threshold = datetime.utcnow() - timedelta(days=max_age_days)
+            batch_size = app.config.get('THREAD_CLEANUP_BATCH_SIZE', 100)
+            deadline = time.monotonic() + app.config.get('THREAD_CLEANUP_TIME_BUDGET_SECONDS', 300)
             
-            # Find old threads that have low activity
-            old_threads = Thread.query.filter(
-                Thread.created_at < age_threshold,
-                Thread.sticky.is_(False),  # Don't delete sticky threads
-                Thread.upvotes < 5,  # Low upvotes
-                Thread.views < 100  # Low views
-            ).all()
-            
-            logger.info(f"Found {len(old_threads)} old threads to clean up")
+            checkpoint = db.session.get(TaskCheckpoint, CLEANUP_CHECKPOINT)
+            if checkpoint is None:
+                checkpoint = TaskCheckpoint(name=CLEANUP_CHECKPOINT, last_id=0)
+                db.session.add(checkpoint)
+            if checkpoint.last_id:
+                logger.info(f"Resuming thread cleanup after thread {checkpoint.last_id}")
             
-            for thread in old_threads:
-                logger.info(f"Cleaning up thread {thread.id} from board /{thread.board.slug}/")
+            deleted_count = 0
+            while True:
+                if time.monotonic() >= deadline:
+                    logger.info(f"Thread cleanup ran out of time after thread {checkpoint.last_id}, will resume there")
+                    break
                 
-                # Get all posts in the thread
-                posts = Post.query.filter_by(thread_id=thread.id).all()
+                # Find old threads that have low activity
+                batch = db.session.execute(
+                    select(Thread.id, Thread.board_id).where(
+                        Thread.id > checkpoint.last_id,
+                        Thread.created_at < age_threshold,
+                        Thread.sticky.is_(False),  # Don't delete sticky threads
+                        Thread.upvotes < 5,  # Low upvotes
+                        Thread.views < 100  # Low views
+                    ).order_by(Thread.id).limit(batch_size)
+                ).all()
                 
-                # Clean up images from all posts
-                for post in posts:
-                    images = Image.query.filter_by(post_id=post.id).all()
-                    
-                    for image in images:
-                        # Delete from Mega.nz
-                        if image.mega_url:
-                            logger.info(f"Deleting image {image.id} from Mega.nz")
-                            mega_handler.delete_file(image.mega_url)
-                        
-                        # Delete the image record
-                        db.session.delete(image)
-                    
-                    # Delete the post
-                    db.session.delete(post)
+                if not batch:
+                    # Every old thread has been seen; the next run starts over
+                    checkpoint.last_id = 0
+                    checkpoint.updated_at = datetime.utcnow()
+                    db.session.commit()
+                    break
                 
-                # Delete the thread
-                db.session.delete(thread)
+                delete_threads(batch)
+                checkpoint.last_id = batch[-1].id
+                checkpoint.updated_at = datetime.utcnow()
+                db.session.commit()
+                deleted_count += len(batch)
+                
+                for thread_id, board_id in batch:
+                    catalog_cache.remove_thread(board_id, thread_id)
+                    page_cache.invalidate(board_tag(board_id), thread_tag(thread_id))
+                    thread_events.discard(thread_id)
+                page_cache.invalidate(INDEX_TAG)
+                file_deletion_queue.kick()
+                logger.info(f"Deleted {len(batch)} old threads")
             
-            # Commit all deletions
-            db.session.commit()
-            logger.info("Thread cleanup task completed successfully")
+            logger.info(f"Thread cleanup task completed, {deleted_count} threads deleted")
             
         except Exception as e:
             logger.error(f"Error in thread cleanup task: {str(e)}")
             db.session.rollback()
 
 
+def delete_threads(threads):
+    """
+    Delete threads with their posts, images, image jobs and votes using
+    one set-based DELETE per table, in the current transaction.
+    
+    Their files are released and queued for deletion; call
+    file_deletion_queue.kick() after committing.
+    
+    Args:
+        threads: (thread_id, board_id) rows
+    
+    Returns:
+        int: Number of files queued for deletion
+    """
+    thread_ids = [thread_id for thread_id, _ in threads]
+    post_ids = select(Post.id).where(Post.thread_id.in_(thread_ids))
+    image_ids = select(Image.id).where(Image.post_id.in_(post_ids))
+    
+    file_ids = []
+    for mega_url, thumbnails in db.session.execute(
+        select(Image.mega_url, Image.thumbnails).where(Image.post_id.in_(post_ids))
+    ):
+        file_ids.extend(Image.stored_file_ids(mega_url, thumbnails))
+    queued = file_deletion_queue.release(file_ids)
+    
+    votes = Vote.__table__
+    db.session.execute(delete(ImageJob.__table__).where(ImageJob.__table__.c.image_id.in_(image_ids)))
+    db.session.execute(delete(votes).where(or_(votes.c.thread_id.in_(thread_ids), votes.c.post_id.in_(post_ids))))
+    db.session.execute(delete(Image.__table__).where(Image.__table__.c.post_id.in_(post_ids)))
+    db.session.execute(delete(Post.__table__).where(Post.__table__.c.thread_id.in_(thread_ids)))
+    db.session.execute(delete(Thread.__table__).where(Thread.__table__.c.id.in_(thread_ids)))
+    
+    for board_id in {board_id for _, board_id in threads}:
+        touch_board(board_id)
+    return queued
+
+
+def flush_view_counts(app):
+    """
+    Write the view counts accumulated in this process to the threads table
+    using a single batched UPDATE.
+    """
+    counts = view_counter.drain()
+    if not counts:
+        return
+    
+    with app.app_context():
+        try:
+            threads = Thread.__table__
+            # updated_at is carried over explicitly so views don't bump threads
+            stmt = update(threads).where(threads.c.id == bindparam('thread_id')).values(
+                views=threads.c.views + bindparam('delta'),
+                updated_at=threads.c.updated_at
+            )
+            db.session.execute(stmt, [
+                {'thread_id': thread_id, 'delta': delta}
+                for thread_id, delta in counts.items()
+            ])
+            db.session.commit()
+            logger.debug(f"Flushed views for {len(counts)} threads")
+        except Exception as e:
+            logger.error(f"Error flushing view counts: {str(e)}")
+            db.session.rollback()
+            view_counter.restore(counts)
+
+
+def refill_captcha_pool(app):
+    """
+    Top the captcha pool up to its high watermark once it has dropped
+    below the low watermark.
+    """
+    count = captcha_pool.deficit()
+    if not count:
+        return
+    
+    with app.app_context():
+        try:
+            captcha_pool.extend(render_captchas(count))
+            logger.debug(f"Added {count} captchas to the pool")
+        except Exception as e:
+            logger.error(f"Error refilling captcha pool: {str(e)}")
+            db.session.rollback()
+
+
+def purge_captcha_tokens(app):
+    """
+    Delete used captcha tokens, and unused ones too old to be solved,
+    so the captcha_tokens table stops growing.
+    """
+    with app.app_context():
+        try:
+            max_age_hours = app.config.get('CAPTCHA_TOKEN_MAX_AGE_HOURS', 24)
+            cutoff = datetime.utcnow() - timedelta(hours=max_age_hours)
+            
+            deleted = CaptchaToken.query.filter(
+                db.or_(CaptchaToken.used.is_(True), CaptchaToken.created_at < cutoff)
+            ).delete(synchronize_session=False)
+            db.session.commit()
+            logger.info(f"Purged {deleted} captcha tokens")
+        except Exception as e:
+            logger.error(f"Error purging captcha tokens: {str(e)}")
+            db.session.rollback()
+
+
+def requeue_image_jobs(app):
+    """
+    Resubmit image processing jobs that are due for a retry or were
+    lost, e.g. when a worker restarted mid-job.
+    """
+    with app.app_context():
+        try:
+            started = image_processor.requeue_stale()
+            if started:
+                logger.info(f"Resubmitted {started} image jobs")
+        except Exception as e:
+            logger.error(f"Error requeueing image jobs: {str(e)}")
+            db.session.rollback()
+
+
+def drain_file_deletions(app):
+    """
+    Start deleting queued files that are due, i.e. retries and files
+    left behind by a process that exited before deleting them.
+    """
+    with app.app_context():
+        try:
+            file_deletion_queue.kick()
+        except Exception as e:
+            logger.error(f"Error draining file deletions: {str(e)}")
+            db.session.rollback()
+
+
+def refresh_thread_counters(thread_ids=None):
+    """
+    Recompute the denormalized reply_count, image_count and last_post_at
+    columns from posts and images with one set-based UPDATE.
+    
+    Args:
+        thread_ids: Threads to refresh, or None for every thread
+    
+    The caller is responsible for committing.
+    """
+    threads = Thread.__table__
+    
+    post_count = select(func.count(Post.id)).where(
+        Post.thread_id == threads.c.id
+    ).scalar_subquery()
+    image_count = select(func.count(Image.id)).join(Post, Image.post_id == Post.id).where(
+        Post.thread_id == threads.c.id
+    ).scalar_subquery()
+    last_post_at = select(func.max(Post.created_at)).where(
+        Post.thread_id == threads.c.id
+    ).scalar_subquery()
+    
+    stmt = update(threads).values(
+        reply_count=case((post_count > 0, post_count - 1), else_=0),  # Subtract OP
+        image_count=image_count,
+        last_post_at=func.coalesce(last_post_at, threads.c.created_at),
+        updated_at=threads.c.updated_at  # Don't bump threads
+    )
+    if thread_ids is not None:
+        stmt = stmt.where(threads.c.id.in_(thread_ids))
+    
+    db.session.flush()
+    db.session.execute(stmt)
+
+
+@click.command('repair-thread-counters')
+@with_appcontext
+def repair_thread_counters_command():
+    """Recompute thread reply/image counters from posts and images."""
+    refresh_thread_counters()
+    db.session.commit()
+    click.echo("Thread counters repaired.")
+
+
+def run_as_leader(job, app):
+    """
+    Run a shared job only in the process holding the scheduler lock, so
+    it runs once across all web workers, marlin-worker processes and nodes.
+    """
+    with app.app_context():
+        try:
+            leader = scheduler_lock.is_leader()
+        except Exception as e:
+            logger.error(f"Error taking the scheduler lock: {str(e)}")
+            db.session.rollback()
+            return
+    
+    if leader:
+        job(app)
+    else:
+        logger.debug(f"Skipping {job.__name__}, another process is the scheduler leader")
+
+
 def start_scheduler(scheduler):
     """
     Start the background scheduler with cleanup tasks
+    
+    SCHEDULER_JOBS selects what this process runs: the local jobs work on
+    state held in each process (buffered views, the captcha pool), the
+    shared jobs on the database, and those only run in the process elected
+    by scheduler_lock. 'all' schedules both, 'local' suits web workers
+    next to a marlin-worker, which runs with 'shared'.
     """
     try:
-        # Add the cleanup job to run at the specified interval
-        interval_hours = current_app.config.get('THREAD_CLEANUP_INTERVAL_HOURS', 24)
+        app = current_app._get_current_object()
+        jobs = current_app.config.get('SCHEDULER_JOBS', 'all')
         
-        scheduler.add_job(
-            cleanup_old_threads,
-            'interval',
-            hours=interval_hours,
-            id='cleanup_old_threads',
-            replace_existing=True
-        )
+        if jobs in ('all', 'local'):
+            # Periodically write buffered thread views to the database
+            flush_seconds = current_app.config.get('VIEW_COUNT_FLUSH_INTERVAL_SECONDS', 10)
+            
+            scheduler.add_job(
+                flush_view_counts,
+                'interval',
+                seconds=flush_seconds,
+                args=[app],
+                id='flush_view_counts',
+                replace_existing=True
+            )
+            
+            # Flush whatever is still buffered when the worker shuts down
+            atexit.register(flush_view_counts, app)
+            
+            # Keep a pool of pre-rendered captchas, filling it right away
+            if current_app.config.get('CAPTCHA_POOL_ENABLED', True):
+                scheduler.add_job(
+                    refill_captcha_pool,
+                    'interval',
+                    seconds=current_app.config.get('CAPTCHA_POOL_REFILL_INTERVAL_SECONDS', 2),
+                    args=[app],
+                    id='refill_captcha_pool',
+                    next_run_time=datetime.now(),
+                    replace_existing=True
+                )
+        
+        if jobs in ('all', 'shared'):
+            # Add the cleanup job to run at the specified interval
+            interval_hours = current_app.config.get('THREAD_CLEANUP_INTERVAL_HOURS', 24)
+            
+            scheduler.add_job(
+                run_as_leader,
+                'interval',
+                hours=interval_hours,
+                args=[cleanup_old_threads, app],
+                id='cleanup_old_threads',
+                name='cleanup_old_threads',
+                replace_existing=True
+            )
+            
+            # Purge the captcha_tokens table, also left over after switching to signed tokens
+            scheduler.add_job(
+                run_as_leader,
+                'interval',
+                hours=current_app.config.get('CAPTCHA_PURGE_INTERVAL_HOURS', 1),
+                args=[purge_captcha_tokens, app],
+                id='purge_captcha_tokens',
+                name='purge_captcha_tokens',
+                replace_existing=True
+            )
+            
+            # Retry failed image jobs and pick up lost ones
+            scheduler.add_job(
+                run_as_leader,
+                'interval',
+                seconds=current_app.config.get('IMAGE_JOB_RETRY_DELAY_SECONDS', 30),
+                args=[requeue_image_jobs, app],
+                id='requeue_image_jobs',
+                name='requeue_image_jobs',
+                replace_existing=True
+            )
+            
+            # Retry failed file deletions and finish interrupted ones
+            scheduler.add_job(
+                run_as_leader,
+                'interval',
+                seconds=current_app.config.get('FILE_DELETION_RETRY_DELAY_SECONDS', 60),
+                args=[drain_file_deletions, app],
+                id='drain_file_deletions',
+                name='drain_file_deletions',
+                replace_existing=True
+            )
         
         # Start the scheduler if it's not already running
         if not scheduler.running:
             scheduler.start()
-            logger.info(f"Scheduler started. Thread cleanup will run every {interval_hours} hours.")
+            logger.info(f"Scheduler started with {jobs} jobs ({scheduler_lock.backend} leader lock).")
     except Exception as e:
         logger.error(f"Failed to start scheduler: {str(e)}")
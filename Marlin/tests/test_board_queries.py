@@ -0,0 +1,78 @@
+import os
+import sys
+import tempfile
+import threading
+
+# The app reads its configuration when it is imported
+DATA_DIR = tempfile.mkdtemp(prefix='marlin-test-')
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(DATA_DIR, 'marlin.db')}"
+os.environ.setdefault('MEGA_EMAIL', 'test@example.com')
+os.environ.setdefault('MEGA_PASSWORD', 'test')
+os.environ['PAGE_CACHE_BACKEND'] = 'none'
+os.environ['SCHEDULER_LOCK'] = 'none'
+os.environ['IMAGE_PROCESSING_WORKERS'] = '0'
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+from sqlalchemy import event
+from app import app, db, scheduler
+from models import Board, Thread, Post, Image
+
+
+@pytest.fixture(scope='module')
+def client():
+    if scheduler.running:
+        scheduler.shutdown(wait=False)
+    return app.test_client()
+
+
+def create_threads(slug, count, replies=3):
+    """Give a board threads whose first posts have an image, plus some replies"""
+    with app.app_context():
+        board = Board.query.filter_by(slug=slug).first()
+        for n in range(count):
+            thread = Thread(subject=f'Thread {n}', board_id=board.id, reply_count=replies)
+            db.session.add(thread)
+            db.session.flush()
+            for position in range(replies + 1):
+                post = Post(content=f'Post {position}', thread_id=thread.id)
+                db.session.add(post)
+                db.session.flush()
+                db.session.add(Image(
+                    filename='image.png', mega_url=f'{thread.id}-{position}.png',
+                    public_url=f'/media/{thread.id}-{position}.png', post_id=post.id
+                ))
+        db.session.commit()
+
+
+def count_queries(client, url):
+    """Number of SQL statements run while rendering a page"""
+    statements = []
+    request_thread = threading.get_ident()
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        # Background jobs share the engine; only count the request's own queries
+        if threading.get_ident() == request_thread:
+            statements.append(statement)
+
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', record)
+    try:
+        response = client.get(url)
+    finally:
+        event.remove(engine, 'before_cursor_execute', record)
+    assert response.status_code == 200
+    return len(statements)
+
+
+def test_board_page_queries_do_not_grow_with_threads(client):
+    create_threads('p', 1)
+    create_threads('ck', 15)
+
+    one_thread = count_queries(client, '/p/')
+    full_page = count_queries(client, '/ck/')
+
+    assert one_thread == full_page
+    assert full_page <= 4
@@ -1,15 +1,21 @@
 import logging
-import uuid
-import os
+import time
 from datetime import datetime
 from flask import Blueprint, render_template, redirect, url_for, request, flash, current_app, abort
+from flask import Response, make_response, stream_template, stream_with_context, get_flashed_messages, json
+from flask_wtf.csrf import generate_csrf
 from flask_login import current_user, login_required
-from werkzeug.utils import secure_filename
 from app import db
 from models import Board, Thread, Post, Image, Vote
 from forms import NewThreadForm, ReplyForm
 from captcha import validate_captcha
-from mega_utils import mega_handler
+from image_processing import store_image
+from image_jobs import image_processor
+from view_counter import view_counter
+from catalog import catalog_cache
+from page_cache import page_cache, board_tag, thread_tag, INDEX_TAG
+from live import thread_events
+from conditional import make_validators, is_not_modified, not_modified, add_validators, touch_board, touch_thread
 
 logger = logging.getLogger(__name__)
 
@@ -18,36 +24,164 @@ threads_bp = Blueprint('threads', __name__)
 
 @threads_bp.route('/<board_slug>/thread/<int:thread_id>')
 def view_thread(board_slug, thread_id):
+    cache_key = None
+    if page_cache.is_cacheable():
+        cache_key = f'thread:{board_slug}:{thread_id}'
+        cached = page_cache.get(cache_key)
+        if cached is not None:
+            if cached.status_code == 200:
+                view_counter.increment(thread_id)
+            return cached
+    
     board = Board.query.filter_by(slug=board_slug).first_or_404()
     thread = Thread.query.filter_by(id=thread_id, board_id=board.id).first_or_404()
     
-    # Increment view counter
-    thread.views += 1
-    db.session.commit()
-    
-    # Get all posts in the thread with images
-    posts = Post.query.filter_by(thread_id=thread.id).order_by(Post.created_at).all()
+    # Answer conditional GETs before loading any posts
+    validators = make_validators(thread.last_modified_at or thread.updated_at)
+    if is_not_modified(validators):
+        return not_modified(validators)
     
-    # Get images for all posts
-    posts_with_images = []
-    for post in posts:
-        images = Image.query.filter_by(post_id=post.id).all()
-        posts_with_images.append({
-            'post': post,
-            'images': images
-        })
+    # Count the view; it is written to the database by the flush_view_counts task
+    view_counter.increment(thread.id)
     
     # Create reply form
     form = ReplyForm()
     
-    return render_template(
+    title = f'/{board.slug}/ - {thread.subject or "Thread #" + str(thread.id)}'
+    
+    if cache_key:
+        posts = Post.query.filter_by(thread_id=thread.id).order_by(Post.created_at, Post.id).all()
+        return page_cache.render(
+            cache_key,
+            [thread_tag(thread.id)],
+            'thread.html',
+            validators=validators,
+            title=title,
+            board=board,
+            thread=thread,
+            posts_with_images=attach_images(posts),
+            form=form
+        )
+    
+    if current_app.config.get('THREAD_STREAM_RENDER', False):
+        # Pop flashes and create the CSRF token now, since the session cookie
+        # is sent before the streamed body is rendered
+        get_flashed_messages(with_categories=True)
+        generate_csrf()
+        
+        chunk_size = current_app.config.get('THREAD_RENDER_CHUNK_SIZE', 100)
+        return add_validators(Response(stream_template(
+            'thread.html',
+            title=title,
+            board=board,
+            thread=thread,
+            posts_with_images=iter_posts_with_images(thread.id, chunk_size),
+            form=form
+        )), validators)
+    
+    # Get all posts in the thread with their images
+    posts = Post.query.filter_by(thread_id=thread.id).order_by(Post.created_at, Post.id).all()
+    
+    return add_validators(make_response(render_template(
         'thread.html',
-        title=f'/{board.slug}/ - {thread.subject or "Thread #" + str(thread.id)}',
+        title=title,
         board=board,
         thread=thread,
-        posts_with_images=posts_with_images,
+        posts_with_images=attach_images(posts),
         form=form
-    )
+    )), validators)
+
+
+def attach_images(posts):
+    """Pair each post with its images using a single query for all of them"""
+    images_by_post = {post.id: [] for post in posts}
+    if images_by_post:
+        images = Image.query.filter(Image.post_id.in_(images_by_post.keys())).order_by(Image.id).all()
+        for image in images:
+            images_by_post[image.post_id].append(image)
+    
+    return [{'post': post, 'images': images_by_post[post.id]} for post in posts]
+
+
+def iter_posts_with_images(thread_id, chunk_size):
+    """
+    Yield the posts of a thread with their images, one chunk at a time.
+    
+    Posts are fetched with yield_per so only one chunk is held in memory,
+    and images are loaded with one query per chunk.
+    """
+    query = Post.query.filter_by(thread_id=thread_id).order_by(Post.created_at, Post.id)
+    chunk = []
+    for post in query.yield_per(chunk_size):
+        chunk.append(post)
+        if len(chunk) >= chunk_size:
+            yield from attach_images(chunk)
+            chunk = []
+    if chunk:
+        yield from attach_images(chunk)
+
+
+@threads_bp.route('/<board_slug>/thread/<int:thread_id>/stream')
+def thread_stream(board_slug, thread_id):
+    """Server-Sent Events stream of posts added to a thread"""
+    if not current_app.config.get('LIVE_UPDATES_ENABLED', True):
+        abort(404)
+    
+    board = Board.query.filter_by(slug=board_slug).first_or_404()
+    thread = Thread.query.filter_by(id=thread_id, board_id=board.id).first_or_404()
+    
+    # Resume after the last post the client has, from the reconnect header or the URL
+    last_id = request.headers.get('Last-Event-ID', type=int) or request.args.get('after', type=int)
+    if last_id is None:
+        last_post = Post.query.filter_by(thread_id=thread.id).order_by(Post.id.desc()).first()
+        last_id = last_post.id if last_post else 0
+    
+    max_seconds = current_app.config.get('LIVE_STREAM_MAX_SECONDS', 300)
+    keepalive_seconds = current_app.config.get('LIVE_KEEPALIVE_SECONDS', 15)
+    
+    # Every stream holds a worker thread; past the cap the client polls instead
+    if not thread_events.open_stream():
+        response = make_response('Too many live streams', 503)
+        response.headers['Retry-After'] = str(max_seconds)
+        return response
+    
+    def generate():
+        nonlocal last_id
+        deadline = time.monotonic() + max_seconds
+        version = thread_events.version(thread.id)
+        
+        yield 'retry: 3000\n\n'
+        
+        # Catch up first, then wait for signals and only query when one arrives
+        changed = True
+        while time.monotonic() < deadline:
+            if changed:
+                posts = Post.query.filter(
+                    Post.thread_id == thread.id,
+                    Post.id > last_id
+                ).order_by(Post.id).all()
+                
+                for item in attach_images(posts):
+                    html = render_template('post.html', board=board, thread=thread, is_op=False, **item)
+                    last_id = item['post'].id
+                    yield f"id: {last_id}\nevent: post\ndata: {json.dumps({'id': last_id, 'html': html})}\n\n"
+                
+                # Don't hold a pooled connection while idle
+                db.session.close()
+            
+            new_version = thread_events.wait(
+                thread.id, version, min(keepalive_seconds, max(deadline - time.monotonic(), 0))
+            )
+            changed = new_version != version
+            version = new_version
+            if not changed:
+                yield ': keepalive\n\n'
+    
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream')
+    response.call_on_close(thread_events.close_stream)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # Stop nginx from buffering the stream
+    return response
 
 
 @threads_bp.route('/<board_slug>/new', methods=['GET', 'POST'])
@@ -64,7 +198,9 @@ def new_thread(board_slug):
         # Create new thread
         thread = Thread(
             subject=form.subject.data,
-            board_id=board.id
+            board_id=board.id,
+            reply_count=0,
+            image_count=0
         )
         db.session.add(thread)
         db.session.flush()  # Get the thread ID
@@ -80,33 +216,33 @@ def new_thread(board_slug):
         db.session.flush()  # Get the post ID
         
         # Handle image upload if provided
+        image = image_job = None
         if form.image.data:
             try:
-                # Generate unique filename
-                original_filename = secure_filename(form.image.data.filename)
-                file_ext = os.path.splitext(original_filename)[1]
-                new_filename = f"{uuid.uuid4().hex}{file_ext}"
-                
-                # Upload to Mega.nz
-                mega_url, public_url = mega_handler.upload_file(form.image.data, new_filename)
+                # Store the original; thumbnails are made off the request
+                stored = store_image(form.image.data)
                 
-                if mega_url and public_url:
+                if stored:
                     # Create image record
-                    image = Image(
-                        filename=new_filename,
-                        mega_url=mega_url,
-                        public_url=public_url,
-                        post_id=post.id
-                    )
+                    image = Image(post_id=post.id, **stored)
                     db.session.add(image)
+                    image_job = image_processor.enqueue(image)
+                    thread.image_count = 1
                 else:
                     flash('Failed to upload image. Thread created without image.', 'warning')
             except Exception as e:
                 logger.error(f"Error uploading image: {str(e)}")
                 flash('Error uploading image. Thread created without image.', 'warning')
         
+        thread.last_post_at = post.created_at
+        touch_board(board.id)
+        
         # Commit all changes
         db.session.commit()
+        catalog_cache.add_thread(thread, post, image)
+        page_cache.invalidate(board_tag(board.id), INDEX_TAG)
+        if image_job:
+            image_processor.submit(image_job.id)
         
         flash('Thread created successfully!', 'success')
         return redirect(url_for('threads.view_thread', board_slug=board_slug, thread_id=thread.id))
@@ -149,36 +285,38 @@ def reply(board_slug, thread_id):
         db.session.flush()  # Get the post ID
         
         # Handle image upload if provided
+        image_job = None
         if form.image.data:
             try:
-                # Generate unique filename
-                original_filename = secure_filename(form.image.data.filename)
-                file_ext = os.path.splitext(original_filename)[1]
-                new_filename = f"{uuid.uuid4().hex}{file_ext}"
-                
-                # Upload to Mega.nz
-                mega_url, public_url = mega_handler.upload_file(form.image.data, new_filename)
+                # Store the original; thumbnails are made off the request
+                stored = store_image(form.image.data)
                 
-                if mega_url and public_url:
+                if stored:
                     # Create image record
-                    image = Image(
-                        filename=new_filename,
-                        mega_url=mega_url,
-                        public_url=public_url,
-                        post_id=post.id
-                    )
+                    image = Image(post_id=post.id, **stored)
                     db.session.add(image)
+                    image_job = image_processor.enqueue(image)
+                    thread.image_count = Thread.image_count + 1
                 else:
                     flash('Failed to upload image. Reply posted without image.', 'warning')
             except Exception as e:
                 logger.error(f"Error uploading image: {str(e)}")
                 flash('Error uploading image. Reply posted without image.', 'warning')
         
-        # Update thread's updated_at timestamp (bump)
+        # Update thread's counters and updated_at timestamp (bump)
+        thread.reply_count = Thread.reply_count + 1
+        thread.last_post_at = post.created_at
         thread.updated_at = datetime.utcnow()
+        touch_board(board.id)
+        touch_thread(thread.id)
         
         # Commit all changes
         db.session.commit()
+        catalog_cache.update_thread(thread)
+        page_cache.invalidate(board_tag(board.id), thread_tag(thread.id))
+        thread_events.publish(thread.id)
+        if image_job:
+            image_processor.submit(image_job.id)
         
         flash('Reply posted successfully!', 'success')
         return redirect(url_for('threads.view_thread', board_slug=board_slug, thread_id=thread_id))
@@ -211,7 +349,10 @@ def upvote_thread(board_slug, thread_id):
         
         # Increment thread upvotes
         thread.upvotes += 1
+        touch_board(board.id)
+        touch_thread(thread.id)
         db.session.commit()
+        page_cache.invalidate(board_tag(board.id), thread_tag(thread.id), INDEX_TAG)
         
         flash('Thread upvoted!', 'success')
     
@@ -243,7 +384,9 @@ def upvote_post(board_slug, thread_id, post_id):
         
         # Increment post upvotes
         post.upvotes += 1
+        touch_thread(thread.id)
         db.session.commit()
+        page_cache.invalidate(thread_tag(thread.id))
         
         flash('Post upvoted!', 'success')
     
@@ -0,0 +1,121 @@
+import os
+import hashlib
+import logging
+import tempfile
+from flask import Request
+from mega_utils import mega_handler
+
+logger = logging.getLogger(__name__)
+
+# Leading bytes of the accepted image formats: (offset, signature, format)
+IMAGE_SIGNATURES = (
+    (0, b'\xff\xd8\xff', 'jpeg'),
+    (0, b'\x89PNG\r\n\x1a\n', 'png'),
+    (0, b'GIF87a', 'gif'),
+    (0, b'GIF89a', 'gif'),
+    (8, b'WEBP', 'webp'),  # After "RIFF" and the chunk size
+)
+
+# Bytes needed to recognise every format above
+SNIFF_BYTES = 12
+
+# File extension stored for each format
+FORMAT_EXTENSIONS = {'jpeg': '.jpg', 'png': '.png', 'gif': '.gif', 'webp': '.webp'}
+
+
+def sniff_image_format(head):
+    """Image format from the first bytes of a file, or None if it is not an accepted image"""
+    for offset, signature, image_format in IMAGE_SIGNATURES:
+        if head[offset:offset + len(signature)] == signature:
+            if image_format == 'webp' and not head.startswith(b'RIFF'):
+                continue
+            return image_format
+    return None
+
+
+class StreamedUpload:
+    """
+    Spool for one uploaded file, written by the multipart parser chunk by chunk.
+
+    The file goes straight to a temporary file in the upload folder while
+    it is hashed, so storing it is a rename instead of another copy. The
+    first bytes are checked as soon as they arrive: once a file is known
+    not to be an image, the rest of it is discarded unread.
+    """
+
+    def __init__(self, directory):
+        fd, self.path = tempfile.mkstemp(dir=directory, suffix='.part')
+        self.file = os.fdopen(fd, 'w+b')
+        self.digest = hashlib.sha256()
+        self.size = 0
+        self.head = b''
+        self.image_format = None
+        self.rejected = False
+
+    def write(self, data):
+        if self.rejected:
+            return len(data)
+
+        if len(self.head) < SNIFF_BYTES:
+            self.head += data[:SNIFF_BYTES - len(self.head)]
+            if len(self.head) == SNIFF_BYTES:
+                self._sniff()
+                if self.rejected:
+                    return len(data)
+
+        self.digest.update(data)
+        self.size += len(data)
+        return self.file.write(data)
+
+    def _sniff(self):
+        self.image_format = sniff_image_format(self.head)
+        if self.image_format is None:
+            # Drop what was written; later chunks are ignored
+            self.rejected = True
+            self.size = 0
+            self.file.truncate(0)
+            logger.info("Rejected upload that is not an image")
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        # The parser seeks back to the start once the file is complete
+        if self.image_format is None and not self.rejected:
+            self._sniff()
+        return self.file.seek(offset, whence)
+
+    @property
+    def sha256(self):
+        return self.digest.hexdigest()
+
+    def detach(self):
+        """
+        Hand the spooled file over to storage
+
+        Returns:
+            str: Path of the temporary file, which the caller now owns
+        """
+        self.file.flush()
+        path, self.path = self.path, None
+        return path
+
+    def close(self):
+        self.file.close()
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+        self.path = None
+
+    def __getattr__(self, name):
+        # read, readline, tell, flush, ... go to the temporary file
+        return getattr(self.file, name)
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+class UploadRequest(Request):
+    """Request that spools file uploads through StreamedUpload"""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return StreamedUpload(mega_handler.spool_folder())
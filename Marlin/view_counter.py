@@ -0,0 +1,43 @@
+import logging
+import threading
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+class ViewCounter:
+    """
+    In-process accumulator for thread view counts.
+
+    Views are counted in memory on each request and written to the
+    database in bulk by the flush_view_counts task, so a GET never has to
+    take a row lock on the thread.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = Counter()
+
+    def increment(self, thread_id, amount=1):
+        """Record views for a thread"""
+        with self._lock:
+            self._pending[thread_id] += amount
+
+    def drain(self):
+        """
+        Take all pending counts, leaving the accumulator empty
+
+        Returns:
+            Counter: Pending views keyed by thread ID
+        """
+        with self._lock:
+            pending = self._pending
+            self._pending = Counter()
+        return pending
+
+    def restore(self, counts):
+        """Put drained counts back, e.g. after a failed flush"""
+        with self._lock:
+            self._pending.update(counts)
+
+# Create a singleton instance
+view_counter = ViewCounter()
@@ -0,0 +1,38 @@
+"""
+Runs the shared background jobs outside the web workers:
+
+    ./marlin-worker    (or python worker.py)
+
+Start the web app with SCHEDULER_JOBS=local next to it. More than one
+worker can run, e.g. one per node: the scheduler lock elects the one
+that runs the jobs, and another takes over if it stops.
+"""
+import os
+import signal
+import logging
+import threading
+
+# Read by the app's config when it is imported, which starts the scheduler
+os.environ.setdefault('SCHEDULER_JOBS', 'shared')
+
+logger = logging.getLogger(__name__)
+
+
+def main():
+    from app import app, scheduler
+    from scheduler_lock import scheduler_lock
+    
+    stop = threading.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *args: stop.set())
+    
+    logger.info(f"marlin-worker {os.getpid()} running {app.config['SCHEDULER_JOBS']} jobs")
+    stop.wait()
+    
+    logger.info("marlin-worker shutting down")
+    scheduler.shutdown()
+    scheduler_lock.release()
+
+
+if __name__ == "__main__":
+    main()